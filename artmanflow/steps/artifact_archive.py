@@ -0,0 +1,233 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import multiprocessing
+import os
+import subprocess
+import tarfile
+import threading
+from shutil import which
+
+
+class StreamingArchive(object):
+    def __init__(self, path, compression='gzip', threads=None,
+        manifest_path=None):
+        self._path = path
+        self._part_path = path + '.part'
+        self._lock = threading.Lock()
+        self._added_dirs = set()
+        # Files are hashed while they are written, no second read
+        self._manifest_path = manifest_path
+        self._manifest = {}
+        self._finished = False
+
+        threads = threads or multiprocessing.cpu_count()
+        self._output_file = open(self._part_path, 'wb')
+        self._compressor = subprocess.Popen(
+            self.compress_command(compression, threads),
+            stdin=subprocess.PIPE, stdout=self._output_file)
+        self._tar = tarfile.open(fileobj=self._compressor.stdin, mode='w|',
+                                 format=tarfile.GNU_FORMAT)
+
+    @staticmethod
+    def compress_command(compression, threads):
+        if compression == 'zstd':
+            return ['zstd', '-q', '-T%s' % threads]
+        if compression != 'gzip':
+            raise ValueError('Unsupported compression: %s' % compression)
+        if which('pigz'):
+            # Block-parallel gzip, the output is a regular gzip stream
+            return ['pigz', '-p', str(threads)]
+        return ['gzip']
+
+    def add_tree(self, root_path, exclude_func=None):
+        with self._lock:
+            self._add_dir(root_path, '.')
+            for entry in sorted(os.listdir(root_path)):
+                self._add_entry(root_path, entry, exclude_func)
+
+    def add_archive(self, archive_path):
+        # Copies the members of another archive without extracting them,
+        # directories already added by other archives are skipped
+        with self._lock:
+            tar, decompressor = open_archive_stream(archive_path)
+            try:
+                for member in tar:
+                    name = os.path.normpath(member.name)
+                    arcname = '.' if name == '.' else './' + name
+                    if member.isdir():
+                        if arcname in self._added_dirs:
+                            continue
+                        self._added_dirs.add(arcname)
+                    member.name = arcname
+                    self._add_member(member, tar.extractfile(member)
+                                     if member.isreg() else None)
+            finally:
+                close_archive_stream(tar, decompressor)
+
+    def close(self):
+        with self._lock:
+            self._tar.close()
+            self._compressor.stdin.close()
+            returncode = self._compressor.wait()
+            self._output_file.close()
+        if returncode:
+            raise RuntimeError('Artifacts compression failed with exit'
+                               ' code %s' % returncode)
+        os.rename(self._part_path, self._path)
+        self._finished = True
+        if self._manifest_path:
+            with open(self._manifest_path + '.part', 'w') as manifest_file:
+                json.dump({'archive': os.path.basename(self._path),
+                           'files': self._manifest}, manifest_file)
+            os.rename(self._manifest_path + '.part', self._manifest_path)
+
+    def abort(self):
+        # Stops the compressor and removes the partial archive, does nothing
+        # once the archive is complete
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+            if self._compressor.poll() is None:
+                self._compressor.kill()
+            self._compressor.wait()
+            for close in [self._tar.close, self._compressor.stdin.close]:
+                try:
+                    close()
+                except (IOError, OSError):
+                    pass  # nothing reads the pipe anymore
+            self._output_file.close()
+            if os.path.exists(self._part_path):
+                os.remove(self._part_path)
+
+    def _add_entry(self, root_path, relative_path, exclude_func=None):
+        if exclude_func and exclude_func(relative_path):
+            return
+        path = os.path.join(root_path, relative_path)
+        arcname = './' + relative_path
+        if os.path.isdir(path) and not os.path.islink(path):
+            self._add_dir(path, arcname)
+            for entry in sorted(os.listdir(path)):
+                self._add_entry(root_path, os.path.join(relative_path, entry),
+                                exclude_func)
+        else:
+            member = self._tar.gettarinfo(path, arcname)
+            if member.isreg():
+                with open(path, 'rb') as member_file:
+                    self._add_member(member, member_file)
+            else:
+                self._add_member(member)
+
+    def _add_dir(self, path, arcname):
+        if arcname not in self._added_dirs:
+            self._tar.add(path, arcname=arcname, recursive=False)
+            self._added_dirs.add(arcname)
+
+    def _add_member(self, member, member_file=None):
+        name = os.path.normpath(member.name)
+        if member_file is None or not self._manifest_path:
+            self._tar.addfile(member, member_file)
+            if member.islnk() and self._manifest_path:
+                # Hardlinks have the content of the file they point to
+                target = self._manifest.get(os.path.normpath(member.linkname))
+                if target:
+                    self._manifest[name] = target
+            return
+        hashing_file = _HashingFile(member_file)
+        self._tar.addfile(member, hashing_file)
+        self._manifest[name] = {'size': member.size,
+                                'sha256': hashing_file.hexdigest()}
+
+
+class _HashingFile(object):
+    def __init__(self, file_obj):
+        self._file = file_obj
+        self._digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._digest.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+class ArchiveIndexer(object):
+    def __init__(self, path):
+        self._path = path
+
+    def extract(self, dest_path, extract_prefix, folder_pattern):
+        folders = []
+        tar, decompressor = open_archive_stream(self._path)
+
+        # A single streaming pass: list and extract at the same time
+        try:
+            for member in tar:
+                name = member.name + '/' if member.isdir() else member.name
+                if member.isdir() and folder_pattern.match(name):
+                    folders.append(name)
+                if name.startswith(extract_prefix):
+                    self._check_member(member)
+                    tar.extract(member, dest_path)
+        finally:
+            close_archive_stream(tar, decompressor)
+        return folders
+
+    @staticmethod
+    def _check_member(member):
+        names = [member.name]
+        if member.issym() or member.islnk():
+            # Links must not point outside of the destination either
+            names.append(member.linkname)
+        for name in names:
+            if name.startswith('/') or '..' in name.split('/'):
+                raise ValueError('Unsafe archive member: %s' % member.name)
+
+
+def open_archive_stream(path):
+    # Returns a tar opened for a single sequential pass over the members
+    if path.endswith('.zst'):
+        decompressor = subprocess.Popen(['zstd', '-q', '-dc', path],
+                                        stdout=subprocess.PIPE)
+        return tarfile.open(fileobj=decompressor.stdout, mode='r|'), \
+            decompressor
+    return tarfile.open(path, mode='r|gz'), None
+
+
+def read_archive_files(path, names, max_size):
+    # A single streaming pass, files bigger than max_size are skipped
+    names = set(names)
+    contents = {}
+    tar, decompressor = open_archive_stream(path)
+    try:
+        for member in tar:
+            name = os.path.normpath(member.name)
+            if name in names and member.isreg() and member.size <= max_size:
+                contents[name] = tar.extractfile(member).read()
+                if len(contents) == len(names):
+                    break
+    finally:
+        close_archive_stream(tar, decompressor)
+    return contents
+
+
+def close_archive_stream(tar, decompressor):
+    tar.close()
+    if decompressor:
+        decompressor.stdout.close()
+        decompressor.wait()
@@ -0,0 +1,88 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+try:
+    from common import ConfigUtils
+except ImportError:
+    from artmanflow.steps.common import ConfigUtils
+
+
+class ArtifactManifest(object):
+    # Path, size and sha256 of every file of an execution archive, written
+    # by StreamingArchive while the archive is created
+    OTHER_FILES = '(other files)'
+
+    def __init__(self, files, apis=None):
+        self._files = files
+        # API outputs are 'java/<package>' directories (or top level files)
+        self._outputs = {}
+        for api in apis or []:
+            for output in api.get('outputs') or []:
+                self._outputs[output] = api['name']
+
+    @staticmethod
+    def find(step_props):
+        manifest_path = step_props.host_guest_output_dir_subpath(
+            ConfigUtils.artifact_manifest_name())
+        if not os.path.isfile(manifest_path):
+            return None
+        with open(manifest_path) as manifest_file:
+            files = json.load(manifest_file)['files']
+        summary_path = step_props.host_guest_output_dir_subpath(
+            ConfigUtils.artifact_yaml_name())
+        apis = None
+        if os.path.isfile(summary_path):
+            apis = ConfigUtils.read_config(summary_path).get('apis')
+        return ArtifactManifest(files, apis)
+
+    def files(self):
+        return self._files
+
+    def api_name(self, path):
+        parts = path.split('/')
+        return self._outputs.get('/'.join(parts[:2])) or \
+            self._outputs.get(parts[0])
+
+    def diff(self, new_manifest):
+        # A single pass over both file lists, nothing is extracted
+        apis = {}
+
+        def api_diff(path):
+            name = new_manifest.api_name(path) or self.api_name(path) or \
+                self.OTHER_FILES
+            if name not in apis:
+                apis[name] = {'name': name, 'added': [], 'removed': [],
+                              'changed': [], 'unchanged': 0}
+            return apis[name]
+
+        for path, entry in new_manifest.files().items():
+            old_entry = self._files.get(path)
+            if not old_entry:
+                api_diff(path)['added'].append(path)
+            elif old_entry['sha256'] != entry['sha256']:
+                api_diff(path)['changed'].append(path)
+            else:
+                api_diff(path)['unchanged'] += 1
+        for path in self._files:
+            if path not in new_manifest.files():
+                api_diff(path)['removed'].append(path)
+
+        for api in apis.values():
+            for kind in ['added', 'removed', 'changed']:
+                api[kind].sort()
+        return sorted(apis.values(), key=lambda api: (
+            api['name'] == self.OTHER_FILES, api['name']))
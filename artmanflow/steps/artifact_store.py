@@ -0,0 +1,269 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+try:
+    from artifact_archive import open_archive_stream, close_archive_stream
+except ImportError:
+    from artmanflow.steps.artifact_archive import \
+        open_archive_stream, close_archive_stream
+
+
+class ArtifactStore(object):
+    # Generated files are stored once, keyed by their content hash, and each
+    # execution keeps only a manifest of its archive members
+    _MEMORY_BLOB_SIZE = 8 * 1024 * 1024
+    _COPY_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, path):
+        self._path = path
+        self._blobs_path = os.path.join(path, 'blobs')
+        self._manifests_path = os.path.join(path, 'manifests')
+        self._temp_path = os.path.join(path, 'tmp')
+        for dir_path in [self._blobs_path, self._manifests_path,
+                         self._temp_path]:
+            if not os.path.isdir(dir_path):
+                os.makedirs(dir_path)
+
+    def ingest(self, execution_id, archive_path, execution_path=None):
+        entries = []
+        stats = {'files': 0, 'new_blobs': 0, 'new_bytes': 0,
+                 'total_bytes': 0}
+        tar, decompressor = open_archive_stream(archive_path)
+        try:
+            for member in tar:
+                entry = {
+                    'name': member.name,
+                    'mode': member.mode,
+                    'mtime': member.mtime
+                }
+                if member.isdir():
+                    entry['type'] = 'dir'
+                elif member.issym():
+                    entry['type'] = 'symlink'
+                    entry['linkname'] = member.linkname
+                elif member.isreg():
+                    entry['type'] = 'file'
+                    entry['size'] = member.size
+                    entry['blob'], added = self._store_blob(
+                        tar.extractfile(member), member.size,
+                        member.mode & 0o111)
+                    stats['files'] += 1
+                    stats['total_bytes'] += member.size
+                    if added:
+                        stats['new_blobs'] += 1
+                        stats['new_bytes'] += member.size
+                else:
+                    continue
+                entries.append(entry)
+        finally:
+            close_archive_stream(tar, decompressor)
+
+        manifest = {
+            'execution_id': execution_id,
+            'execution_path': execution_path,
+            'artifact_name': os.path.basename(archive_path),
+            'created_at': time.time(),
+            'entries': entries
+        }
+        manifest_path = self._manifest_path(execution_id)
+        with open(manifest_path + '.part', 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.rename(manifest_path + '.part', manifest_path)
+        return stats
+
+    def has_manifest(self, execution_id):
+        return os.path.isfile(self._manifest_path(execution_id))
+
+    def manifest(self, execution_id):
+        with open(self._manifest_path(execution_id)) as manifest_file:
+            return json.load(manifest_file)
+
+    def read_files(self, execution_id, names, max_size):
+        names = set(names)
+        contents = {}
+        for entry in self.manifest(execution_id)['entries']:
+            name = os.path.normpath(entry['name'])
+            if name in names and entry.get('blob') and \
+                    entry['size'] <= max_size:
+                with open(self._blob_path(entry['blob']), 'rb') as blob_file:
+                    contents[name] = blob_file.read()
+        return contents
+
+    def stream_archive(self, execution_id):
+        # Rebuilds the execution archive (always gzip) without a temp file
+        manifest = self.manifest(execution_id)
+        buffer = _ChunkBuffer()
+        tar = tarfile.open(fileobj=buffer, mode='w|gz',
+                           format=tarfile.GNU_FORMAT)
+        for entry in manifest['entries']:
+            info = tarfile.TarInfo(entry['name'])
+            info.mode = entry['mode']
+            info.mtime = entry['mtime']
+            if entry['type'] == 'dir':
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif entry['type'] == 'symlink':
+                info.type = tarfile.SYMTYPE
+                info.linkname = entry['linkname']
+                tar.addfile(info)
+            else:
+                info.size = entry['size']
+                with open(self._blob_path(entry['blob']), 'rb') as blob_file:
+                    tar.addfile(info, blob_file)
+            chunk = buffer.take()
+            if chunk:
+                yield chunk
+        tar.close()
+        yield buffer.take()
+
+    def materialize(self, execution_id, dest_path):
+        # A tree of hardlinks to the (read-only) blobs, copies if the store
+        # is on another device
+        link = True
+        for entry in self.manifest(execution_id)['entries']:
+            path = os.path.normpath(os.path.join(dest_path, entry['name']))
+            if entry['type'] == 'dir':
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                continue
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if entry['type'] == 'symlink':
+                os.symlink(entry['linkname'], path)
+                continue
+            blob_path = self._blob_path(entry['blob'])
+            if link:
+                try:
+                    os.link(blob_path, path)
+                    continue
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM):
+                        raise
+                    link = False
+            shutil.copy2(blob_path, path)
+
+    def gc(self, grace_seconds=3600):
+        # Manifests of deleted executions go first, then the blobs nothing
+        # references anymore. Recent blobs are kept, they may belong to an
+        # archive being ingested right now.
+        stats = {'manifests': 0, 'blobs': 0, 'bytes': 0}
+        referenced = set()
+        for manifest_name in os.listdir(self._manifests_path):
+            if not manifest_name.endswith('.json'):
+                continue
+            manifest_path = os.path.join(self._manifests_path, manifest_name)
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            execution_path = manifest.get('execution_path')
+            if execution_path and not os.path.isdir(execution_path):
+                os.remove(manifest_path)
+                stats['manifests'] += 1
+                continue
+            referenced.update(entry['blob'] for entry in manifest['entries']
+                              if entry.get('blob'))
+
+        expired_at = time.time() - grace_seconds
+        for prefix in os.listdir(self._blobs_path):
+            prefix_path = os.path.join(self._blobs_path, prefix)
+            for blob_name in os.listdir(prefix_path):
+                blob_path = os.path.join(prefix_path, blob_name)
+                stat = os.stat(blob_path)
+                if '%s/%s' % (prefix, blob_name) in referenced or \
+                        stat.st_mtime > expired_at:
+                    continue
+                os.remove(blob_path)
+                stats['blobs'] += 1
+                stats['bytes'] += stat.st_size
+        return stats
+
+    def _store_blob(self, member_file, size, executable):
+        digest = hashlib.sha256()
+        temp_file = None
+        if size <= self._MEMORY_BLOB_SIZE:
+            data = member_file.read()
+            digest.update(data)
+        else:
+            temp_file = tempfile.NamedTemporaryFile(dir=self._temp_path,
+                                                    delete=False)
+            while True:
+                chunk = member_file.read(self._COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                temp_file.write(chunk)
+            temp_file.close()
+
+        sha = digest.hexdigest()
+        # The executable bit is part of the key, hardlinks share the mode
+        blob = '%s/%s%s' % (sha[:2], sha, '.x' if executable else '')
+        blob_path = self._blob_path(blob)
+        if os.path.isfile(blob_path):
+            if temp_file:
+                os.remove(temp_file.name)
+            # Referenced again, not a garbage collection candidate anymore
+            os.utime(blob_path, None)
+            return blob, False
+
+        if not os.path.isdir(os.path.dirname(blob_path)):
+            try:
+                os.makedirs(os.path.dirname(blob_path))
+            except OSError:
+                pass  # created by a concurrent ingest
+        if not temp_file:
+            temp_file = tempfile.NamedTemporaryFile(dir=self._temp_path,
+                                                    delete=False)
+            temp_file.write(data)
+            temp_file.close()
+        os.chmod(temp_file.name, 0o555 if executable else 0o444)
+        os.rename(temp_file.name, blob_path)
+        return blob, True
+
+    def _blob_path(self, blob):
+        return os.path.join(self._blobs_path, blob)
+
+    def _manifest_path(self, execution_id):
+        return os.path.join(self._manifests_path, execution_id + '.json')
+
+
+class _ChunkBuffer(object):
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(data)
+        return len(data)
+
+    def take(self):
+        chunk = b''.join(self._chunks)
+        self._chunks = []
+        return chunk
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[2] != 'gc':
+        print('Usage: %s <artifact store path> gc [grace seconds]' %
+              sys.argv[0])
+        sys.exit(2)
+    grace = int(sys.argv[3]) if len(sys.argv) > 3 else 3600
+    print(ArtifactStore(sys.argv[1]).gc(grace))
@@ -0,0 +1,136 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import os
+import sqlite3
+import tempfile
+import threading
+
+
+class ExecutionCatalog(object):
+    _COLUMNS = ['step_type', 'config_hash', 'status', 'submitted_at',
+                'start_time', 'end_time', 'duration_seconds', 'exit_code',
+                'container_id', 'artifact_size']
+
+    _SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS executions (
+            execution_id TEXT PRIMARY KEY,
+            step_type TEXT,
+            config_hash TEXT,
+            status TEXT,
+            submitted_at REAL,
+            start_time REAL,
+            end_time REAL,
+            duration_seconds REAL,
+            exit_code INTEGER,
+            container_id TEXT,
+            artifact_size INTEGER)''',
+        '''CREATE TABLE IF NOT EXISTS execution_commits (
+            execution_id TEXT,
+            repo TEXT,
+            git_commit TEXT,
+            PRIMARY KEY (execution_id, repo))''',
+        '''CREATE INDEX IF NOT EXISTS executions_submitted_at
+            ON executions (submitted_at)''',
+        '''CREATE INDEX IF NOT EXISTS executions_status
+            ON executions (status, submitted_at)''',
+        '''CREATE INDEX IF NOT EXISTS executions_config_hash
+            ON executions (config_hash, submitted_at)''',
+        '''CREATE INDEX IF NOT EXISTS execution_commits_commit
+            ON execution_commits (git_commit)'''
+    ]
+
+    _initialized_paths = set()
+    _initialized_lock = threading.Lock()
+
+    def __init__(self, path=None):
+        # The database is created by the first operation
+        self._path = path or os.path.join(tempfile.gettempdir(),
+                                          'artmanflow-catalog.sqlite')
+
+    def update(self, execution_id, fields, commits=None):
+        columns = [c for c in self._COLUMNS if c in fields]
+        values = [fields[c] for c in columns]
+        updates = ', '.join('%s = excluded.%s' % (c, c) for c in columns)
+        statement = 'INSERT INTO executions (%s) VALUES (%s)' % (
+            ', '.join(['execution_id'] + columns),
+            ', '.join(['?'] * (len(columns) + 1)))
+        if updates:
+            statement += ' ON CONFLICT (execution_id) DO UPDATE SET ' + updates
+        else:
+            statement += ' ON CONFLICT (execution_id) DO NOTHING'
+
+        with self._connect() as connection:
+            connection.execute(statement, [execution_id] + values)
+            if commits:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO execution_commits'
+                    ' (execution_id, repo, git_commit) VALUES (?, ?, ?)',
+                    [(execution_id, repo, commit)
+                     for repo, commit in sorted(commits.items()) if commit])
+
+    def get(self, execution_id):
+        executions = self._select('WHERE e.execution_id = ?', [execution_id],
+                                  1, 0)
+        return executions[0] if executions else None
+
+    def list(self, step_type=None, status=None, config_hash=None,
+        git_commit=None, limit=50, offset=0):
+        conditions = []
+        params = []
+        for column, value in [('e.step_type', step_type),
+                              ('e.status', status),
+                              ('e.config_hash', config_hash)]:
+            if value:
+                conditions.append('%s = ?' % column)
+                params.append(value)
+        if git_commit:
+            conditions.append(
+                'e.execution_id IN (SELECT execution_id FROM'
+                ' execution_commits WHERE git_commit = ?)')
+            params.append(git_commit)
+        where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return self._select(where, params, limit, offset)
+
+    def _select(self, where, params, limit, offset):
+        query = 'SELECT e.execution_id, %s FROM executions e %s' \
+                ' ORDER BY e.submitted_at DESC LIMIT ? OFFSET ?' % (
+                    ', '.join('e.' + c for c in self._COLUMNS), where)
+        with self._connect() as connection:
+            connection.row_factory = sqlite3.Row
+            executions = [dict(row) for row in connection.execute(
+                query, params + [limit, offset])]
+            for execution in executions:
+                execution['commits'] = dict(connection.execute(
+                    'SELECT repo, git_commit FROM execution_commits'
+                    ' WHERE execution_id = ?',
+                    [execution['execution_id']]).fetchall())
+        return executions
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # A connection per operation, the catalog is used by many threads
+        connection = sqlite3.connect(self._path, timeout=30)
+        with ExecutionCatalog._initialized_lock:
+            if self._path not in ExecutionCatalog._initialized_paths:
+                with connection:
+                    for statement in self._SCHEMA:
+                        connection.execute(statement)
+                ExecutionCatalog._initialized_paths.add(self._path)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
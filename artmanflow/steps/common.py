@@ -12,16 +12,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import fcntl
+import hashlib
+import json
 import re
+import shutil
 import tempfile
 import uuid
 import os
 import subprocess
 import sys
+import threading
+import time
+import traceback
 from ruamel import yaml
 
+# Host-only modules (catalog, container pool, supervisor, metrics, artifact
+# store) are imported by BaseHost, the guest scripts do not need them
+try:
+    from guest_snapshot import GuestFilesSnapshot
+except ImportError:
+    from artmanflow.steps.guest_snapshot import GuestFilesSnapshot
+
 
 class ConfigUtils(object):
+    _ARTIFACT_NAMES = {
+        'gzip': 'artifacts.tar.gz',
+        'zstd': 'artifacts.tar.zst'
+    }
+
     def __init__(self):
         pass
 
@@ -54,18 +74,52 @@ class ConfigUtils(object):
             yaml.round_trip_dump(config, output)
             output.flush()
 
+    @staticmethod
+    def config_hash(config):
+        # The execution id is also a part of derived values, like the staging
+        # branch name or the uploaded artifacts path
+        execution_id = config.get('execution_id') or ''
+        dump = json.dumps(config, sort_keys=True, default=str)
+        if execution_id:
+            dump = dump.replace(execution_id, '')
+        return hashlib.sha256(dump.encode('UTF-8')).hexdigest()
+
     @staticmethod
     def generate_id(prefix):
         return "%s%s" % (prefix, str(uuid.uuid4())[24:])
 
     @staticmethod
-    def artifact_name():
-        return 'artifacts.tar.gz'
+    def artifact_name(compression='gzip'):
+        return ConfigUtils._ARTIFACT_NAMES[compression]
+
+    @staticmethod
+    def artifact_compressions():
+        return ['gzip', 'zstd']
+
+    @staticmethod
+    def artifact_names():
+        return [ConfigUtils._ARTIFACT_NAMES[c] for c in
+                ConfigUtils.artifact_compressions()]
+
+    @staticmethod
+    def find_artifact(step_props):
+        for artifact_name in ConfigUtils.artifact_names():
+            if ConfigUtils.check_artifact_exist(step_props, artifact_name):
+                return artifact_name
+        return None
 
     @staticmethod
     def artifact_yaml_name():
         return 'artifacts.yaml'
 
+    @staticmethod
+    def timings_name():
+        return 'timings.json'
+
+    @staticmethod
+    def artifact_manifest_name():
+        return 'artifacts_manifest.json'
+
     @staticmethod
     def check_artifact_exist(step_props, artifact_name):
         artifacts_fl = step_props.host_guest_output_dir_subpath(artifact_name)
@@ -73,6 +127,8 @@ class ConfigUtils(object):
 
 
 class GitUtils(object):
+    _COMMIT_SHA_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+
     def __init__(self):
         pass
 
@@ -82,17 +138,41 @@ class GitUtils(object):
         if not actual_branch:
             actual_branch = config['git_branch']
 
+        repo_owner, repo_name = GitUtils.repo_properties(config['git_repo'])
+        command = ['git', 'clone', GitUtils.repo_url(config), '--branch',
+                   actual_branch, '--single-branch']
+        if config.get('git_reference'):
+            command += ['--reference', config['git_reference'],
+                        '--dissociate']
+
+        return command + [repo_name]
+
+    @staticmethod
+    def repo_url(config):
         repo = config['git_repo']
-        repo_owner, repo_name = GitUtils.repo_properties(repo)
         if 'git_user_name' in config and 'git_security_token' in config:
             repo_tokens = re.compile(r'(://+)').split(repo)
             creds = "%s:%s@" % (
                 config['git_user_name'], config['git_security_token'])
             repo_tokens.insert(2, creds)
             repo = ''.join(repo_tokens)
+        return repo
 
-        return ['git', 'clone', repo, '--branch', actual_branch,
-                '--single-branch', repo_name]
+    @staticmethod
+    def resolve_commit(config):
+        commit = config['git_commit']
+        if GitUtils._COMMIT_SHA_PATTERN.match(commit):
+            return commit
+        if commit != 'HEAD':
+            return None
+        try:
+            output = subprocess.check_output(
+                ['git', 'ls-remote', GitUtils.repo_url(config),
+                 'refs/heads/%s' % config['git_branch']])
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        refs = output.decode('UTF-8').split()
+        return refs[0] if refs else None
 
     @staticmethod
     def repo_properties(repo_url):
@@ -106,6 +186,55 @@ class GitUtils(object):
         return repo_owner, repo_name
 
 
+class DockerUtils(object):
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def image_digest(image):
+        try:
+            output = subprocess.check_output(
+                ['docker', 'image', 'inspect', '--format', '{{.Id}}', image])
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return output.decode('UTF-8').strip() or None
+
+
+class FileLock(object):
+    def __init__(self, path, shared=False):
+        self._path = path
+        self._shared = shared
+        self._file = None
+
+    def acquire(self, blocking=True):
+        operation = fcntl.LOCK_SH if self._shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        self._file = open(self._path, 'a')
+        try:
+            fcntl.flock(self._file.fileno(), operation)
+        except IOError:
+            # Held by another process
+            self._file.close()
+            self._file = None
+            if blocking:
+                raise
+            return False
+        return True
+
+    def release(self):
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
 class HostStepProperties(object):
     _EXECUTION_ID_PATTERN = re.compile(r'^[\w\-.]+$')
 
@@ -188,10 +317,43 @@ class GuestStepProperties(object):
 
 
 class BaseHost(object):
+    # Guests changing the container itself (installed packages, files
+    # outside of the guest root) cannot run in pooled containers
+    GUEST_MUTATES_CONTAINER = False
+
     def __init__(self, host_step_properties, config):
         self._config = config
         self._host = host_step_properties
-        self._guest = GuestStepProperties(config['guest_root_path'])
+        self._docker_image = config['docker_image']
+        self._process = None
+        self._pooled_container_name = None
+        self._pooled_release_thread = None
+        from artmanflow.steps.catalog import ExecutionCatalog
+        from artmanflow.steps.supervisor import ExecutionSupervisor
+        # The catalog database is only opened once something is recorded
+        self._catalog = ExecutionCatalog(config.get('execution_catalog_path'))
+        self._supervisor = ExecutionSupervisor(
+            self._host.execution_id(), self._host.temp_path(),
+            int(config.get('execution_timeout_seconds') or 0), self._catalog,
+            {'step_type': self._host.step_name(),
+             'config_hash': ConfigUtils.config_hash(config)})
+
+        pool_config = config.get('container_pool') or {}
+        self._pool_config = pool_config if pool_config.get('enabled') else None
+        guest_root_path = config['guest_root_path']
+        if self._pool_config:
+            from artmanflow.steps.container_pool import ContainerPool
+            # Pooled containers have their own slot directory mounted at the
+            # guest root, the execution works in a subdirectory of it
+            guest_root_path = ContainerPool.execution_root_path(
+                guest_root_path, self._host.temp_path())
+        self._guest = GuestStepProperties(guest_root_path)
+
+    def execution_id(self):
+        return self._host.execution_id()
+
+    def step_name(self):
+        return self._host.step_name()
 
     def pre_execute(self):
         try:
@@ -200,10 +362,13 @@ class BaseHost(object):
             pass  # assume dir already exists
         with open(self._host.stdout_file_path(), 'a'):
             pass
+        self._supervisor.register()
 
     def run_guest_script(self, guest_config, extra_mount_volumes=None):
-        host_guest_config_file_path = self._host.host_guest_config_file_path()
-        ConfigUtils.dump_config(guest_config, host_guest_config_file_path)
+        if self._supervisor.is_cancelled():
+            self._log('The execution was cancelled')
+            self._supervisor.finish_cancelled()
+            return None
 
         host_guest_output_dir = self._host.host_guest_output_dir_path()
         os.makedirs(host_guest_output_dir)
@@ -217,31 +382,289 @@ class BaseHost(object):
         if extra_mount_volumes:
             mount_volumes.extend(extra_mount_volumes)
 
-        script_path = self._guest.guest_script_path(
-            self._host.guest_script_name())
-        self._run_command(['python3', script_path],
-                          host_guest_config_file_path,
-                          self._host.stdout_file_path(),
-                          self._guest.guest_root_path(),
-                          mount_volumes)
+        guest_config['guest_root_path'] = self._guest.guest_root_path()
+        # Host files (caches, mirrors, baselines), left out of snapshots
+        guest_config['mounted_paths'] = [mount[1] for mount in mount_volumes]
+        host_guest_config_file_path = self._host.host_guest_config_file_path()
+        ConfigUtils.dump_config(guest_config, host_guest_config_file_path)
+
+        pool = self._container_pool(extra_mount_volumes)
+        if pool:
+            self._process = self._run_pooled_command(
+                pool, host_guest_config_file_path, extra_mount_volumes)
+
+        if not self._process:
+            script_path = self._guest.guest_script_path(
+                self._host.guest_script_name())
+            self._process = self._run_command(['python3', script_path],
+                                              host_guest_config_file_path,
+                                              self._host.stdout_file_path(),
+                                              self._guest.guest_root_path(),
+                                              mount_volumes)
+        self._supervisor.started(self._process, self._container_id)
+        return self._process
+
+    def run_host_script(self, script_name, config):
+        # Runs a step script directly on the host instead of in docker, its
+        # guest root is the execution temp directory
+        if self._supervisor.is_cancelled():
+            self._log('The execution was cancelled')
+            self._supervisor.finish_cancelled()
+            return None
+
+        config['guest_root_path'] = self._host.temp_path()
+        config_file_path = self._host.host_guest_config_file_path()
+        ConfigUtils.dump_config(config, config_file_path)
+        os.makedirs(self._host.host_guest_output_dir_path())
+
+        command = [sys.executable,
+                   os.path.join(self._host.step_dir_path(), script_name),
+                   config_file_path]
+        with open(self._host.stdout_file_path(), 'a+') as output_file:
+            output_file.write(
+                "\033[1;30msubprocess.Popen(%s)\n\033[0m\n" % command)
+            output_file.flush()
+            self._process = subprocess.Popen(command, stdout=output_file,
+                                             stderr=output_file)
+        self._supervisor.started(self._process, lambda: None)
+        return self._process
+
+    def wait_container_created(self):
+        # docker writes the container id file once the container is created
+        while self._process and self._process.poll() is None and \
+                not self._container_id():
+            time.sleep(0.1)
+
+    def wait(self):
+        # Blocks until the guest script started by execute() exits, enforces
+        # the execution timeout and records the exit status
+        if not self._process:
+            return None
+        exit_code = self._supervisor.wait()
+        if self._pooled_release_thread:
+            # guest_output is moved back from the container slot
+            self._pooled_release_thread.join()
+        from artmanflow.steps.metrics import ARTIFACT_BYTES
+        artifact_size = self._artifact_size()
+        ARTIFACT_BYTES.inc(artifact_size, step=self.step_name())
+        self._observe_guest_phases()
+        self._catalog.update(self.execution_id(),
+                             {'artifact_size': artifact_size},
+                             self._artifact_commits())
+        self._store_artifacts()
+        return exit_code
+
+    def fail(self, error):
+        self._log('The execution failed: %s\n%s' % (error,
+                                                    traceback.format_exc()))
+        self._supervisor.finish_failed(error)
+
+    def _store_artifacts(self):
+        from artmanflow.steps.artifact_store import ArtifactStore
+        store_config = self._config.get('artifact_store') or {}
+        artifact_name = ConfigUtils.find_artifact(self._host)
+        if not store_config.get('path') or not artifact_name:
+            return
+        artifact_path = self._host.host_guest_output_dir_subpath(artifact_name)
+        stats = ArtifactStore(store_config['path']).ingest(
+            self.execution_id(), artifact_path, self._host.temp_path())
+        self._log('Stored %s artifact files (%s bytes) in %s, %s new files'
+                  ' (%s bytes)' % (stats['files'], stats['total_bytes'],
+                                   store_config['path'], stats['new_blobs'],
+                                   stats['new_bytes']))
+        if not store_config.get('keep_archives'):
+            os.remove(artifact_path)
+        self._collect_store_garbage(store_config)
+
+    def _collect_store_garbage(self, store_config):
+        from artmanflow.steps.artifact_store import ArtifactStore
+        # At most once per interval for all the executions using the store
+        interval = int(store_config.get('gc_interval_seconds', 3600))
+        stamp_path = os.path.join(store_config['path'], 'gc.stamp')
+        with FileLock(stamp_path + '.lock'):
+            if os.path.isfile(stamp_path) and \
+                    time.time() - os.path.getmtime(stamp_path) < interval:
+                return
+            open(stamp_path, 'w').close()
+        stats = ArtifactStore(store_config['path']).gc(
+            int(store_config.get('gc_grace_seconds', 3600)))
+        self._log('Removed %s manifests and %s unreferenced files (%s bytes)'
+                  ' from %s' % (stats['manifests'], stats['blobs'],
+                                stats['bytes'], store_config['path']))
+
+    def _observe_guest_phases(self):
+        from artmanflow.steps.metrics import PHASE_DURATION
+        timings_path = self._host.host_guest_output_dir_subpath(
+            ConfigUtils.timings_name())
+        if not os.path.isfile(timings_path):
+            return
+        with open(timings_path) as timings_file:
+            timings = json.load(timings_file)
+        # Only the named top level phases, commands would explode the labels
+        for phase in timings.get('children', []):
+            if phase.get('kind') == 'phase' and 'duration' in phase:
+                PHASE_DURATION.observe(phase['duration'],
+                                       step=self.step_name(),
+                                       phase=phase['name'])
+
+    def _artifact_size(self):
+        artifact_names = ConfigUtils.artifact_names() + [
+            ConfigUtils.artifact_yaml_name()]
+        # Batch executions have an artifact per matrix cell
+        summary = self._artifact_summary() or {}
+        artifact_names.extend(cell['artifact'] for cell in
+                              summary.get('cells') or [])
+        size = 0
+        for artifact_name in artifact_names:
+            path = self._host.host_guest_output_dir_subpath(artifact_name)
+            if os.path.isfile(path):
+                size += os.path.getsize(path)
+        return size
+
+    def _artifact_commits(self):
+        commits = (self._artifact_summary() or {}).get('commits')
+        return commits if isinstance(commits, dict) else None
+
+    def _artifact_summary(self):
+        path = self._host.host_guest_output_dir_subpath(
+            ConfigUtils.artifact_yaml_name())
+        if not os.path.isfile(path):
+            return None
+        return ConfigUtils.read_config(path)
+
+    def _container_id(self):
+        if self._pooled_container_name:
+            return self._pooled_container_name
+        cid_file_path = self._host.temp_subpath('container.cid')
+        if not os.path.isfile(cid_file_path):
+            return None
+        with open(cid_file_path) as cid_file:
+            return cid_file.read().strip() or None
 
     def _run_command(self, command, input_file_name, output_file_name,
         guest_root_path=None, mount_dirs=None):
 
+        # docker writes the container id there, the file must not exist
+        cid_file_path = self._host.temp_subpath('container.cid')
+        if os.path.isfile(cid_file_path):
+            os.remove(cid_file_path)
         cmd = self._construct_docker_run_command(command, guest_root_path,
-                                                 mount_dirs)
+                                                 mount_dirs, cid_file_path)
         with open(input_file_name, 'r') as input_file, \
             open(output_file_name, 'a+') as output_file:
             output_file.write(
                 "\033[1;30msubprocess.Popen(%s, stdout='%s', stderr='%s', stdin='%s'\n\033[0m\n" % (
                     cmd, output_file_name, output_file_name, input_file_name))
             output_file.flush()
-            subprocess.Popen(cmd, stdout=output_file, stderr=output_file,
-                             stdin=input_file)
+            return subprocess.Popen(cmd, stdout=output_file,
+                                    stderr=output_file, stdin=input_file)
+
+    def _container_pool(self, extra_mount_volumes):
+        if not self._pool_config:
+            return None
+        if self.GUEST_MUTATES_CONTAINER:
+            self._log('Container pool is not used: the %s guest changes the'
+                      ' container' % self.step_name())
+            return None
+
+        # Pooled containers can see only the files of the execution directory
+        for mount in extra_mount_volumes or []:
+            host_path = os.path.join(
+                self._host.temp_path(),
+                os.path.relpath(mount[1], self._guest.guest_root_path()))
+            if mount[1].startswith(self._guest.guest_root_path() + '/') \
+                    and os.path.abspath(mount[0]) == host_path:
+                continue
+            self._log('Container pool is not used: %s is not in the'
+                      ' execution directory' % mount[0])
+            return None
+
+        from artmanflow.steps.container_pool import ContainerPool
+        return ContainerPool.for_image(
+            self._docker_image, os.path.join(
+                os.path.dirname(self._host.temp_path()), 'artmanflow-pool'),
+            self._config['guest_root_path'], self._host.step_dir_path(),
+            self._pool_config)
+
+    def _run_pooled_command(self, pool, input_file_name, extra_mount_volumes):
+        container = pool.acquire()
+        if not container:
+            self._log('No pooled container is available, starting a new one')
+            return None
+
+        self._pooled_container_name = container.name
+        # The container sees only its slot: the mounted inputs are moved in
+        # and guest_output is created there, linked from the execution dir
+        # until the guest exits. The config is passed on stdin.
+        work_path = os.path.join(pool.slot_path(container),
+                                 os.path.basename(self._host.temp_path()))
+        os.makedirs(work_path)
+        moved_paths = []
+        for mount in extra_mount_volumes or []:
+            slot_path = os.path.join(work_path, os.path.relpath(
+                mount[1], self._guest.guest_root_path()))
+            if not os.path.isdir(os.path.dirname(slot_path)):
+                os.makedirs(os.path.dirname(slot_path))
+            os.rename(mount[0], slot_path)
+            moved_paths.append((mount[0], slot_path))
+        host_output_path = self._host.host_guest_output_dir_path()
+        slot_output_path = os.path.join(work_path,
+                                        os.path.basename(host_output_path))
+        os.rmdir(host_output_path)
+        os.makedirs(slot_output_path)
+        os.symlink(slot_output_path, host_output_path)
+        moved_paths.append((host_output_path, slot_output_path))
+
+        output_file_name = self._host.stdout_file_path()
+        cmd = pool.exec_command(
+            container,
+            ['python3', pool.guest_script_path(self._host.guest_script_name())],
+            self._guest.guest_root_path(),
+            [('HOST_USER_ID', os.getuid()), ('HOST_GROUP_ID', os.getgid())])
+        with open(input_file_name, 'r') as input_file, \
+            open(output_file_name, 'a+') as output_file:
+            output_file.write(
+                "\033[1;30msubprocess.Popen(%s, stdout='%s', stderr='%s', stdin='%s'\n\033[0m\n" % (
+                    cmd, output_file_name, output_file_name, input_file_name))
+            output_file.flush()
+            try:
+                process = subprocess.Popen(cmd, stdout=output_file,
+                                           stderr=output_file,
+                                           stdin=input_file)
+            except OSError:
+                self._release_pooled_container(pool, container, None,
+                                               moved_paths)
+                raise
+
+        self._pooled_release_thread = threading.Thread(
+            target=self._release_pooled_container,
+            args=(pool, container, process, moved_paths))
+        self._pooled_release_thread.start()
+        return process
+
+    def _release_pooled_container(self, pool, container, process,
+        moved_paths):
+        if process:
+            process.wait()
+        try:
+            for host_path, slot_path in moved_paths:
+                if os.path.islink(host_path):
+                    os.remove(host_path)
+                os.rename(slot_path, host_path)
+        finally:
+            # Remove guest working files, the next execution gets an empty slot
+            pool.clean_execution_root(container, self._guest.guest_root_path())
+            pool.release(container)
+
+    def _log(self, message):
+        with open(self._host.stdout_file_path(), 'a') as output_file:
+            output_file.write('\033[1;30m%s\n\033[0m' % message)
 
     def _construct_docker_run_command(self, command, guest_root_path=None,
-        mount_dirs=None):
+        mount_dirs=None, cid_file_path=None):
         cmd = ['docker', 'run', '--rm']  # run and remove container after exit
+        if cid_file_path:
+            cmd += ['--cidfile', cid_file_path]
         if guest_root_path:
             cmd += ['-w', guest_root_path]  # set working dir
         if mount_dirs:
@@ -250,7 +673,7 @@ class BaseHost(object):
         cmd += [
             '-e', 'HOST_USER_ID=%s' % os.getuid(),  # to chown inside  docker
             '-e', 'HOST_GROUP_ID=%s' % os.getgid(),
-            '-i', self._config['docker_image']  # specify image
+            '-i', self._docker_image  # specify image
         ]
         cmd += command
 
@@ -271,10 +694,96 @@ class BaseHost(object):
         return [local_mount_path, guest_mount_path]
 
 
+class PhaseTimer(object):
+    def __init__(self, name):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._root = self._node(name, 'phase')
+        self._main_stack = [self._root]
+        self._local.stack = self._main_stack
+
+    @contextlib.contextmanager
+    def phase(self, name, kind='phase'):
+        stack = self._stack()
+        node = self._node(name, kind)
+        with self._lock:
+            stack[-1]['children'].append(node)
+        stack.append(node)
+        try:
+            yield node
+        except BaseException:
+            node['failed'] = True
+            raise
+        finally:
+            stack.pop()
+            self._finish(node)
+
+    def write(self, path):
+        self._finish(self._root)
+        with self._lock:
+            with open(path, 'w') as timings_file:
+                json.dump(self._root, timings_file, indent=1)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            # Worker threads start under the phase the main thread is in
+            stack = [self._main_stack[-1]]
+            self._local.stack = stack
+        return stack
+
+    @staticmethod
+    def _node(name, kind):
+        return {'name': name, 'kind': kind, 'start': time.time(),
+                'children': []}
+
+    @staticmethod
+    def _finish(node):
+        node['end'] = time.time()
+        node['duration'] = round(node['end'] - node['start'], 3)
+
+
+class BaseHostScript(object):
+    # Scripts started by BaseHost.run_host_script, their guest root is the
+    # execution temp directory and their files already belong to the host user
+    def __init__(self, config):
+        self._config = config
+        self._guest = GuestStepProperties(config['guest_root_path'])
+        self._timer = PhaseTimer(type(self).__name__)
+
+    def phase(self, name):
+        return self._timer.phase(name)
+
+    def before_execute(self):
+        self.puts(">>>>>>>>>> START HOST SCRIPT EXECUTION: %s\n" % ' '.join(
+            sys.argv))
+
+    def after_execute(self):
+        self._timer.write(self._guest.guest_output_dir_subpath(
+            ConfigUtils.timings_name()))
+        self.puts("<<<<<<<<< END HOST SCRIPT EXECUTION")
+
+    def puts(self, message='', start_color="\033[1;30m", end_color='\033[0m'):
+        sys.stdout.flush()
+        print("%s%s%s" % (start_color, message, end_color))
+        sys.stdout.flush()
+
+
 class BaseGuest(object):
+    _COMMAND_PHASE_NAME_LENGTH = 120
+
     def __init__(self, config):
         self._config = config
         self._guest = GuestStepProperties(config['guest_root_path'])
+        self._timer = PhaseTimer(type(self).__name__)
+
+    def phase(self, name):
+        return self._timer.phase(name)
+
+    def command_phase(self, command, hide_command=False):
+        name = '*****' if hide_command else ' '.join(str(c) for c in command)
+        return self._timer.phase(name[:self._COMMAND_PHASE_NAME_LENGTH],
+                                 'command')
 
     def before_execute(self):
         self.puts(">>>>>>>>>> START GUEST SCRIPT EXECUTION: %s\n" % ' '.join(
@@ -290,10 +799,24 @@ class BaseGuest(object):
                 "Exception was thrown: %s. Saving guest script root"
                 " directory snapshot for debugging at: %s" % (
                     str(exception), snapshot_path))
+        linked_paths = []
         if exception or save_guest_files_snapshot:
-            self._create_guest_files_snapshot(snapshot_path)
+            with self.phase('snapshot'):
+                if self._create_guest_files_snapshot(snapshot_path):
+                    # Hardlinks share the owner of the guest root files
+                    linked_paths.append(snapshot_path)
+        with self.phase('output permissions'):
+            self.change_file_permissions(self._guest.guest_output_dir_path(),
+                                         linked_paths)
+        self._write_timings()
         self.puts("<<<<<<<<< END GUEST SCRIPT EXECUTION")
 
+    def _write_timings(self):
+        timings_path = self._guest.guest_output_dir_subpath(
+            ConfigUtils.timings_name())
+        self._timer.write(timings_path)
+        self.change_file_permissions(timings_path)
+
     def puts(self, message='', start_color="\033[1;30m", end_color='\033[0m'):
         sys.stdout.flush()
         print("%s%s%s" % (start_color, message, end_color))
@@ -304,45 +827,92 @@ class BaseGuest(object):
         self.puts(
             "\033[1;30msubprocess.check_call(%s, cwd='%s')\033[0m" % (
                 print_command, cwd))
-        subprocess.check_call(command, cwd=cwd)
+        with self.command_phase(command, hide_command):
+            subprocess.check_call(command, cwd=cwd)
         sys.stdout.flush()
 
+    def run_buffered_command(self, command, cwd=None):
+        with self.command_phase(command):
+            process = subprocess.Popen(command, cwd=cwd,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+        return process.returncode, output.decode('UTF-8', 'replace')
+
     def check_command(self, command, cwd=None, hide_command=False):
         print_command = '*****' if hide_command else command
         self.puts(
             "\033[1;30msubprocess.check_output(%s, cwd='%s')\033[0m" % (
                 print_command, cwd))
-        rv = subprocess.check_output(command, cwd=cwd)
+        with self.command_phase(command, hide_command):
+            rv = subprocess.check_output(command, cwd=cwd)
         sys.stdout.flush()
         return rv
 
-    def change_file_permissions(self, path):
+    def merge_tree(self, src_path, dest_path):
+        if not os.path.exists(dest_path):
+            os.makedirs(dest_path)
+        for entry in os.listdir(src_path):
+            src_entry = os.path.join(src_path, entry)
+            dest_entry = os.path.join(dest_path, entry)
+            if os.path.isdir(dest_entry) and os.path.isdir(src_entry) \
+                    and not os.path.islink(src_entry):
+                self.merge_tree(src_entry, dest_entry)
+            else:
+                if os.path.isdir(dest_entry) \
+                        and not os.path.islink(dest_entry):
+                    shutil.rmtree(dest_entry)
+                os.rename(src_entry, dest_entry)
+
+    def change_file_permissions(self, path, skip_paths=()):
+        # Only what is exported to the host (guest_output, cache entries)
+        # needs the host ownership, a single in-process pass over it
         user_host_id = int(os.getenv('HOST_USER_ID', 0))
         group_host_id = int(os.getenv('HOST_GROUP_ID', 0))
-        if user_host_id and group_host_id:
-            user_and_group = "%s:%s" % (user_host_id, group_host_id)
-            self.run_command(['chown', '-R', user_and_group, path],
-                             hide_command=False)
+        if not user_host_id or not group_host_id or not os.path.exists(path):
+            return
+        changed = self._change_owner(path, user_host_id, group_host_id)
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, sub_dirs, files in os.walk(path):
+                sub_dirs[:] = [d for d in sub_dirs
+                               if os.path.join(root, d) not in skip_paths]
+                for name in sub_dirs + files:
+                    changed += self._change_owner(os.path.join(root, name),
+                                                  user_host_id, group_host_id)
+        self.puts('Changed owner of %s files in %s to %s:%s' % (
+            changed, path, user_host_id, group_host_id))
+
+    @staticmethod
+    def _change_owner(path, user_id, group_id):
+        stat = os.lstat(path)
+        if stat.st_uid == user_id and stat.st_gid == group_id:
+            return 0
+        os.lchown(path, user_id, group_id)
+        return 1
 
     def _create_guest_files_snapshot(self, snapshot_path):
-        output_path = self._guest.guest_output_dir_path()
-        # snapshot_path = self._guest.guest_root_dir_snapshot_path()
-
-        self.run_command(['mkdir', '-p', snapshot_path])
-        for root, sub_dirs, files in os.walk(self._guest.guest_root_path()):
-            for sub_dir in sub_dirs:
-                sub_dir_path = self._guest.guest_root_subpath(sub_dir)
-                if sub_dir_path == output_path:
-                    continue
-                self.run_command(
-                    ['cp', '-R', sub_dir_path, snapshot_path])
-            for file in files:
-                file_path = self._guest.guest_root_subpath(file)
-                self.run_command(
-                    ['cp', file_path, snapshot_path])
-            break
-
-        self.change_file_permissions(snapshot_path)
+        # Returns True if files of the snapshot are hardlinks
+        snapshot_config = self._config.get('guest_snapshot') or {}
+        snapshot = GuestFilesSnapshot(
+            snapshot_config.get('mode', 'copy'),
+            snapshot_config.get('exclude'),
+            snapshot_config.get('threads'),
+            self._config.get('artifact_compression', 'gzip'))
+        start_time = time.time()
+        snapshot_path = snapshot.create(
+            self._guest.guest_root_path(), snapshot_path,
+            [self._guest.guest_output_dir_path()] +
+            (self._config.get('mounted_paths') or []))
+        stats = snapshot.stats()
+        if stats['files']:
+            summary = '%s files (%s linked, %s copied), %.1f MB' % (
+                stats['files'], stats['linked'], stats['copied'],
+                stats['bytes'] / 1048576.0)
+        else:
+            summary = '%.1f MB archive' % (stats['bytes'] / 1048576.0)
+        self.puts('Snapshot saved at %s in %.1fs: %s' % (
+            snapshot_path, time.time() - start_time, summary))
+        return stats['linked'] > 0
 
     def checkout_git_input_repo(self, config):
         # Do not checkout if locally mounted.
@@ -356,7 +926,6 @@ class BaseGuest(object):
         git_repo_path = self._guest.guest_root_subpath(command[-1])
         self.run_command(
             ['git', 'checkout', config['git_commit']], cwd=git_repo_path)
-        self.change_file_permissions(git_repo_path)
         return command[-1]
 
     def checkout_git_output_repo(self, config):
@@ -365,6 +934,4 @@ class BaseGuest(object):
         git_repo_path = self._guest.guest_root_subpath(git_cmd[-1])
         self.run_command(
             ['git', 'checkout', '-b', config['git_branch']], git_repo_path)
-
-        self.change_file_permissions(git_repo_path)
         return git_cmd[-1]
@@ -0,0 +1,223 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+
+class PooledContainer(object):
+    def __init__(self, name):
+        self.name = name
+        self.uses = 0
+        self.idle_since = time.time()
+
+
+class ContainerPool(object):
+    # Pools are shared by all the executions started by this process
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    _GUEST_STEPS_PATH = '/var/artmanflow_steps'
+
+    def __init__(self, image, host_slots_path, guest_root_path,
+        host_steps_path, max_size, idle_timeout_seconds, max_uses):
+        self._image = image
+        # Every container gets its own slot directory as the guest root, it
+        # only ever contains the files of the execution it is running
+        self._host_slots_path = host_slots_path
+        self._guest_root_path = guest_root_path
+        self._host_steps_path = host_steps_path
+        self._max_size = max_size
+        self._idle_timeout_seconds = idle_timeout_seconds
+        self._max_uses = max_uses
+        self._lock = threading.Lock()
+        self._idle = []
+        self._busy = set()
+        self._starting = 0
+        # Idle containers are also evicted when no execution acquires one
+        self._stopped = threading.Event()
+        reaper = threading.Thread(target=self._reap)
+        reaper.daemon = True
+        reaper.start()
+
+    @staticmethod
+    def for_image(image, host_slots_path, guest_root_path, host_steps_path,
+        pool_config):
+        key = (image, host_slots_path, guest_root_path, host_steps_path)
+        with ContainerPool._pools_lock:
+            pool = ContainerPool._pools.get(key)
+            if not pool:
+                pool = ContainerPool(
+                    image, host_slots_path, guest_root_path, host_steps_path,
+                    int(pool_config.get('max_size', 4)),
+                    int(pool_config.get('idle_timeout_seconds', 600)),
+                    int(pool_config.get('max_uses', 10)))
+                ContainerPool._pools[key] = pool
+            return pool
+
+    @staticmethod
+    def shutdown_all():
+        with ContainerPool._pools_lock:
+            pools = list(ContainerPool._pools.values())
+            ContainerPool._pools.clear()
+        for pool in pools:
+            pool.shutdown()
+
+    def shutdown(self):
+        self._stopped.set()
+        with self._lock:
+            containers = self._idle + list(self._busy)
+            self._idle = []
+            self._busy = set()
+        for container in containers:
+            self._remove(container)
+
+    @staticmethod
+    def execution_root_path(guest_root_path, host_execution_path):
+        return '/'.join(
+            [guest_root_path, os.path.basename(host_execution_path)])
+
+    def guest_script_path(self, guest_script_name):
+        return '/'.join([self._GUEST_STEPS_PATH, guest_script_name])
+
+    def slot_path(self, container):
+        return os.path.join(self._host_slots_path, container.name)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._evict_idle()
+                container = self._idle.pop() if self._idle else None
+                if not container:
+                    if len(self._busy) + self._starting >= self._max_size:
+                        return None
+                    self._starting += 1
+            if container:
+                if self._is_running(container):
+                    with self._lock:
+                        self._busy.add(container)
+                    return container
+                self._remove(container)
+                continue
+
+            container = None
+            try:
+                container = self._start()
+            finally:
+                with self._lock:
+                    self._starting -= 1
+                    if container:
+                        self._busy.add(container)
+            return container
+
+    def release(self, container):
+        container.uses += 1
+        container.idle_since = time.time()
+        recycle = container.uses >= self._max_uses or not self._is_running(
+            container)
+        with self._lock:
+            self._busy.discard(container)
+            if not recycle:
+                self._idle.append(container)
+        if recycle:
+            self._remove(container)
+
+    def exec_command(self, container, command, working_dir, env):
+        cmd = ['docker', 'exec', '-i', '-w', working_dir]
+        for name, value in env:
+            cmd += ['-e', '%s=%s' % (name, value)]
+        return cmd + [container.name] + command
+
+    def clean_execution_root(self, container, execution_root_path):
+        # Guest files are owned by the container user, removed from inside
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['docker', 'exec', container.name, 'rm', '-rf',
+                             '--', execution_root_path],
+                            stdout=devnull, stderr=devnull)
+
+    def _start(self):
+        name = 'artmanflow-pool-%s' % uuid.uuid4().hex[:12]
+        slot_path = os.path.join(self._host_slots_path, name)
+        os.makedirs(slot_path)
+        cmd = ['docker', 'run', '-d', '--rm', '--name', name,
+               '-v', ':'.join([slot_path, self._guest_root_path]),
+               '-v', ':'.join([self._host_steps_path, self._GUEST_STEPS_PATH,
+                               'ro']),
+               '--entrypoint', 'sleep', self._image, 'infinity']
+        with open(os.devnull, 'w') as devnull:
+            if subprocess.call(cmd, stdout=devnull, stderr=devnull):
+                self._remove_slot(slot_path)
+                return None
+        return PooledContainer(name)
+
+    def _reap(self):
+        interval = min(max(self._idle_timeout_seconds, 1), 60)
+        while not self._stopped.wait(interval):
+            with self._lock:
+                self._evict_idle()
+
+    def _evict_idle(self):
+        now = time.time()
+        expired = [c for c in self._idle
+                   if now - c.idle_since > self._idle_timeout_seconds]
+        for container in expired:
+            self._idle.remove(container)
+            threading.Thread(target=self._remove, args=(container,)).start()
+
+    @staticmethod
+    def _is_running(container):
+        try:
+            output = subprocess.check_output(
+                ['docker', 'inspect', '-f', '{{.State.Running}}',
+                 container.name], stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            return False
+        return output.decode('UTF-8').strip() == 'true'
+
+    def _remove(self, container):
+        # The slot files are owned by the container user, they are removed
+        # from inside the container while it still runs
+        empty_slot_cmd = ['find', self._guest_root_path, '-mindepth', '1',
+                          '-delete']
+        with open(os.devnull, 'w') as devnull:
+            if subprocess.call(['docker', 'exec', container.name] +
+                               empty_slot_cmd,
+                               stdout=devnull, stderr=devnull):
+                # Stopped container, the slot is emptied by a new one
+                subprocess.call(
+                    ['docker', 'run', '--rm', '-v', ':'.join(
+                        [self.slot_path(container), self._guest_root_path]),
+                     '--entrypoint', empty_slot_cmd[0], self._image] +
+                    empty_slot_cmd[1:], stdout=devnull, stderr=devnull)
+            subprocess.call(['docker', 'rm', '-f', container.name],
+                            stdout=devnull, stderr=devnull)
+        self._remove_slot(self.slot_path(container))
+
+    @staticmethod
+    def _remove_slot(slot_path):
+        try:
+            shutil.rmtree(slot_path)
+        except OSError as e:
+            sys.stderr.write('Could not remove container pool slot %s: %s\n'
+                             % (slot_path, e))
+
+
+# Pooled containers run "sleep infinity", they must not outlive the server
+atexit.register(ContainerPool.shutdown_all)
@@ -0,0 +1,151 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+try:
+    from common import FileLock
+except ImportError:
+    from artmanflow.steps.common import FileLock
+
+
+class GenerationCache(object):
+    def __init__(self, path, max_size_bytes):
+        self._path = path
+        self._max_size_bytes = max_size_bytes
+        if not os.path.isdir(self._entries_path()):
+            os.makedirs(self._entries_path())
+
+    @staticmethod
+    def key(artman_sha, toolkit_sha, googleapis_sha, yaml_path, target,
+        image_digest):
+        key_parts = [artman_sha, toolkit_sha, googleapis_sha,
+                     os.path.normpath(yaml_path), target, image_digest]
+        return hashlib.sha256('\n'.join(key_parts).encode('UTF-8')).hexdigest()
+
+    def lookup(self, key, dest_path):
+        with FileLock(self._lock_path()):
+            index = self._read_index()
+            entry = index['entries'].get(key)
+            if entry is None:
+                index['misses'] += 1
+                self._write_index(index)
+                return False
+            stored_at = entry.get('stored_at')
+
+        # Copied without the lock so that hits of parallel APIs and
+        # executions do not wait for each other. An entry evicted meanwhile
+        # makes the copy fail, or is found replaced below.
+        if os.path.exists(dest_path):
+            shutil.rmtree(dest_path)
+        try:
+            shutil.copytree(self._entry_path(key), dest_path, symlinks=True)
+            copied = True
+        except (OSError, shutil.Error):
+            copied = False
+
+        with FileLock(self._lock_path()):
+            index = self._read_index()
+            entry = index['entries'].get(key)
+            hit = copied and entry is not None and \
+                entry.get('stored_at') == stored_at
+            if hit:
+                entry['last_used'] = time.time()
+                index['hits'] += 1
+            else:
+                index['misses'] += 1
+            self._write_index(index)
+        if not hit:
+            shutil.rmtree(dest_path, ignore_errors=True)
+        return hit
+
+    def store(self, key, src_path):
+        tmp_path = os.path.join(self._entries_path(),
+                                '.tmp-%s' % uuid.uuid4().hex)
+        shutil.copytree(src_path, tmp_path, symlinks=True)
+        size = self._tree_size(tmp_path)
+
+        with FileLock(self._lock_path()):
+            index = self._read_index()
+            entry_path = self._entry_path(key)
+            if key in index['entries'] or size > self._max_size_bytes:
+                shutil.rmtree(tmp_path)
+                return None
+            if os.path.exists(entry_path):
+                shutil.rmtree(entry_path)
+            os.rename(tmp_path, entry_path)
+            now = time.time()
+            index['entries'][key] = {'size': size, 'last_used': now,
+                                     'stored_at': now}
+            self._evict(index)
+            self._write_index(index)
+            return entry_path
+
+    def stats(self):
+        with FileLock(self._lock_path()):
+            index = self._read_index()
+        return {
+            'hits': index['hits'],
+            'misses': index['misses'],
+            'evictions': index['evictions'],
+            'entries': len(index['entries']),
+            'size': sum(e['size'] for e in index['entries'].values())
+        }
+
+    def _evict(self, index):
+        entries = index['entries']
+        total_size = sum(e['size'] for e in entries.values())
+        lru_keys = sorted(entries, key=lambda k: entries[k]['last_used'])
+        for lru_key in lru_keys:
+            if total_size <= self._max_size_bytes:
+                break
+            total_size -= entries.pop(lru_key)['size']
+            shutil.rmtree(self._entry_path(lru_key), ignore_errors=True)
+            index['evictions'] += 1
+
+    def _read_index(self):
+        index_path = os.path.join(self._path, 'index.json')
+        if not os.path.isfile(index_path):
+            return {'entries': {}, 'hits': 0, 'misses': 0, 'evictions': 0}
+        with open(index_path) as index_file:
+            return json.load(index_file)
+
+    def _write_index(self, index):
+        index_path = os.path.join(self._path, 'index.json')
+        tmp_index_path = index_path + '.tmp'
+        with open(tmp_index_path, 'w') as index_file:
+            json.dump(index, index_file)
+        os.rename(tmp_index_path, index_path)
+
+    def _entries_path(self):
+        return os.path.join(self._path, 'entries')
+
+    def _entry_path(self, key):
+        return os.path.join(self._entries_path(), key)
+
+    def _lock_path(self):
+        return os.path.join(self._path, 'lock')
+
+    @staticmethod
+    def _tree_size(path):
+        size = 0
+        for root, sub_dirs, files in os.walk(path):
+            for file_name in files:
+                size += os.lstat(os.path.join(root, file_name)).st_size
+        return size
@@ -0,0 +1,67 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import subprocess
+
+from artmanflow.steps.common import FileLock, GitUtils
+
+
+class GitMirrorCache(object):
+    def __init__(self, path):
+        self._path = path
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+
+    def path(self):
+        return self._path
+
+    def mirror_name(self, config):
+        repo = config['git_repo']
+        repo_owner, repo_name = GitUtils.repo_properties(repo)
+        repo_hash = hashlib.sha1(repo.encode('UTF-8')).hexdigest()[:12]
+        return '%s-%s.git' % (repo_name, repo_hash)
+
+    def mirror_path(self, config):
+        return os.path.join(self._path, self.mirror_name(config))
+
+    def update(self, config, output_file):
+        mirror_path = self.mirror_path(config)
+        repo = config['git_repo']
+        auth_repo = GitUtils.repo_url(config)
+        hide_command = auth_repo != repo
+
+        # Concurrent executions must not fetch into the same mirror at once
+        with FileLock(mirror_path + '.lock'):
+            if not os.path.isdir(mirror_path):
+                self._call(['git', 'clone', '--mirror', auth_repo,
+                            mirror_path], output_file, hide_command)
+                self._call(['git', 'remote', 'set-url', 'origin', repo],
+                           output_file, cwd=mirror_path)
+            else:
+                self._call(['git', 'fetch', '--prune', auth_repo,
+                            '+refs/heads/*:refs/heads/*',
+                            '+refs/tags/*:refs/tags/*'],
+                           output_file, hide_command, mirror_path)
+        return mirror_path
+
+    def _call(self, command, output_file, hide_command=False, cwd=None):
+        print_command = '*****' if hide_command else command
+        output_file.write(
+            "\033[1;30msubprocess.check_call(%s, cwd='%s')\n\033[0m" % (
+                print_command, cwd))
+        output_file.flush()
+        subprocess.check_call(command, cwd=cwd, stdout=output_file,
+                              stderr=output_file)
@@ -0,0 +1,201 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+from artmanflow.steps.common import FileLock, GitUtils
+
+
+class GuestImageCache(object):
+    _IMAGE_REPOSITORY = 'artmanflow-guest'
+
+    _COMPONENTS_PATH = '/artmanflow_components'
+
+    # Attempts to use an image removed by other executions since it was built
+    _USE_ATTEMPTS = 3
+
+    # The repositories are build arguments, they are not parsed by the shell
+    _DOCKERFILE_TEMPLATE = '''FROM %(base_image)s
+ARG ARTMAN_REPO
+ARG TOOLKIT_REPO
+RUN git clone -- "$ARTMAN_REPO" %(artman_path)s \\
+ && git -C %(artman_path)s checkout %(artman_commit)s \\
+ && git clone -- "$TOOLKIT_REPO" %(toolkit_path)s \\
+ && git -C %(toolkit_path)s checkout %(toolkit_commit)s \\
+ && pip3 uninstall --yes -q googleapis-artman \\
+ && pip3 install -q -e %(artman_path)s \\
+ && rm -rf /artman /googleapis /toolkit \\
+ && mkdir -p /root/.artman \\
+ && printf 'local:\\n  toolkit: %(toolkit_path)s\\n' \\
+    > /root/.artman/config.yaml
+LABEL artmanflow.base_image_digest="%(base_image_digest)s" \\
+      artmanflow.artman_commit="%(artman_commit)s" \\
+      artmanflow.toolkit_commit="%(toolkit_commit)s"
+'''
+
+    def __init__(self, max_images, state_path=None):
+        self._max_images = max_images
+        self._state_path = state_path or os.path.join(
+            tempfile.gettempdir(), 'artmanflow-guest-images')
+        if not os.path.isdir(self._state_path):
+            os.makedirs(self._state_path)
+
+    @staticmethod
+    def components_paths():
+        return {
+            'artman': '/'.join([GuestImageCache._COMPONENTS_PATH, 'artman']),
+            'toolkit': '/'.join([GuestImageCache._COMPONENTS_PATH, 'toolkit'])
+        }
+
+    @staticmethod
+    def image_tag(base_image_digest, artman_commit, toolkit_commit):
+        key = '\n'.join([base_image_digest, artman_commit, toolkit_commit])
+        key_hash = hashlib.sha256(key.encode('UTF-8')).hexdigest()[:24]
+        return '%s:%s' % (GuestImageCache._IMAGE_REPOSITORY, key_hash)
+
+    def ensure_image(self, base_image, base_image_digest, artman_config,
+        toolkit_config, output_file):
+        artman_commit = GitUtils.resolve_commit(artman_config)
+        toolkit_commit = GitUtils.resolve_commit(toolkit_config)
+        if not artman_commit or not toolkit_commit:
+            self._log(output_file, 'Guest image cache is not used: could not'
+                                   ' resolve artman/toolkit commits')
+            return None
+
+        tag = self.image_tag(base_image_digest, artman_commit, toolkit_commit)
+        # Builds of other images go on, only the same image waits
+        with FileLock(self._tag_lock_path(tag)):
+            if self._image_exists(tag):
+                self._log(output_file, 'Using cached guest image %s' % tag)
+            else:
+                self._log(output_file, 'Building guest image %s' % tag)
+                paths = self.components_paths()
+                dockerfile = self._DOCKERFILE_TEMPLATE % {
+                    'base_image': base_image,
+                    'base_image_digest': base_image_digest,
+                    'artman_path': paths['artman'],
+                    'artman_commit': artman_commit,
+                    'toolkit_path': paths['toolkit'],
+                    'toolkit_commit': toolkit_commit
+                }
+                cmd = ['docker', 'build',
+                       '--build-arg',
+                       'ARTMAN_REPO=%s' % artman_config['git_repo'],
+                       '--build-arg',
+                       'TOOLKIT_REPO=%s' % toolkit_config['git_repo'],
+                       '-t', tag, '-']
+                build = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=output_file,
+                                         stderr=output_file)
+                build.communicate(dockerfile.encode('UTF-8'))
+                if build.returncode:
+                    self._log(output_file, 'Could not build guest image %s'
+                              % tag)
+                    return None
+
+        # Tag locks are taken under this one (to remove images), never the
+        # other way around
+        with FileLock(os.path.join(self._state_path, 'lock')):
+            self._touch(tag)
+            self._collect_garbage(tag, output_file)
+        return tag
+
+    @contextlib.contextmanager
+    def use_image(self, base_image, base_image_digest, artman_config,
+        toolkit_config, output_file):
+        # The garbage collection of other executions does not remove the
+        # image while it is used, the guest container must be created before
+        # leaving the block (images of containers are not removed)
+        for _ in range(self._USE_ATTEMPTS):
+            tag = self.ensure_image(base_image, base_image_digest,
+                                    artman_config, toolkit_config,
+                                    output_file)
+            if not tag:
+                break
+            lock = FileLock(self._tag_lock_path(tag), shared=True)
+            lock.acquire()
+            if self._image_exists(tag):
+                try:
+                    yield tag
+                finally:
+                    lock.release()
+                return
+            lock.release()
+            self._log(output_file, 'Guest image %s was removed by another'
+                                   ' execution' % tag)
+        yield None
+
+    def _collect_garbage(self, current_tag, output_file):
+        usage = self._read_usage()
+        for tag in sorted(usage, key=lambda t: usage[t]):
+            if len(usage) <= self._max_images:
+                break
+            if tag == current_tag:
+                continue
+            tag_lock = FileLock(self._tag_lock_path(tag))
+            if not tag_lock.acquire(blocking=False):
+                # Being built or used, retried by a later collection
+                continue
+            self._log(output_file, 'Removing least recently used guest'
+                                   ' image %s' % tag)
+            try:
+                returncode = subprocess.call(['docker', 'rmi', tag],
+                                             stdout=output_file,
+                                             stderr=output_file)
+            finally:
+                tag_lock.release()
+            if returncode:
+                # Likely used by a container, retried by a later collection
+                continue
+            del usage[tag]
+        self._write_usage(usage)
+
+    def _tag_lock_path(self, tag):
+        return os.path.join(self._state_path,
+                            '%s.lock' % tag.split(':')[-1])
+
+    def _touch(self, tag):
+        usage = self._read_usage()
+        usage[tag] = time.time()
+        self._write_usage(usage)
+
+    def _read_usage(self):
+        usage_path = os.path.join(self._state_path, 'images.json')
+        if not os.path.isfile(usage_path):
+            return {}
+        with open(usage_path) as usage_file:
+            return json.load(usage_file)
+
+    def _write_usage(self, usage):
+        usage_path = os.path.join(self._state_path, 'images.json')
+        with open(usage_path + '.tmp', 'w') as usage_file:
+            json.dump(usage, usage_file)
+        os.rename(usage_path + '.tmp', usage_path)
+
+    @staticmethod
+    def _image_exists(tag):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(['docker', 'image', 'inspect', tag],
+                                   stdout=devnull, stderr=devnull) == 0
+
+    @staticmethod
+    def _log(output_file, message):
+        output_file.write('\033[1;30m%s\n\033[0m' % message)
+        output_file.flush()
@@ -0,0 +1,141 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import fnmatch
+import multiprocessing
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from artifact_archive import StreamingArchive
+except ImportError:
+    from artmanflow.steps.artifact_archive import StreamingArchive
+
+
+class GuestFilesSnapshot(object):
+    MODES = ['link', 'copy', 'tar']
+
+    def __init__(self, mode='copy', exclude=None, threads=None,
+        compression='gzip'):
+        if mode not in self.MODES:
+            raise ValueError('Unsupported snapshot mode: %s' % mode)
+        self._mode = mode
+        self._exclude = list(exclude or [])
+        self._threads = int(threads or multiprocessing.cpu_count())
+        self._compression = compression
+        self._lock = threading.Lock()
+        self._stats = {'files': 0, 'linked': 0, 'copied': 0, 'bytes': 0}
+
+    def create(self, root_path, snapshot_path, skip_paths=()):
+        # Returns the path of the created snapshot (a directory or an archive)
+        skip_paths = set(os.path.abspath(p) for p in skip_paths)
+        skip_paths.add(os.path.abspath(snapshot_path))
+
+        def excluded(relative_path):
+            path = os.path.join(root_path, relative_path)
+            return os.path.abspath(path) in skip_paths or \
+                self._is_excluded(relative_path)
+
+        if self._mode == 'tar':
+            archive_path = snapshot_path + '.tar' + (
+                '.zst' if self._compression == 'zstd' else '.gz')
+            skip_paths.add(os.path.abspath(archive_path))
+            archive = StreamingArchive(archive_path, self._compression,
+                                       self._threads)
+            try:
+                archive.add_tree(root_path, excluded)
+                archive.close()
+            except Exception:
+                archive.abort()
+                raise
+            with self._lock:
+                self._stats['bytes'] = os.path.getsize(archive_path)
+            return archive_path
+
+        # Hardlinks cannot cross devices, guest_output is usually a bind
+        # mount: link mode only pays off with the snapshot on the guest root
+        # file system
+        link = self._mode == 'link'
+        with ThreadPoolExecutor(max_workers=self._threads) as pool:
+            futures = []
+            for dir_path, sub_dirs, files in os.walk(root_path):
+                relative_dir = os.path.relpath(dir_path, root_path)
+                if relative_dir == '.':
+                    relative_dir = ''
+                dest_dir = os.path.join(snapshot_path, relative_dir)
+                if not os.path.isdir(dest_dir):
+                    os.makedirs(dest_dir)
+
+                for sub_dir in list(sub_dirs):
+                    relative_path = os.path.join(relative_dir, sub_dir)
+                    src_path = os.path.join(dir_path, sub_dir)
+                    if excluded(relative_path):
+                        sub_dirs.remove(sub_dir)
+                    elif os.path.islink(src_path):
+                        # os.walk() does not follow directory symlinks
+                        self._copy_symlink(src_path,
+                                           os.path.join(dest_dir, sub_dir))
+
+                for file_name in files:
+                    relative_path = os.path.join(relative_dir, file_name)
+                    if excluded(relative_path):
+                        continue
+                    src_path = os.path.join(dir_path, file_name)
+                    dest_path = os.path.join(dest_dir, file_name)
+                    if os.path.islink(src_path):
+                        self._copy_symlink(src_path, dest_path)
+                        continue
+                    if link:
+                        try:
+                            os.link(src_path, dest_path)
+                            self._count('linked', src_path)
+                            continue
+                        except OSError as e:
+                            if e.errno not in (errno.EXDEV, errno.EPERM,
+                                               errno.EMLINK):
+                                raise
+                            link = False
+                    futures.append(pool.submit(self._copy_file, src_path,
+                                               dest_path))
+            for future in futures:
+                future.result()
+        return snapshot_path
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _is_excluded(self, relative_path):
+        name = os.path.basename(relative_path)
+        return any(fnmatch.fnmatch(name, pattern) or
+                   fnmatch.fnmatch(relative_path, pattern)
+                   for pattern in self._exclude)
+
+    def _copy_file(self, src_path, dest_path):
+        shutil.copy2(src_path, dest_path)
+        self._count('copied', src_path)
+
+    def _copy_symlink(self, src_path, dest_path):
+        os.symlink(os.readlink(src_path), dest_path)
+        self._count('copied', None)
+
+    def _count(self, kind, path):
+        size = os.lstat(path).st_size if path else 0
+        with self._lock:
+            self._stats['files'] += 1
+            self._stats[kind] += 1
+            self._stats['bytes'] += size
@@ -0,0 +1,76 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import threading
+import time
+
+from artmanflow.steps.common import DockerUtils
+
+
+class ImagePullManager(object):
+    # Shared by all the executions started by this process (web server)
+    _lock = threading.Lock()
+    _in_flight = {}
+    _checked_at = {}
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def pull(image, output_file, ttl_seconds=0):
+        cls = ImagePullManager
+        with cls._lock:
+            checked_at = cls._checked_at.get(image)
+            pull_done = cls._in_flight.get(image)
+            leader = pull_done is None
+            fresh = leader and checked_at is not None \
+                and time.time() - checked_at < ttl_seconds
+            if leader and not fresh:
+                pull_done = threading.Event()
+                cls._in_flight[image] = pull_done
+
+        if fresh:
+            cls._log(output_file, 'docker pull %s skipped: image was checked'
+                                  ' %ds ago (digest %s)' % (
+                         image, time.time() - checked_at,
+                         DockerUtils.image_digest(image)))
+            return 'fresh'
+
+        if not leader:
+            cls._log(output_file, 'docker pull %s is already in progress,'
+                                  ' waiting for it' % image)
+            pull_done.wait()
+            cls._log(output_file, 'docker pull %s finished (digest %s)' % (
+                image, DockerUtils.image_digest(image)))
+            return 'joined'
+
+        returncode = None
+        try:
+            cls._log(output_file, 'docker pull %s' % image)
+            returncode = subprocess.call(['docker', 'pull', image],
+                                         stdout=output_file,
+                                         stderr=output_file)
+        finally:
+            with cls._lock:
+                del cls._in_flight[image]
+                if returncode == 0:
+                    cls._checked_at[image] = time.time()
+            pull_done.set()
+        return 'pulled'
+
+    @staticmethod
+    def _log(output_file, message):
+        output_file.write('\033[1;30m%s\n\033[0m' % message)
+        output_file.flush()
@@ -20,42 +20,62 @@ import github3
 
 try:
     from common import GuestStepProperties, ConfigUtils, GitUtils, BaseGuest
+    from artifact_archive import ArchiveIndexer
 except ImportError:
     from artmanflow.steps.common import \
         GuestStepProperties, ConfigUtils, GitUtils, BaseGuest
+    from artmanflow.steps.artifact_archive import ArchiveIndexer
 
 
 class JavaSourcesStagingGuest(BaseGuest):
     def execute(self):
         try:
             self.before_execute()
-            staging_name = self.checkout_git_output_repo(
-                self._config['staging'])
-            client_folders = self._extract_client_folders()
-            self._copy_artifacts_to_staging(staging_name, client_folders)
-            self._build_and_test(staging_name)
-            self._git_commit_and_push(staging_name)
-            pr_url = self._post_pr()
+            with self.phase('checkout'):
+                staging_name = self.checkout_git_output_repo(
+                    self._config['staging'])
+            with self.phase('extract artifacts'):
+                client_folders = self._extract_artifacts()
+            with self.phase('copy to staging'):
+                self._copy_artifacts_to_staging(staging_name, client_folders)
+            with self.phase('build and test'):
+                self._build_and_test(staging_name)
+            with self.phase('commit and push'):
+                self._git_commit_and_push(staging_name)
+            with self.phase('pull request'):
+                pr_url = self._post_pr()
             self._dump_output({'pr_url': pr_url})
             self.after_execute(self._config['debug_mode'])
         except Exception as e:
             self.after_execute(True, e)
             raise
 
-    def _extract_client_folders(self):
+    def _extract_artifacts(self):
         exp = re.compile(r'^\./([^/]+/){2}$')
         art_name = self._config['generator_artifacts']['sources_zip']
-
-        art_list = self.check_command(['tar', '-tf', art_name],
-                                      self._guest.guest_root_path())
-        art_list = art_list.decode('UTF-8').split('\n')
-        client_folders = []
-        for art in art_list:
-            if exp.match(art):
-                client_folders.append(art)
-
+        extract_path = self._guest.guest_root_subpath('artifacts')
+        sources_dir = self._config['generator_artifacts'].get('sources_dir')
+        if sources_dir:
+            return self._copy_artifacts(sources_dir, extract_path)
+
+        self.puts("Extracting ./java/ from %s to %s" % (art_name, extract_path))
+        client_folders = ArchiveIndexer(art_name).extract(
+            extract_path, './java/', exp)
         return client_folders
 
+    def _copy_artifacts(self, sources_dir, extract_path):
+        # Stored sources are linked read-only files, no archive to extract
+        self.puts("Copying ./java/ from %s to %s" % (sources_dir,
+                                                     extract_path))
+        java_path = os.path.join(sources_dir, 'java')
+        if not os.path.isdir(java_path):
+            return []
+        os.makedirs(extract_path)
+        self.run_command(['cp', '-a', java_path, extract_path])
+        self.run_command(['chmod', '-R', 'u+w', extract_path])
+        return ['./java/%s/' % entry for entry in sorted(os.listdir(java_path))
+                if os.path.isdir(os.path.join(java_path, entry))]
+
     def _copy_artifacts_to_staging(self, staging_name, client_folders):
         staging_path = self._guest.guest_root_subpath(staging_name)
         dests = []
@@ -69,11 +89,10 @@ class JavaSourcesStagingGuest(BaseGuest):
                 os.makedirs(dest_path)
             dests.append(dest)
 
-        unzip_dest = self._guest.guest_root_subpath([staging_name, 'generated'])
-        self.run_command(
-            ['tar', '-pxzf', self._config['generator_artifacts']['sources_zip'],
-             '-C', unzip_dest, '--wildcards', './java/*'],
-            self._guest.guest_root_path())
+        extracted_path = self._guest.guest_root_subpath(['artifacts', 'java'])
+        if os.path.isdir(extracted_path):
+            self.merge_tree(extracted_path, self._guest.guest_root_subpath(
+                [staging_name, 'generated', 'java']))
         for dest in dests:
             self.run_command(['git', 'add', dest], staging_path)
 
@@ -128,7 +147,6 @@ class JavaSourcesStagingGuest(BaseGuest):
         output_yaml_path = self._guest.guest_output_dir_subpath(
             ConfigUtils.artifact_yaml_name())
         ConfigUtils.dump_config(output_yaml, output_yaml_path)
-        self.change_file_permissions(output_yaml_path)
 
 
 if __name__ == '__main__':
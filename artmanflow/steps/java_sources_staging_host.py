@@ -27,6 +27,17 @@ class JavaSourcesStagingHost(BaseHost):
         return self._host.execution_id()
 
     def _stage_sources_in_guest(self):
+        host_sources_dir = self._config['generator_artifacts'].get(
+            'sources_dir')
+        if host_sources_dir:
+            guest_sources_dir = self._guest.guest_root_subpath('sources')
+            guest_config = copy.deepcopy(self._config)
+            guest_config['generator_artifacts']['sources_dir'] = \
+                guest_sources_dir
+            self.run_guest_script(guest_config, [[host_sources_dir,
+                                                  guest_sources_dir, 'ro']])
+            return
+
         host_art_path = self._config['generator_artifacts']['sources_zip']
         art_name = host_art_path[host_art_path.rfind('/') + 1:]
         guest_art_path = self._guest.guest_root_subpath(art_name)
@@ -0,0 +1,177 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import threading
+
+
+class Metric(object):
+    def __init__(self, name, help_text, metric_type, label_names):
+        self.name = name
+        self._help_text = help_text
+        self._type = metric_type
+        self._label_names = label_names
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self._help_text),
+                 '# TYPE %s %s' % (self.name, self._type)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _render_value(self, label_values, value):
+        return ['%s%s %s' % (self.name, self._labels(label_values),
+                             _format_number(value))]
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self._label_names)
+
+    def _labels(self, label_values, extra=None):
+        pairs = list(zip(self._label_names, label_values)) + (extra or [])
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                                 for name, value in pairs)
+
+
+class Counter(Metric):
+    def __init__(self, name, help_text, label_names=()):
+        Metric.__init__(self, name, help_text, 'counter', label_names)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    def __init__(self, name, help_text, label_names=()):
+        Metric.__init__(self, name, help_text, 'gauge', label_names)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def reset(self, values):
+        # Replaces all the values at once, labels missing in values disappear
+        with self._lock:
+            self._values = dict((self._key(labels), value)
+                                for labels, value in values)
+
+
+class Histogram(Metric):
+    DURATION_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600,
+                        7200]
+
+    def __init__(self, name, help_text, label_names=(),
+        buckets=DURATION_BUCKETS):
+        Metric.__init__(self, name, help_text, 'histogram', label_names)
+        self._buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ((0,) * (len(self._buckets) + 1), 0.0))
+            # Values are immutable, render() can read them without the lock
+            counts = counts[:index] + (counts[index] + 1,) + counts[index + 1:]
+            self._values[key] = (counts, total + value)
+
+    def _render_value(self, label_values, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + ['+Inf'], counts):
+            cumulative += count
+            lines.append('%s_bucket%s %s' % (
+                self.name,
+                self._labels(label_values, [('le', _format_number(bound))]),
+                cumulative))
+        lines.append('%s_sum%s %s' % (self.name, self._labels(label_values),
+                                      _format_number(total)))
+        lines.append('%s_count%s %s' % (self.name, self._labels(label_values),
+                                        cumulative))
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._register(Gauge(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=()):
+        return self._register(Histogram(name, help_text, label_names))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _format_number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# Collected in the web server process, rendered by /metrics
+REGISTRY = MetricsRegistry()
+
+EXECUTIONS = REGISTRY.counter(
+    'artmanflow_executions_total',
+    'Finished executions by step and outcome', ['step', 'status'])
+
+EXECUTION_DURATION = REGISTRY.histogram(
+    'artmanflow_execution_duration_seconds',
+    'Execution wall time from leaving the queue to the guest exit', ['step'])
+
+PHASE_DURATION = REGISTRY.histogram(
+    'artmanflow_phase_duration_seconds',
+    'Duration of execution phases', ['step', 'phase'])
+
+ARTIFACT_BYTES = REGISTRY.counter(
+    'artmanflow_artifact_bytes_total',
+    'Bytes of artifacts produced by finished executions', ['step'])
+
+RUNNING_EXECUTIONS = REGISTRY.gauge(
+    'artmanflow_running_executions',
+    'Executions currently running', ['step'])
+
+QUEUED_EXECUTIONS = REGISTRY.gauge(
+    'artmanflow_queued_executions',
+    'Executions waiting in the scheduler queue', ['step'])
+
+RUNNING_GUESTS = REGISTRY.gauge(
+    'artmanflow_running_guest_processes',
+    'Guest processes (docker run or docker exec) currently supervised')
@@ -0,0 +1,349 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import signal
+import sys
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+try:
+    from common import ConfigUtils, BaseHostScript
+    from artifact_archive import StreamingArchive
+    from supervisor import ExecutionSupervisor
+except ImportError:
+    from artmanflow.steps.common import ConfigUtils, \
+        BaseHostScript
+    from artmanflow.steps.artifact_archive import StreamingArchive
+    from artmanflow.steps.supervisor import ExecutionSupervisor
+
+
+class ShardCoordinator(BaseHostScript):
+    SHARD_CONFIG_KEYS = ['docker_image', 'debug_mode', 'max_parallel_apis',
+                         'artifact_compression', 'artman', 'toolkit',
+                         'googleapis']
+
+    _MAX_WORKER_ERRORS = 3
+    _REQUEST_TIMEOUT_SECONDS = 60
+
+    def __init__(self, config):
+        BaseHostScript.__init__(self, config)
+        sharding = config['sharding']
+        self._worker_token = sharding.get('worker_token') or ''
+        self._max_attempts = int(sharding.get('max_attempts', 3))
+        self._poll_interval = float(sharding.get('poll_interval_seconds', 10))
+        self._workers = {}
+        for worker_url in sharding['workers']:
+            self._workers[worker_url.rstrip('/')] = {
+                'shard': None, 'errors': 0, 'busy_until': 0}
+
+        apis = config['artman_client_yaml_configs']
+        shard_count = min(
+            len(apis),
+            len(self._workers) * int(sharding.get('shards_per_worker', 1)))
+        # Round robin, neighbouring APIs are often similarly sized
+        self._shards = [{
+            'index': index,
+            'api_indexes': list(range(len(apis)))[index::shard_count],
+            'status': 'pending',
+            'attempts': 0,
+            'failed_workers': set(),
+            'worker': None,
+            'execution_id': None
+        } for index in range(shard_count)]
+
+    def execute(self):
+        exit_code = 1
+        try:
+            self.before_execute()
+            with self.phase('run shards'):
+                self._run_shards()
+            with self.phase('merge shards'):
+                exit_code = self._merge_shards()
+        except Exception as e:
+            self.puts('Sharded generation failed: %s' % e, '\033[1;31m')
+            raise
+        finally:
+            self._cancel_running_shards()
+            self.after_execute()
+        return exit_code
+
+    def _run_shards(self):
+        self.puts("\n> Generating %s APIs in %s shards on %s workers" % (
+            len(self._config['artman_client_yaml_configs']),
+            len(self._shards), len(self._workers)))
+        while not all(shard['status'] in ['succeeded', 'failed']
+                      for shard in self._shards):
+            self._assign_shards()
+            if not self._workers:
+                for shard in self._shards:
+                    if shard['status'] == 'pending':
+                        shard['status'] = 'failed'
+                        self.puts('Shard %s failed: no workers left' %
+                                  shard['index'], '\033[1;31m')
+                break
+            time.sleep(self._poll_interval)
+            self._poll_shards()
+
+    def _assign_shards(self):
+        for shard in self._shards:
+            if shard['status'] != 'pending':
+                continue
+            worker_url = self._pick_worker(shard)
+            if not worker_url:
+                return
+            self._submit_shard(shard, worker_url)
+
+    def _pick_worker(self, shard):
+        now = time.time()
+        idle = [url for url, worker in sorted(self._workers.items())
+                if not worker['shard'] and worker['busy_until'] <= now]
+        # Another worker than the ones this shard already failed on
+        preferred = [url for url in idle if url not in shard['failed_workers']]
+        return (preferred or idle or [None])[0]
+
+    def _submit_shard(self, shard, worker_url):
+        worker = self._workers[worker_url]
+        try:
+            # The same key for a resubmission of a timed out submission,
+            # the worker does not start the shard twice
+            response = self._request(
+                '%s/sources-generation/shards' % worker_url,
+                self._shard_config(shard),
+                headers={'Idempotency-Key': '%s-%s-%s' % (
+                    self._config['execution_id'], shard['index'],
+                    shard['attempts'])})
+        except HTTPError as e:
+            if e.code == 429:
+                # The worker queue is full, try again later
+                worker['busy_until'] = time.time() + int(
+                    e.headers.get('Retry-After') or self._poll_interval)
+            else:
+                self._worker_error(worker_url, e)
+            return
+        except (URLError, OSError, ValueError) as e:
+            self._worker_error(worker_url, e)
+            return
+
+        shard['attempts'] += 1
+        shard['status'] = 'running'
+        shard['worker'] = worker_url
+        shard['execution_id'] = response['execution_id']
+        worker['shard'] = shard
+        worker['errors'] = 0
+        self.puts('Shard %s (%s APIs, attempt %s) is running on %s as %s' % (
+            shard['index'], len(shard['api_indexes']), shard['attempts'],
+            worker_url, shard['execution_id']), '\033[36m')
+
+    def _poll_shards(self):
+        for worker_url, worker in list(self._workers.items()):
+            shard = worker['shard']
+            if not shard:
+                continue
+            try:
+                state = self._request('%s/sources-generation/%s/status' % (
+                    worker_url, shard['execution_id']))
+            except (URLError, OSError, ValueError) as e:
+                if self._worker_error(worker_url, e):
+                    self._retry_shard(shard, 'worker is unreachable')
+                continue
+            worker['errors'] = 0
+
+            execution = state.get('execution')
+            if not ExecutionSupervisor.is_finished(execution):
+                continue
+            worker['shard'] = None
+            shard['summary'] = state.get('summary')
+            if execution['status'] == 'succeeded' and \
+                    self._download_artifact(shard):
+                shard['status'] = 'succeeded'
+                self.puts('Shard %s succeeded on %s' % (shard['index'],
+                                                        worker_url),
+                          '\033[32m')
+            else:
+                self._retry_shard(shard, 'execution %s' % execution['status'])
+
+    def _retry_shard(self, shard, reason):
+        shard['failed_workers'].add(shard['worker'])
+        if shard['attempts'] < self._max_attempts:
+            shard['status'] = 'pending'
+            self.puts('Shard %s failed on %s (%s), reassigning it' % (
+                shard['index'], shard['worker'], reason), '\033[1;31m')
+            return
+
+        shard['status'] = 'failed'
+        self.puts('Shard %s failed on %s (%s) after %s attempts' % (
+            shard['index'], shard['worker'], reason, shard['attempts']),
+                  '\033[1;31m')
+        # Keep the output of the APIs that did succeed, like a local run
+        if shard.get('summary'):
+            self._download_artifact(shard)
+
+    def _worker_error(self, worker_url, error):
+        # Returns True if the worker was removed from the pool
+        worker = self._workers[worker_url]
+        worker['errors'] += 1
+        self.puts('Request to worker %s failed: %s' % (worker_url, error),
+                  '\033[1;31m')
+        if worker['errors'] < self._MAX_WORKER_ERRORS:
+            return False
+        self.puts('Worker %s is removed after %s failed requests' % (
+            worker_url, worker['errors']), '\033[1;31m')
+        del self._workers[worker_url]
+        return True
+
+    def _download_artifact(self, shard):
+        shard_path = self._guest.guest_root_subpath(
+            ['shards', str(shard['index'])])
+        if not os.path.isdir(shard_path):
+            os.makedirs(shard_path)
+        try:
+            response = urlopen(
+                '%s/sources-generation/%s/download' % (
+                    shard['worker'], shard['execution_id']),
+                timeout=self._REQUEST_TIMEOUT_SECONDS)
+            # The worker may use another compression than the coordinator,
+            # or stream a gzip archive from the artifact store
+            artifact_path = os.path.join(
+                shard_path, self._response_artifact_name(response))
+            with open(artifact_path + '.part', 'wb') as artifact_file:
+                shutil.copyfileobj(response, artifact_file)
+            os.rename(artifact_path + '.part', artifact_path)
+        except (URLError, OSError) as e:
+            self.puts('Could not download the artifacts of shard %s: %s' % (
+                shard['index'], e), '\033[1;31m')
+            return False
+        shard['artifact_path'] = artifact_path
+        return True
+
+    @staticmethod
+    def _response_artifact_name(response):
+        disposition = (response.headers.get('Content-Disposition') or
+                       '').strip('"; ')
+        for artifact_name in ConfigUtils.artifact_names():
+            if disposition.endswith(artifact_name):
+                return artifact_name
+        if response.headers.get('Content-Type') == 'application/zstd':
+            return ConfigUtils.artifact_name('zstd')
+        return ConfigUtils.artifact_name('gzip')
+
+    def _merge_shards(self):
+        compression = self._config.get('artifact_compression', 'gzip')
+        apis = self._config['artman_client_yaml_configs']
+        archive_path = self._guest.guest_output_dir_subpath(
+            ConfigUtils.artifact_name(compression))
+        self.puts("\n> Merging shard artifacts to %s" % archive_path)
+        archive = StreamingArchive(
+            archive_path, compression,
+            manifest_path=self._guest.guest_output_dir_subpath(
+                ConfigUtils.artifact_manifest_name()))
+        statuses = [None] * len(apis)
+        summaries = []
+        for shard in self._shards:
+            if not shard.get('artifact_path'):
+                continue
+            archive.add_archive(shard['artifact_path'])
+            summary = shard.get('summary')
+            if summary:
+                summaries.append(summary)
+                for api_index, status in zip(shard['api_indexes'],
+                                             summary.get('apis') or []):
+                    statuses[api_index] = status
+        archive.close()
+        shutil.rmtree(self._guest.guest_root_subpath('shards'),
+                      ignore_errors=True)
+
+        for api_index, api in enumerate(apis):
+            if not statuses[api_index]:
+                statuses[api_index] = {
+                    'name': self._api_name(api),
+                    'path': api['path'],
+                    'target': api['target'],
+                    'status': 'failure',
+                    'cached': False,
+                    'reused': False,
+                    'outputs': []
+                }
+        summary = {
+            'commits': summaries[0].get('commits') if summaries else None,
+            'docker_image_digest': summaries[0].get(
+                'docker_image_digest') if summaries else None,
+            'apis': statuses,
+            'shards': [{
+                'index': shard['index'],
+                'worker': shard['worker'],
+                'execution_id': shard['execution_id'],
+                'status': shard['status'],
+                'attempts': shard['attempts']
+            } for shard in self._shards]
+        }
+        ConfigUtils.dump_config(summary, self._guest.guest_output_dir_subpath(
+            ConfigUtils.artifact_yaml_name()))
+
+        failed = [s['name'] for s in statuses if s['status'] != 'success']
+        if failed:
+            self.puts('Generation failed for APIs: %s' % ', '.join(failed),
+                      '\033[1;31m')
+            return 1
+        return 0
+
+    def _cancel_running_shards(self):
+        for worker_url, worker in list(self._workers.items()):
+            shard = worker['shard']
+            if not shard:
+                continue
+            self.puts('Cancelling shard %s on %s' % (shard['index'],
+                                                     worker_url))
+            try:
+                self._request('%s/sources-generation/%s/cancel' % (
+                    worker_url, shard['execution_id']), {}, parse=False)
+            except (URLError, OSError) as e:
+                self.puts('Could not cancel shard %s: %s' % (shard['index'],
+                                                             e))
+
+    def _shard_config(self, shard):
+        config = dict((key, self._config[key])
+                      for key in self.SHARD_CONFIG_KEYS
+                      if key in self._config)
+        apis = self._config['artman_client_yaml_configs']
+        config['artman_client_yaml_configs'] = [
+            apis[api_index] for api_index in shard['api_indexes']]
+        return config
+
+    def _request(self, url, data=None, parse=True, headers=None):
+        request = Request(url, headers=headers or {})
+        if self._worker_token:
+            # Workers only accept shards from coordinators sharing the token
+            request.add_header('Authorization',
+                               'Bearer %s' % self._worker_token)
+        if data is not None:
+            request.add_header('Content-Type', 'application/json')
+            request.data = json.dumps(data).encode('UTF-8')
+        response = urlopen(request, timeout=self._REQUEST_TIMEOUT_SECONDS)
+        body = response.read()
+        return json.loads(body.decode('UTF-8')) if parse else body
+
+    @staticmethod
+    def _api_name(api):
+        return api['path'].partition('/artman_')[2].partition('.yaml')[0]
+
+
+if __name__ == '__main__':
+    execution_config = ConfigUtils.read_config()
+    # Stopped by the execution supervisor, cancels the running shards
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(143))
+    sys.exit(ShardCoordinator(execution_config).execute())
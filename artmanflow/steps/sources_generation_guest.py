@@ -13,35 +13,63 @@
 # limitations under the License.
 
 import os
+import shutil
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from common import GuestStepProperties, ConfigUtils, GitUtils, BaseGuest
+    from generation_cache import GenerationCache
+    from artifact_archive import StreamingArchive
 except ImportError:
     from artmanflow.steps.common import \
         GuestStepProperties, ConfigUtils, GitUtils, BaseGuest
+    from artmanflow.steps.generation_cache import GenerationCache
+    from artmanflow.steps.artifact_archive import StreamingArchive
 
 
 class SourcesGenerationGuest(BaseGuest):
+    _CELLS_DIR_NAME = 'cells'
+
+    # Changes in these googleapis paths may affect any API
+    _SHARED_GOOGLEAPIS_PATHS = ['gapic/', 'google/api/', 'google/iam/',
+                                'google/longrunning/', 'google/protobuf/',
+                                'google/rpc/', 'google/type/']
+
+    def __init__(self, config):
+        BaseGuest.__init__(self, config)
+        self._output_lock = threading.Lock()
+
     def execute(self):
         try:
             self.before_execute()
-            repo_names = self._checkout_git_repos()
-            self._reinstall_components(repo_names)
-            self._run_artman(repo_names)
-            self._fix_generator_output()
-            self._archive_artifacts()
+            with self.phase('checkout'):
+                repo_names = self._checkout_git_repos()
+            if not self._config.get('preinstalled_components'):
+                with self.phase('reinstall components'):
+                    self._reinstall_components(repo_names)
+            with self.phase('generate'):
+                statuses = self._run_artman(repo_names)
+            self._check_generation_summary(statuses)
             self.after_execute(self._config['debug_mode'])
         except Exception as e:
             self.after_execute(True, e)
             raise
 
     def _checkout_git_repos(self):
-        repo_names = {
-            'artman': self.checkout_git_input_repo(self._config['artman']),
-            'toolkit': self.checkout_git_input_repo(self._config['toolkit']),
-            'googleapis': self.checkout_git_input_repo(
-                self._config['googleapis'])
-        }
+        preinstalled = self._config.get('preinstalled_components') or {}
+        repo_names = {}
+        for repo_name in ['artman', 'toolkit', 'googleapis']:
+            if repo_name in preinstalled:
+                # Already checked out and installed in the guest image
+                self.run_command(['ln', '-s', preinstalled[repo_name],
+                                  self._guest.guest_root_subpath(repo_name)])
+                repo_names[repo_name] = repo_name
+            else:
+                repo_names[repo_name] = self.checkout_git_input_repo(
+                    self._config[repo_name])
         return repo_names
 
     def _reinstall_components(self, repo_names):
@@ -63,47 +91,548 @@ class SourcesGenerationGuest(BaseGuest):
         # self._docker.run_command(['cat', '/root/.artman/config.yaml'])
 
     def _run_artman(self, repo_names):
+        max_parallel_apis = int(self._config.get('max_parallel_apis', 1))
+        commits = self._resolve_commits(repo_names)
+        cache = self._generation_cache()
+        matrix = self._config.get('matrix') or {}
+        if matrix.get('googleapis_commits') or matrix.get('targets'):
+            with self.phase('matrix checkout'):
+                cells = self._matrix_cells(repo_names, commits, matrix)
+        else:
+            apis = self._config['artman_client_yaml_configs']
+            cells = [self._cell(None, repo_names, commits, apis)]
+            cells[0]['plan'] = self._plan_incremental_generation(
+                repo_names, commits, apis)
+        try:
+            for cell in cells:
+                cell['archive'] = self._open_archive(cell['output_path'])
+
+            # APIs of all the cells share the same pool
+            jobs = [(cell, index, api) for cell in cells
+                    for index, api in enumerate(cell['apis'])]
+            if max_parallel_apis > 1 and len(jobs) > 1:
+                self.puts("\n> Generating %s APIs, up to %s in parallel" % (
+                    len(jobs), max_parallel_apis))
+                pool = ThreadPoolExecutor(max_workers=max_parallel_apis)
+                try:
+                    futures = [
+                        pool.submit(self._generate_api, cell, index, api,
+                                    cache, True)
+                        for cell, index, api in jobs]
+                    statuses = [future.result() for future in futures]
+                finally:
+                    pool.shutdown()
+            else:
+                statuses = [self._generate_api(cell, index, api, cache, False)
+                            for cell, index, api in jobs]
+            for (cell, index, api), status in zip(jobs, statuses):
+                cell['statuses'].append(status)
+
+            self.run_command(['rm', '-rf', self._api_artifacts_path()])
+            with self.phase('close archive'):
+                for cell in cells:
+                    cell['archive'].close()
+        except Exception:
+            # No compressor process or partial archive is left behind
+            for cell in cells:
+                if cell.get('archive'):
+                    cell['archive'].abort()
+            raise
+        if cache:
+            self.puts("\n> Generation cache stats: %s" % cache.stats())
+        for cell in cells:
+            self._report_generation_summary(cell)
+        if matrix.get('googleapis_commits') or matrix.get('targets'):
+            self._report_matrix_summary(cells, commits)
+        return statuses
+
+    def _cell(self, name, repo_names, commits, apis):
+        output_path = self._guest.guest_output_dir_path()
+        if name:
+            output_path = self._guest.guest_output_dir_subpath(
+                [self._CELLS_DIR_NAME, name])
+            os.makedirs(output_path)
+        return {
+            'name': name,
+            'repo_names': repo_names,
+            'commits': commits,
+            'apis': apis,
+            'plan': None,
+            'output_path': output_path,
+            'statuses': []
+        }
+
+    def _matrix_cells(self, repo_names, commits, matrix):
         apis = self._config['artman_client_yaml_configs']
+        googleapis_commits = matrix.get('googleapis_commits') or [None]
+        targets = matrix.get('targets') or [None]
+        if matrix.get('googleapis_commits') and \
+                self._config['googleapis']['git_repo'].startswith('/'):
+            raise ValueError('Matrix googleapis commits cannot be checked out'
+                             ' in a locally mounted googleapis repository')
 
-        for api in apis:
-            path = self._guest.guest_client_yaml_file_path(api['path'])
-            api_name = path.partition('/artman_')[2].partition('.yaml')[0]
-
-            target = api['target'].split(',')
-            if len(target) == 1:
-                target.insert(0, 'generate')
-
-            args = [
-                '--root-dir',
-                self._guest.guest_root_subpath(repo_names['googleapis']),
-                '--config', self._guest.guest_root_subpath(api['path']),
-                '--output-dir',
-                self._guest.guest_output_dir_subpath('artifacts'),
-                '--local'
-            ]
-
-            verbose = ['-v'] if self._config['debug_mode'] else []
-            self.puts("\n> Generating API %s" % api_name)
+        cells = []
+        worktrees = {}
+        for googleapis_commit in googleapis_commits:
+            if googleapis_commit not in worktrees:
+                worktrees[googleapis_commit] = self._googleapis_worktree(
+                    repo_names, commits, googleapis_commit)
+            googleapis_name, googleapis_sha = worktrees[googleapis_commit]
+            cell_repo_names = dict(repo_names, googleapis=googleapis_name)
+            cell_commits = dict(commits, googleapis=googleapis_sha)
+            for target in targets:
+                name = '%02d-%s-%s' % (len(cells),
+                                       (googleapis_sha or 'unknown')[:8],
+                                       target or 'default')
+                cell_apis = [self._cell_api(api, repo_names, googleapis_name,
+                                            target) for api in apis]
+                cell = self._cell(name, cell_repo_names, cell_commits,
+                                  cell_apis)
+                cell['googleapis_commit'] = googleapis_sha
+                cell['target'] = target
+                cells.append(cell)
+
+        self.puts("\n> Generation matrix of %s cells:" % len(cells))
+        for cell in cells:
+            self.puts("  %s" % cell['name'], '\033[36m')
+        return cells
+
+    def _googleapis_worktree(self, repo_names, commits, googleapis_commit):
+        if not googleapis_commit:
+            return repo_names['googleapis'], commits['googleapis']
+
+        # Worktrees share the objects of the clone, nothing is cloned again
+        googleapis_path = self._guest.guest_root_subpath(
+            repo_names['googleapis'])
+        try:
+            self.check_command(
+                ['git', 'cat-file', '-e', '%s^{commit}' % googleapis_commit],
+                googleapis_path)
+        except subprocess.CalledProcessError:
+            self.run_command(['git', 'fetch', 'origin', googleapis_commit],
+                             googleapis_path)
+            googleapis_commit = 'FETCH_HEAD'
+        sha = self.check_command(
+            ['git', 'rev-parse', '%s^{commit}' % googleapis_commit],
+            googleapis_path).decode('UTF-8').strip()
+        if sha == commits['googleapis']:
+            return repo_names['googleapis'], sha
+
+        worktree_name = '%s-%s' % (repo_names['googleapis'], sha[:12])
+        worktree_path = self._guest.guest_root_subpath(worktree_name)
+        if not os.path.isdir(worktree_path):
             self.run_command(
-                ['python3', '-m', 'artman.cli.main'] + args + verbose + target,
-                self._guest.guest_root_subpath(repo_names['artman']))
+                ['git', 'worktree', 'add', '--detach', worktree_path, sha],
+                googleapis_path)
+        return worktree_name, sha
+
+    @staticmethod
+    def _cell_api(api, repo_names, googleapis_name, target):
+        cell_api = dict(api)
+        if target:
+            cell_api['target'] = target
+        # The path stays the same for the cache keys and the summary, only
+        # artman gets the config from the cell googleapis checkout
+        googleapis_prefix = repo_names['googleapis'] + '/'
+        api_path = os.path.normpath(api['path'])
+        if googleapis_name != repo_names['googleapis'] and \
+                api_path.startswith(googleapis_prefix):
+            cell_api['config_path'] = '%s/%s' % (
+                googleapis_name, api_path[len(googleapis_prefix):])
+        return cell_api
+
+    def _generate_api(self, cell, index, api, cache, buffered):
+        api_name = self._api_name(api)
+        if cell['name']:
+            api_name = '%s/%s' % (cell['name'], api_name)
+        with self.phase('api %s' % api_name):
+            return self._generate_api_output(cell, index, api, cache,
+                                             buffered)
+
+    def _generate_api_output(self, cell, index, api, cache, buffered):
+        repo_names, commits = cell['repo_names'], cell['commits']
+        plan, archive = cell['plan'], cell['archive']
+        api_name = self._api_name(api)
+        output_name = '%03d-%s' % (index, api_name)
+        if cell['name']:
+            output_name = '%s-%s' % (cell['name'], output_name)
+            api_name = '%s/%s' % (cell['name'], api_name)
+        api_output_path = self._guest.guest_output_dir_subpath(
+            ['api_artifacts', output_name])
+        cache_key = self._cache_key(api, commits) if cache else None
+        api_plan = plan.get(self._api_key(api)) if plan else None
+        cached, reused = False, False
+
+        if api_plan and api_plan['reuse']:
+            reused = self._extract_baseline_output(api_name, api_plan,
+                                                   api_output_path)
+
+        if reused:
+            succeeded = True
+        elif cache_key and cache.lookup(cache_key, api_output_path):
+            with self._output_lock:
+                self.puts("\n> Using cached output for API %s (key: %s)" % (
+                    api_name, cache_key))
+            succeeded, cached = True, True
+        else:
+            command, cwd = self._artman_command(repo_names, api,
+                                                api_output_path)
+            if buffered:
+                succeeded = self._run_artman_api_buffered(api_name, command,
+                                                          cwd)
+            else:
+                succeeded = self._run_artman_api(api_name, command, cwd)
+            if succeeded and cache_key and os.path.isdir(api_output_path):
+                entry_path = cache.store(cache_key, api_output_path)
+                if entry_path:
+                    self.change_file_permissions(entry_path)
+
+        outputs = []
+        if os.path.isdir(api_output_path):
+            with self.phase('fix output'):
+                self._fix_generator_output(api_output_path)
+            outputs = self._list_outputs(api_output_path)
+            # Archive the API output right away instead of after all APIs
+            with self.phase('archive'):
+                archive.add_tree(api_output_path)
+                shutil.rmtree(api_output_path)
+
+        status = self._api_status(api, succeeded)
+        status['cached'] = cached
+        status['reused'] = reused
+        status['outputs'] = outputs
+        if api_plan:
+            status['reason'] = api_plan['reason']
+        return status
+
+    def _run_artman_api(self, api_name, command, cwd):
+        self.puts("\n> Generating API %s" % api_name)
+        try:
+            self.run_command(command, cwd)
+        except subprocess.CalledProcessError as e:
+            self.puts("Generation of API %s failed: %s" % (api_name, e),
+                      '\033[1;31m')
+            return False
+        return True
+
+    def _run_artman_api_buffered(self, api_name, command, cwd):
+        returncode, output = self.run_buffered_command(command, cwd)
+
+        # Write the whole API log at once to not interleave it with others
+        with self._output_lock:
+            self.puts("\n> Generating API %s" % api_name)
+            self.puts(
+                "\033[1;30msubprocess.Popen(%s, cwd='%s')\033[0m" % (
+                    command, cwd))
+            sys.stdout.write(output)
+            if returncode:
+                self.puts("Generation of API %s failed with exit code %s" % (
+                    api_name, returncode), '\033[1;31m')
+
+        return returncode == 0
+
+    def _artman_command(self, repo_names, api, output_path):
+        target = api['target'].split(',')
+        if len(target) == 1:
+            target.insert(0, 'generate')
+
+        args = [
+            '--root-dir',
+            self._guest.guest_root_subpath(repo_names['googleapis']),
+            '--config', self._guest.guest_root_subpath(
+                api.get('config_path', api['path'])),
+            '--output-dir', output_path,
+            '--local'
+        ]
+
+        verbose = ['-v'] if self._config['debug_mode'] else []
+        command = ['python3', '-m', 'artman.cli.main'] + args + verbose + target
+        return command, self._guest.guest_root_subpath(repo_names['artman'])
+
+    def _api_artifacts_path(self):
+        return self._guest.guest_output_dir_subpath('api_artifacts')
+
+    def _generation_cache(self):
+        cache_config = self._config.get('generation_cache') or {}
+        if not cache_config.get('path'):
+            return None
+        if not self._config.get('docker_image_digest'):
+            self.puts('Generation cache is disabled: unknown docker image')
+            return None
+        for repo_name in ['artman', 'toolkit', 'googleapis']:
+            if self._config[repo_name]['git_repo'].startswith('/'):
+                self.puts('Generation cache is disabled: %s is mounted from'
+                          ' a local directory' % repo_name)
+                return None
+
+        max_size_bytes = int(cache_config['max_size_mb']) * 1024 * 1024
+        return GenerationCache(cache_config['path'], max_size_bytes)
+
+    def _resolve_commits(self, repo_names):
+        commits = {}
+        for repo_name in ['artman', 'toolkit', 'googleapis']:
+            try:
+                sha = self.check_command(
+                    ['git', 'rev-parse', 'HEAD'],
+                    self._guest.guest_root_subpath(repo_names[repo_name]))
+                commits[repo_name] = sha.decode('UTF-8').strip()
+            except subprocess.CalledProcessError:
+                commits[repo_name] = None
+        return commits
+
+    def _plan_incremental_generation(self, repo_names, commits, apis):
+        baseline = self._config.get('baseline')
+        if not baseline:
+            return None
+
+        self.puts("\n> Incremental generation against execution %s" %
+                  baseline['execution_id'])
+        baseline_apis = {}
+        for baseline_api in baseline.get('apis') or []:
+            baseline_apis[self._api_key(baseline_api)] = baseline_api
+
+        full_reason = self._incremental_full_reason(commits, baseline)
+        changed_paths = []
+        if not full_reason:
+            changed_paths = self._googleapis_changed_paths(
+                repo_names, baseline['commits']['googleapis'],
+                commits['googleapis'])
+            shared_paths = [p for p in changed_paths if self._is_shared(p)]
+            if shared_paths:
+                full_reason = 'shared googleapis file changed: %s' % \
+                              shared_paths[0]
+
+        plan = {}
+        for api in apis:
+            baseline_api = baseline_apis.get(self._api_key(api))
+            if full_reason:
+                reason = full_reason
+            elif not baseline_api:
+                reason = 'not generated in baseline'
+            elif baseline_api['status'] != 'success':
+                reason = 'failed in baseline'
+            else:
+                reason = self._api_change_reason(repo_names, api,
+                                                 changed_paths)
+            plan[self._api_key(api)] = {
+                'reuse': reason is None,
+                'reason': reason or 'unchanged since baseline',
+                'outputs': baseline_api['outputs'] if baseline_api else []
+            }
+
+        self.puts("\n> Incremental generation plan:")
+        for api in apis:
+            api_plan = plan[self._api_key(api)]
+            self.puts("  %-50s %-12s %s" % (
+                self._api_name(api),
+                'reuse' if api_plan['reuse'] else 'regenerate',
+                api_plan['reason']), '\033[36m')
+        self._extract_baseline_outputs(plan)
+        return plan
+
+    def _extract_baseline_outputs(self, plan):
+        # A single pass over the baseline archive for all the reused APIs,
+        # before the generation starts
+        baseline = self._config['baseline']
+        members = ['./%s' % output for api_plan in plan.values()
+                   if api_plan['reuse'] for output in api_plan['outputs']]
+        if baseline.get('sources_dir') or not members:
+            return
+        outputs_path = self._guest.guest_root_subpath('baseline_outputs')
+        os.makedirs(outputs_path)
+        try:
+            self.run_command(['tar', '-pxf', baseline['sources_zip'],
+                              '-C', outputs_path] + members)
+        except subprocess.CalledProcessError as e:
+            # The APIs with missing outputs are regenerated
+            self.puts("Could not extract all the baseline outputs: %s" % e,
+                      '\033[1;31m')
+        baseline['outputs_dir'] = outputs_path
+
+    def _incremental_full_reason(self, commits, baseline):
+        baseline_commits = baseline.get('commits') or {}
+        for repo_name in ['artman', 'toolkit', 'googleapis']:
+            if not commits[repo_name] or not baseline_commits.get(repo_name):
+                return '%s commit is unknown' % repo_name
+        for repo_name in ['artman', 'toolkit']:
+            if commits[repo_name] != baseline_commits[repo_name]:
+                return '%s commit changed' % repo_name
+        if self._config.get('docker_image_digest') != baseline.get(
+                'docker_image_digest'):
+            return 'docker image changed'
+        return None
+
+    def _googleapis_changed_paths(self, repo_names, baseline_commit, commit):
+        googleapis_path = self._guest.guest_root_subpath(
+            repo_names['googleapis'])
+        try:
+            self.check_command(
+                ['git', 'cat-file', '-e', '%s^{commit}' % baseline_commit],
+                googleapis_path)
+        except subprocess.CalledProcessError:
+            self.run_command(['git', 'fetch', 'origin', baseline_commit],
+                             googleapis_path)
+        diff = self.check_command(
+            ['git', 'diff', '--name-only', baseline_commit, commit],
+            googleapis_path)
+        return [p for p in diff.decode('UTF-8').split('\n') if p]
+
+    def _is_shared(self, changed_path):
+        if '/' not in changed_path:
+            return True
+        for shared_prefix in self._SHARED_GOOGLEAPIS_PATHS:
+            if changed_path.startswith(shared_prefix):
+                return True
+        return False
+
+    def _api_change_reason(self, repo_names, api, changed_paths):
+        googleapis_prefix = repo_names['googleapis'] + '/'
+        api_path = os.path.normpath(api['path'])
+        if api_path.startswith(googleapis_prefix):
+            api_path = api_path[len(googleapis_prefix):]
+        api_dir = os.path.dirname(api_path) + '/'
+
+        api_changed_paths = [p for p in changed_paths if p.startswith(api_dir)]
+        if not api_changed_paths:
+            return None
+        if len(api_changed_paths) == 1:
+            return 'changed: %s' % api_changed_paths[0]
+        return 'changed: %s (and %s more)' % (api_changed_paths[0],
+                                              len(api_changed_paths) - 1)
+
+    def _extract_baseline_output(self, api_name, api_plan, api_output_path):
+        with self._output_lock:
+            self.puts("\n> Reusing baseline output for API %s" % api_name)
+        if not api_plan['outputs']:
+            return True
+        outputs_dir = self._config['baseline'].get('outputs_dir')
+        sources_dir = self._config['baseline'].get('sources_dir')
+        try:
+            if outputs_dir:
+                # Extracted for this execution, the outputs are moved
+                for output in api_plan['outputs']:
+                    output_path = os.path.join(api_output_path, output)
+                    if not os.path.isdir(os.path.dirname(output_path)):
+                        os.makedirs(os.path.dirname(output_path))
+                    os.rename(os.path.join(outputs_dir, output), output_path)
+            else:
+                os.makedirs(api_output_path)
+                members = ['./%s' % output for output in api_plan['outputs']]
+                self.run_command(['cp', '-a', '--parents'] + members +
+                                 [api_output_path], cwd=sources_dir)
+                # Stored files are read-only
+                self.run_command(['chmod', '-R', 'u+w', api_output_path])
+        except (subprocess.CalledProcessError, OSError) as e:
+            with self._output_lock:
+                self.puts("Could not extract baseline output for API %s,"
+                          " regenerating it: %s" % (api_name, e),
+                          '\033[1;31m')
+            shutil.rmtree(api_output_path, ignore_errors=True)
+            return False
+        return True
+
+    @staticmethod
+    def _api_key(api):
+        return '%s:%s' % (os.path.normpath(api['path']), api['target'])
+
+    @staticmethod
+    def _list_outputs(output_path):
+        outputs = []
+        for entry in sorted(os.listdir(output_path)):
+            entry_path = os.path.join(output_path, entry)
+            if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+                outputs.extend('%s/%s' % (entry, sub_entry) for sub_entry in
+                               sorted(os.listdir(entry_path)))
+            else:
+                outputs.append(entry)
+        return outputs
+
+    def _cache_key(self, api, commits):
+        return GenerationCache.key(
+            commits['artman'], commits['toolkit'], commits['googleapis'],
+            api['path'], api['target'], self._config['docker_image_digest'])
+
+    def _api_name(self, api):
+        path = self._guest.guest_client_yaml_file_path(api['path'])
+        return path.partition('/artman_')[2].partition('.yaml')[0]
+
+    def _api_status(self, api, succeeded):
+        return {
+            'name': self._api_name(api),
+            'path': api['path'],
+            'target': api['target'],
+            'status': 'success' if succeeded else 'failure'
+        }
+
+    def _report_generation_summary(self, cell):
+        self.puts("\n> Generation summary%s:" % (
+            ' of %s' % cell['name'] if cell['name'] else ''))
+        for status in cell['statuses']:
+            color = '\033[32m' if status['status'] == 'success' \
+                else '\033[1;31m'
+            source = 'cached' if status['cached'] else \
+                'baseline' if status['reused'] else 'generated'
+            self.puts("  %-50s %-12s %-8s %s" % (
+                status['name'], status['target'], status['status'], source),
+                      color)
+
+        summary = {
+            'commits': cell['commits'],
+            'docker_image_digest': self._config.get('docker_image_digest'),
+            'apis': cell['statuses']
+        }
+        summary_path = os.path.join(cell['output_path'],
+                                    ConfigUtils.artifact_yaml_name())
+        ConfigUtils.dump_config(summary, summary_path)
+
+    def _report_matrix_summary(self, cells, commits):
+        compression = self._config.get('artifact_compression', 'gzip')
+        summary_cells = []
+        for cell in cells:
+            failed = [s for s in cell['statuses'] if s['status'] != 'success']
+            summary_cells.append({
+                'name': cell['name'],
+                'googleapis_commit': cell['googleapis_commit'],
+                'target': cell['target'],
+                'status': 'failure' if failed else 'success',
+                'artifact': '/'.join([self._CELLS_DIR_NAME, cell['name'],
+                                      ConfigUtils.artifact_name(compression)]),
+                'apis': len(cell['statuses']),
+                'failed_apis': len(failed)
+            })
+        summary = {
+            'commits': commits,
+            'docker_image_digest': self._config.get('docker_image_digest'),
+            'cells': summary_cells
+        }
+        summary_path = self._guest.guest_output_dir_subpath(
+            ConfigUtils.artifact_yaml_name())
+        ConfigUtils.dump_config(summary, summary_path)
+
+    def _check_generation_summary(self, statuses):
+        failed = sorted(set(s['name'] for s in statuses
+                            if s['status'] != 'success'))
+        if failed:
+            raise RuntimeError(
+                'Generation failed for APIs: %s' % ', '.join(failed))
 
-    def _archive_artifacts(self):
-        self.run_command(['tar', '-pzcf', 'artifacts.tar.gz',
-                          '--remove-files', '-C', 'artifacts', '.'],
-                         self._guest.guest_output_dir_path())
-        self.change_file_permissions(
-            self._guest.guest_output_dir_subpath('artifacts.tar.gz'))
+    def _open_archive(self, output_path):
+        compression = self._config.get('artifact_compression', 'gzip')
+        archive_path = os.path.join(output_path,
+                                    ConfigUtils.artifact_name(compression))
+        self.puts("\n> Streaming generated sources to %s" % archive_path)
+        return StreamingArchive(
+            archive_path, compression, manifest_path=os.path.join(
+                output_path, ConfigUtils.artifact_manifest_name()))
 
     # TODO: this is a hack, should be fixed in artman instead
     #       (must be a way to configure output path)
-    def _fix_generator_output(self):
-        art_sub = ['artifacts', 'java']
+    def _fix_generator_output(self, output_path):
         lr_dir = 'gapic-google-cloud-longrunning-v1'
-        lr_path = self._guest.guest_output_dir_subpath(art_sub + [lr_dir])
+        lr_path = os.path.join(output_path, 'java', lr_dir)
         if os.path.exists(lr_path):
             new_lr_dir = 'gapic-google-longrunning-v1'
-            cwd = self._guest.guest_output_dir_subpath(art_sub)
+            cwd = os.path.join(output_path, 'java')
             self.run_command(['mv', lr_dir, new_lr_dir], cwd)
 
 
@@ -12,40 +12,211 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import subprocess
 import os
 import copy
 
-from artmanflow.steps.common import HostStepProperties, ConfigUtils, BaseHost
+from artmanflow.steps.artifact_store import ArtifactStore
+from artmanflow.steps.common import HostStepProperties, ConfigUtils, \
+    BaseHost, DockerUtils, GitUtils
+from artmanflow.steps.git_mirrors import GitMirrorCache
+from artmanflow.steps.guest_images import GuestImageCache
+from artmanflow.steps.image_pulls import ImagePullManager
 
 
 class SourcesGenerationHost(BaseHost):
+    # Reinstalls artman and removes the preinstalled repositories
+    GUEST_MUTATES_CONTAINER = True
+
     def __init__(self, config):
         BaseHost.__init__(self, SourcesGenerationHost.host_step_properties(
             config['execution_id']), config)
 
     def execute(self):
-        self._pull_docker_image()
-        self._generate_sources_in_guest()
+        if self._is_sharded():
+            self._generate_sources_in_shards()
+        else:
+            self._pull_docker_image()
+            self._generate_sources_in_guest()
         return self._host.execution_id()
 
+    def _is_sharded(self):
+        sharding = self._config.get('sharding') or {}
+        if not sharding.get('workers') or \
+                len(self._config['artman_client_yaml_configs']) < 2:
+            return False
+
+        reason = None
+        if self._config.get('baseline_execution_id'):
+            reason = 'the baseline execution is not available on workers'
+        elif (self._config.get('matrix') or {}).get('googleapis_commits') or \
+                (self._config.get('matrix') or {}).get('targets'):
+            reason = 'batch matrix executions are not sharded'
+        elif any(self._local_repo_mounts().values()):
+            reason = 'local repositories are not available on workers'
+        elif any('git_security_token' in self._config[repo_name]
+                 for repo_name in ['artman', 'toolkit', 'googleapis']):
+            reason = 'git security tokens are not sent to workers'
+        if reason:
+            self._log('Sharding is disabled: %s' % reason)
+            return False
+        return True
+
+    def _generate_sources_in_shards(self):
+        config = copy.deepcopy(self._config)
+        # All the shards must generate from the same commits
+        for repo_name in ['artman', 'toolkit', 'googleapis']:
+            commit = GitUtils.resolve_commit(config[repo_name])
+            if commit:
+                config[repo_name]['git_commit'] = commit
+        self.run_host_script('shard_coordinator.py', config)
+
     def _pull_docker_image(self):
+        ttl_seconds = int(self._config.get('docker_pull_ttl_seconds', 0))
         with open(self._host.stdout_file_path(), 'a') as output_file:
-            subprocess.call(['docker', 'pull', self._config['docker_image']],
-                            stdout=output_file, stderr=output_file)
+            ImagePullManager.pull(self._config['docker_image'], output_file,
+                                  ttl_seconds)
         return self._host.execution_id()
 
     def _generate_sources_in_guest(self):
         guest_config = copy.deepcopy(self._config)
+        # The guest prints its config, the worker token stays on the host
+        guest_config.pop('sharding', None)
         mounts = self._local_repo_mounts()
+        image_digest = DockerUtils.image_digest(self._config['docker_image'])
+        with self._guest_image(guest_config, mounts, image_digest):
+            self._run_guest(guest_config, mounts, image_digest)
+            # The cached guest image is used by the container from now on
+            self.wait_container_created()
+
+    def _run_guest(self, guest_config, mounts, image_digest):
         extra_mounts = []
         for repo_name, repo_mounts in mounts.items():
             if repo_mounts:
                 guest_config[repo_name]['git_repo'] = repo_mounts[1]
                 extra_mounts.append(repo_mounts)
 
+        if image_digest:
+            guest_config['docker_image_digest'] = image_digest
+
+        cache_mount = self._generation_cache_mount()
+        if cache_mount:
+            guest_config['generation_cache']['path'] = cache_mount[1]
+            extra_mounts.append(cache_mount)
+
+        extra_mounts.extend(self._git_mirror_mounts(guest_config, mounts))
+        extra_mounts.extend(self._baseline_mounts(guest_config))
+
         self.run_guest_script(guest_config, extra_mounts)
 
+    def _generation_cache_mount(self):
+        cache_config = self._config.get('generation_cache') or {}
+        host_cache_path = cache_config.get('path')
+        if not host_cache_path:
+            return []
+        if not os.path.isdir(host_cache_path):
+            os.makedirs(host_cache_path)
+        return [host_cache_path,
+                self._guest.guest_root_subpath('generation_cache')]
+
+    @contextlib.contextmanager
+    def _guest_image(self, guest_config, local_mounts, image_digest):
+        image_cache_config = self._config.get('guest_image_cache') or {}
+        if not image_cache_config.get('enabled') or not image_digest or any(
+                local_mounts[repo_name] or
+                'git_security_token' in self._config[repo_name]
+                for repo_name in ['artman', 'toolkit']):
+            yield
+            return
+
+        image_cache = GuestImageCache(int(image_cache_config['max_images']))
+        with open(self._host.stdout_file_path(), 'a') as output_file:
+            with image_cache.use_image(
+                    self._config['docker_image'], image_digest,
+                    self._config['artman'], self._config['toolkit'],
+                    output_file) as image_tag:
+                if image_tag:
+                    self._docker_image = image_tag
+                    guest_config['preinstalled_components'] = \
+                        GuestImageCache.components_paths()
+                yield
+
+    def _baseline_mounts(self, guest_config):
+        baseline_execution_id = self._config.get('baseline_execution_id')
+        if not baseline_execution_id:
+            return []
+
+        baseline_props = SourcesGenerationHost.host_step_properties(
+            baseline_execution_id)
+        art_name = ConfigUtils.find_artifact(baseline_props)
+        store_config = self._config.get('artifact_store') or {}
+        store = ArtifactStore(store_config['path']) \
+            if store_config.get('path') else None
+        stored = store is not None and store.has_manifest(
+            baseline_execution_id)
+        host_summary_path = baseline_props.host_guest_output_dir_subpath(
+            ConfigUtils.artifact_yaml_name())
+        if not (art_name or stored) or not os.path.isfile(host_summary_path):
+            with open(self._host.stdout_file_path(), 'a') as output_file:
+                output_file.write(
+                    'Baseline execution %s has no artifacts, all APIs will be'
+                    ' regenerated\n' % baseline_execution_id)
+            return []
+
+        summary = ConfigUtils.read_config(host_summary_path)
+        guest_config['baseline'] = {
+            'execution_id': baseline_execution_id,
+            'commits': summary.get('commits'),
+            'docker_image_digest': summary.get('docker_image_digest'),
+            'apis': summary.get('apis')
+        }
+        if not art_name:
+            # Only the store manifest is left, link the stored files instead
+            # of unpacking an archive
+            host_sources_path = os.path.join(self._host.temp_path(),
+                                             'baseline_sources')
+            if not os.path.isdir(host_sources_path):
+                store.materialize(baseline_execution_id, host_sources_path)
+            guest_sources_path = self._guest.guest_root_subpath(
+                'baseline_sources')
+            guest_config['baseline']['sources_dir'] = guest_sources_path
+            return [[host_sources_path, guest_sources_path, 'ro']]
+
+        host_art_path = baseline_props.host_guest_output_dir_subpath(art_name)
+        guest_art_path = self._guest.guest_root_subpath('baseline_' + art_name)
+        guest_config['baseline']['sources_zip'] = guest_art_path
+        return [[host_art_path, guest_art_path, 'ro']]
+
+    def _git_mirror_mounts(self, guest_config, local_mounts):
+        mirrors_config = self._config.get('git_mirrors') or {}
+        if not mirrors_config.get('path'):
+            return []
+
+        mirrors = GitMirrorCache(mirrors_config['path'])
+        guest_mirrors_path = self._guest.guest_root_subpath('git_mirrors')
+        mirrored = False
+        with open(self._host.stdout_file_path(), 'a') as output_file:
+            for repo_name, repo_mounts in local_mounts.items():
+                if repo_mounts or repo_name in guest_config.get(
+                        'preinstalled_components', {}):
+                    continue
+                try:
+                    mirrors.update(self._config[repo_name], output_file)
+                except subprocess.CalledProcessError as e:
+                    output_file.write(
+                        'Could not update %s mirror, cloning without it: %s\n'
+                        % (repo_name, e))
+                    continue
+                guest_config[repo_name]['git_reference'] = '/'.join(
+                    [guest_mirrors_path,
+                     mirrors.mirror_name(self._config[repo_name])])
+                mirrored = True
+
+        if not mirrored:
+            return []
+        return [[mirrors.path(), guest_mirrors_path, 'ro']]
+
     def _local_repo_mounts(self):
         config = self._config
         mounts = {
@@ -0,0 +1,217 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import threading
+import time
+
+from ruamel import yaml
+
+try:
+    from metrics import EXECUTIONS, PHASE_DURATION
+except ImportError:
+    from artmanflow.steps.metrics import EXECUTIONS, PHASE_DURATION
+
+
+class ExecutionSupervisor(object):
+    # Supervisors of the executions started by this process
+    _supervisors = {}
+    _supervisors_lock = threading.Lock()
+
+    STATUS_FILE_NAME = 'execution.yaml'
+
+    FINISHED_STATUSES = ['succeeded', 'failed', 'cancelled', 'timed_out']
+
+    _POLL_INTERVAL_SECONDS = 1
+
+    _STOP_GRACE_SECONDS = 10
+
+    def __init__(self, execution_id, execution_path, timeout_seconds=0,
+        catalog=None, details=None):
+        self._execution_id = execution_id
+        self._status_path = os.path.join(execution_path,
+                                         self.STATUS_FILE_NAME)
+        self._timeout_seconds = timeout_seconds
+        self._catalog = catalog
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._process = None
+        self._container_id_func = None
+        self._stop_time = None
+        self._status = {'execution_id': execution_id, 'status': 'pending'}
+        self._status.update(details or {})
+
+    @staticmethod
+    def find(execution_id):
+        with ExecutionSupervisor._supervisors_lock:
+            return ExecutionSupervisor._supervisors.get(execution_id)
+
+    @staticmethod
+    def running_count():
+        with ExecutionSupervisor._supervisors_lock:
+            supervisors = list(ExecutionSupervisor._supervisors.values())
+        return len([s for s in supervisors if s._process and
+                    s._process.poll() is None])
+
+    @staticmethod
+    def read_status(execution_path):
+        status_path = os.path.join(execution_path,
+                                   ExecutionSupervisor.STATUS_FILE_NAME)
+        if not os.path.isfile(status_path):
+            return None
+        with open(status_path) as status_file:
+            return yaml.safe_load(status_file)
+
+    @staticmethod
+    def is_finished(status):
+        return bool(status) and \
+            status.get('status') in ExecutionSupervisor.FINISHED_STATUSES
+
+    def register(self):
+        with ExecutionSupervisor._supervisors_lock:
+            ExecutionSupervisor._supervisors[self._execution_id] = self
+        with self._lock:
+            self._status.setdefault('submitted_at', time.time())
+            self._write_status()
+
+    def is_cancelled(self):
+        with self._lock:
+            return self._cancelled
+
+    def started(self, process, container_id_func):
+        with self._lock:
+            self._process = process
+            self._container_id_func = container_id_func
+            self._status['status'] = 'running'
+            self._status['start_time'] = time.time()
+            self._write_status()
+
+    def wait(self):
+        timed_out = False
+        while self._process.poll() is None:
+            with self._lock:
+                self._update_container_id()
+                duration = time.time() - self._status['start_time']
+                if self._timeout_seconds and \
+                        duration > self._timeout_seconds:
+                    timed_out = True
+                stop = self._cancelled or timed_out
+            if stop:
+                self._stop()
+            time.sleep(self._POLL_INTERVAL_SECONDS)
+
+        with self._lock:
+            self._update_container_id()
+            exit_code = self._process.returncode
+            if self._cancelled:
+                status = 'cancelled'
+            elif timed_out:
+                status = 'timed_out'
+            else:
+                status = 'failed' if exit_code else 'succeeded'
+            end_time = time.time()
+            self._status.update({
+                'status': status,
+                'exit_code': exit_code,
+                'end_time': end_time,
+                'duration_seconds': round(
+                    end_time - self._status['start_time'], 3)
+            })
+            self._write_status()
+        step = self._status.get('step_type')
+        EXECUTIONS.inc(step=step, status=status)
+        PHASE_DURATION.observe(self._status['duration_seconds'], step=step,
+                               phase='guest')
+        self._unregister()
+        return exit_code
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if not self._process:
+                # Not started yet, run_guest_script() will skip it
+                self._status['status'] = 'cancelled'
+                self._write_status()
+                return True
+            self._update_container_id()
+        self._stop()
+        return True
+
+    def finish_failed(self, error):
+        # The host step raised before or while its guest was running
+        with self._lock:
+            if self._status['status'] in self.FINISHED_STATUSES:
+                return
+            process = self._process
+            end_time = time.time()
+            self._status.update({
+                'status': 'failed',
+                'exit_code': 1,
+                'error': str(error),
+                'end_time': end_time,
+                'duration_seconds': round(end_time - self._status.get(
+                    'start_time', end_time), 3)
+            })
+            self._write_status()
+        if process and process.poll() is None:
+            process.kill()
+        EXECUTIONS.inc(step=self._status.get('step_type'), status='failed')
+        self._unregister()
+
+    def finish_cancelled(self):
+        # The execution was cancelled before its guest process was started
+        EXECUTIONS.inc(step=self._status.get('step_type'), status='cancelled')
+        self._unregister()
+
+    def _stop(self):
+        with self._lock:
+            container_id = self._status.get('container_id')
+            process = self._process
+            if self._stop_time is None:
+                self._stop_time = time.time()
+            # Processes get a chance to clean up before they are killed
+            force = time.time() - self._stop_time > self._STOP_GRACE_SECONDS
+        if container_id:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(['docker', 'kill', container_id],
+                                stdout=devnull, stderr=devnull)
+        elif process and process.poll() is None:
+            if force:
+                process.kill()
+            else:
+                process.terminate()
+
+    def _update_container_id(self):
+        if self._container_id_func and 'container_id' not in self._status:
+            container_id = self._container_id_func()
+            if container_id:
+                self._status['container_id'] = container_id
+                self._write_status()
+
+    def _unregister(self):
+        with ExecutionSupervisor._supervisors_lock:
+            if ExecutionSupervisor._supervisors.get(
+                    self._execution_id) is self:
+                del ExecutionSupervisor._supervisors[self._execution_id]
+
+    def _write_status(self):
+        if self._catalog:
+            self._catalog.update(self._execution_id, self._status)
+        if not os.path.isdir(os.path.dirname(self._status_path)):
+            return
+        with open(self._status_path + '.tmp', 'w') as status_file:
+            yaml.safe_dump(self._status, status_file,
+                           default_flow_style=False)
+        os.rename(self._status_path + '.tmp', self._status_path)
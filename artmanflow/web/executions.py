@@ -0,0 +1,73 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from flask import Blueprint, jsonify, render_template, request
+
+from artmanflow.web.service_utils import ServiceUtils
+
+executions = Blueprint('executions', __name__, url_prefix='/executions')
+
+_MAX_PER_PAGE = 500
+
+
+@executions.route('')
+def executions_list():
+    page, per_page, rows = _list_executions()
+    for row in rows:
+        row['output_link'] = '/%s/%s' % (
+            (row['step_type'] or '').replace('_', '-'), row['execution_id'])
+        row['submitted'] = _format_time(row['submitted_at'])
+    filters = dict((k, v) for k, v in _filters().items() if v)
+    return render_template('executions.html', executions=rows, page=page,
+                           per_page=per_page, filters=filters,
+                           has_next=len(rows) == per_page)
+
+
+@executions.route('/json')
+def executions_json():
+    page, per_page, rows = _list_executions()
+    return jsonify({'executions': rows, 'page': page, 'per_page': per_page,
+                    'has_next': len(rows) == per_page})
+
+
+def _list_executions():
+    page = max(1, _int_arg('page', 1))
+    per_page = min(_MAX_PER_PAGE, max(1, _int_arg('per_page', 50)))
+    rows = ServiceUtils.execution_catalog().list(
+        limit=per_page, offset=(page - 1) * per_page, **_filters())
+    return page, per_page, rows
+
+
+def _filters():
+    return {
+        'step_type': request.args.get('step_type') or None,
+        'status': request.args.get('status') or None,
+        'config_hash': request.args.get('config_hash') or None,
+        'git_commit': request.args.get('git_commit') or None
+    }
+
+
+def _int_arg(name, default):
+    try:
+        return int(request.args.get(name, default))
+    except ValueError:
+        return default
+
+
+def _format_time(timestamp):
+    if not timestamp:
+        return ''
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
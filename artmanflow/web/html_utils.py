@@ -12,92 +12,287 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import difflib
+import json
+import os
 import re
 
+from html import escape
+
+
+class AnsiHtmlConverter(object):
+    _ESCAPE_REGEX = re.compile(r'\033\[([0-9;]*)([@-~])')
+
+    # An escape sequence split between two chunks
+    _PARTIAL_ESCAPE_REGEX = re.compile(r'\033(\[[0-9;]*)?$')
+
+    _BASE_COLORS = [
+        '#000000', '#CD0000', '#00CD00', '#C4A000',
+        '#0000EE', '#CD00CD', '#00CCCC', '#AAAAAA',
+        '#555555', '#FF0000', '#00FF00', '#FFFF00',
+        '#5C5CFF', '#FF00FF', '#00FFFF', '#FFFFFF'
+    ]
+
+    _CUBE_LEVELS = [0, 95, 135, 175, 215, 255]
+
+    _RESET_STATE = (False, False, False, None, None)
+
+    def __init__(self, state=None):
+        # (bold, italic, underline, foreground, background), colors are
+        # either a 256-color palette index or an (r, g, b) tuple
+        self._state = self._RESET_STATE
+        self._pending = ''
+        self._styles = {}
+        self._open_tags = {}
+        self._transitions = {}
+        self._states = {self._RESET_STATE: self._RESET_STATE}
+        if state:
+            self._state = self._transition(self._state, state)
+
+    def convert(self, text):
+        text = self._pending + text
+        self._pending = ''
+        partial = self._PARTIAL_ESCAPE_REGEX.search(text)
+        if partial:
+            self._pending = partial.group(0)
+            text = text[:partial.start()]
+
+        # Escaping does not touch the escape sequences, so the whole chunk
+        # is escaped at once; split() then alternates text, params and the
+        # final byte of each sequence
+        parts = self._ESCAPE_REGEX.split(escape(text, False))
+        res = []
+        append = res.append
+        transitions = self._transitions
+        state = self._state
+        span_state = self._RESET_STATE
+        for part, params, final in zip(parts[::3], [None] + parts[1::3],
+                                       [None] + parts[2::3]):
+            if final == 'm':
+                next_state = transitions.get((state, params))
+                if next_state is None:
+                    next_state = self._transition(state, params)
+                state = next_state
+            if not part:
+                continue
+            # Runs with the same style are merged into a single span
+            if state is not span_state:
+                if span_state is not self._RESET_STATE:
+                    append('</span>')
+                if state is not self._RESET_STATE:
+                    append(self._open_tag(state))
+                span_state = state
+            append(part)
+        if span_state is not self._RESET_STATE:
+            append('</span>')
+        self._state = state
+        return ''.join(res)
+
+    def state(self):
+        bold, italic, underline, fg, bg = self._state
+        params = []
+        if bold:
+            params.append('1')
+        if italic:
+            params.append('3')
+        if underline:
+            params.append('4')
+        if fg is not None:
+            params.append(self._color_params(38, fg))
+        if bg is not None:
+            params.append(self._color_params(48, bg))
+        return ';'.join(params)
+
+    def _transition(self, state, params):
+        new_state = self._apply_sgr(state, params)
+        # States are interned, so they can be compared by identity
+        new_state = self._states.setdefault(new_state, new_state)
+        self._transitions[(state, params)] = new_state
+        return new_state
+
+    def _apply_sgr(self, state, params):
+        bold, italic, underline, fg, bg = state
+        codes = [int(c) if c else 0 for c in params.split(';')]
+        i = 0
+        while i < len(codes):
+            code = codes[i]
+            i += 1
+            if code == 0:
+                bold, italic, underline, fg, bg = self._RESET_STATE
+            elif code == 1:
+                bold = True
+            elif code == 3:
+                italic = True
+            elif code == 4:
+                underline = True
+            elif code == 22:
+                bold = False
+            elif code == 23:
+                italic = False
+            elif code == 24:
+                underline = False
+            elif 30 <= code <= 37:
+                fg = code - 30
+            elif 90 <= code <= 97:
+                fg = code - 90 + 8
+            elif code == 39:
+                fg = None
+            elif 40 <= code <= 47:
+                bg = code - 40
+            elif 100 <= code <= 107:
+                bg = code - 100 + 8
+            elif code == 49:
+                bg = None
+            elif code in (38, 48):
+                color, i = self._read_extended_color(codes, i)
+                if code == 38:
+                    fg = color
+                else:
+                    bg = color
+        return bold, italic, underline, fg, bg
+
+    @staticmethod
+    def _read_extended_color(codes, i):
+        if i < len(codes) and codes[i] == 5 and i + 1 < len(codes):
+            return codes[i + 1] % 256, i + 2
+        if i < len(codes) and codes[i] == 2 and i + 3 < len(codes):
+            return tuple(c % 256 for c in codes[i + 1:i + 4]), i + 4
+        return None, len(codes)
+
+    @staticmethod
+    def _color_params(code, color):
+        if isinstance(color, tuple):
+            return '%s;2;%s;%s;%s' % ((code,) + color)
+        return '%s;5;%s' % (code, color)
+
+    def _open_tag(self, state):
+        tag = self._open_tags.get(state)
+        if tag is None:
+            tag = "<span style='%s'>" % self._style(state)
+            self._open_tags[state] = tag
+        return tag
+
+    def _style(self, state):
+        style = self._styles.get(state)
+        if style is None:
+            bold, italic, underline, fg, bg = state
+            # Bold black is rendered as dark gray, like most terminals do
+            if bold and fg == 0:
+                fg = 8
+            style = ''.join([
+                'color:%s;' % self._css_color(fg) if fg is not None else '',
+                'background-color:%s;' % self._css_color(bg)
+                if bg is not None else '',
+                'font-weight:bold;' if bold else '',
+                'font-style:italic;' if italic else '',
+                'text-decoration:underline;' if underline else ''
+            ])
+            self._styles[state] = style
+        return style
+
+    @staticmethod
+    def _css_color(color):
+        if isinstance(color, tuple):
+            return '#%02X%02X%02X' % color
+        if color < 16:
+            return AnsiHtmlConverter._BASE_COLORS[color]
+        if color < 232:
+            levels = AnsiHtmlConverter._CUBE_LEVELS
+            color -= 16
+            return '#%02X%02X%02X' % (levels[color // 36],
+                                      levels[color // 6 % 6],
+                                      levels[color % 6])
+        gray = 8 + (color - 232) * 10
+        return '#%02X%02X%02X' % (gray, gray, gray)
+
+
 class HtmlUtils:
     def __init__(self):
         pass
 
-    _COLOR_REGEX = r'(\033\[\d*;*\d*m)'
-
-    _COLOR_STYLE_MAP = {
-        "\033[30m": "color:#000000;",
-        "\033[0;30m": "color:#000000;",
-        "\033[30;0m": "color:#000000;",
-        "\033[31m": " color:#CD0000;",
-        "\033[0;31m": "color:#CD0000;",
-        "\033[31;0m": "color:#CD0000;",
-        "\033[32m": "color:#00CD00;",
-        "\033[0;32m": "color:#00CD00;",
-        "\033[32;0m": "color:#00CD00;",
-        "\033[33m": "color:#C4A000;",
-        "\033[0;33m": "color:#C4A000;",
-        "\033[33;0m": "color:#C4A000;",
-        "\033[34m": "color:#0000EE;",
-        "\033[0;34m": "color:#0000EE;",
-        "\033[34;0m": "color:#0000EE;",
-        "\033[35m": "color:#CD00CD;",
-        "\033[0;35m": "color:#CD00CD;",
-        "\033[35;0m": "color:#CD00CD;",
-        "\033[36m": "color:#00CCCC;",
-        "\033[0;36m": "color:#00CCCC;",
-        "\033[36;0m": "color:#00CCCC;",
-        "\033[37m": "color:#AAAAAA;",
-        "\033[0;37m": "color:#AAAAAA;",
-        "\033[37;0m": "color:#AAAAAA;",
-        "\033[m": " ",
-        "\033[0m": " ",
-        "\033[1;30m": "color:#555555;font-weight:bold",
-        "\033[30;1m": "color:#555555;font-weight:bold",
-        "\033[1;31m": "color:#CD0000;font-weight:bold",
-        "\033[31;1m": "color:#CD0000;font-weight:bold",
-        "\033[1;32m": "color:#00CD00;font-weight:bold",
-        "\033[32;1m": "color:#00CD00;font-weight:bold",
-        "\033[1;33m": "color:#C4A000;font-weight:bold",
-        "\033[33;1m": "color:#C4A000;font-weight:bold",
-        "\033[1;34m": "color:#0000EE;font-weight:bold",
-        "\033[34;1m": "color:#0000EE;font-weight:bold",
-        "\033[1;35m": "color:#CD00CD;font-weight:bold",
-        "\033[35;1m": "color:#CD00CD;font-weight:bold",
-        "\033[1;36m": "color:#00CCCC;font-weight:bold",
-        "\033[36;1m": "color:#00CCCC;font-weight:bold",
-        "\033[1;37m": "color:#AAAAAA;font-weight:bold",
-        "\033[37;1m": "color:#AAAAAA;font-weight:bold",
-    }
+    _READ_CHUNK_SIZE = 1024 * 1024
 
     @staticmethod
     def generate_html_from_console_output(file_path):
+        converter = AnsiHtmlConverter()
         with open(file_path, 'r') as fl:
             yield '<pre>'
-            color_regex = re.compile(HtmlUtils._COLOR_REGEX)
-            for line in fl:
-                yield HtmlUtils._read_line(color_regex, line)
+            while True:
+                chunk = fl.read(HtmlUtils._READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield converter.convert(chunk)
             yield '</pre>'
-            # yield '</body></html>'
 
     @staticmethod
-    def generate_output_link(file_url, link_name):
-        yield "<p><a href='%s'>%s</a></p>" % (file_url, link_name)
+    def generate_html_from_console_text(text, converter=None):
+        converter = converter or AnsiHtmlConverter()
+        return '<pre>%s</pre>' % converter.convert(text)
 
     @staticmethod
-    def _read_line(regex, line):
-        split_line = regex.split(line)
-        split_len = len(split_line)
+    def generate_waterfall_html(timings_path, max_rows=500):
+        if not os.path.isfile(timings_path):
+            return ''
+        with open(timings_path) as timings_file:
+            root = json.load(timings_file)
+        start = root['start']
+        total = max(root.get('duration') or 0, 0.001)
 
-        res = []
-        for i in range(0, split_len, 2):
-            res.append(split_line[i])
+        rows = []
+        nodes = [(root, 0)]
+        while nodes and len(rows) < max_rows:
+            node, depth = nodes.pop()
+            offset = (node['start'] - start) * 100.0 / total
+            width = max((node.get('duration') or 0) * 100.0 / total, 0.1)
+            bar_class = 'waterfall-bar'
+            if node.get('failed'):
+                bar_class += ' failed'
+            elif node.get('kind') == 'command':
+                bar_class += ' command'
+            rows.append(
+                "<div class='waterfall-row'>"
+                "<span class='waterfall-name' style='padding-left:%spx'"
+                " title='%s'>%s</span>"
+                "<span class='waterfall-track'><span class='%s'"
+                " style='left:%.2f%%;width:%.2f%%'></span></span>"
+                "<span class='waterfall-duration'>%.2fs</span></div>" % (
+                    depth * 12, escape(node['name']), escape(node['name']),
+                    bar_class, offset, min(width, 100 - offset),
+                    node.get('duration') or 0))
+            for child in reversed(node.get('children', [])):
+                nodes.append((child, depth + 1))
+        return "<div class='waterfall'>%s</div>" % ''.join(rows)
 
-            if i + 1 < split_len:
-                style = HtmlUtils._COLOR_STYLE_MAP.get(split_line[i + 1])
-                if style:
-                    res.append("</pre><pre style='display:inline;%s'>" % style)
-                else:
-                    res.append(split_line[i + 1])
+    @staticmethod
+    def generate_text_diff_html(path, old_data, new_data, max_lines=2000):
+        if old_data is None or new_data is None:
+            return "<pre class='diff'>File is too big to compare</pre>"
+        try:
+            old_lines = old_data.decode('UTF-8').splitlines()
+            new_lines = new_data.decode('UTF-8').splitlines()
+        except UnicodeDecodeError:
+            return "<pre class='diff'>Binary files differ</pre>"
 
-        if split_len > 1:
-            last_token = split_line[split_len - 1]
-            if not last_token or last_token.isspace():
-                res.append('\n')
+        lines = []
+        for line in difflib.unified_diff(old_lines, new_lines, 'a/' + path,
+                                         'b/' + path, lineterm=''):
+            if len(lines) >= max_lines:
+                lines.append("<span class='diff-hunk'>...</span>")
+                break
+            line_class = None
+            if line.startswith('@@'):
+                line_class = 'diff-hunk'
+            elif line.startswith('+') and not line.startswith('+++'):
+                line_class = 'diff-added'
+            elif line.startswith('-') and not line.startswith('---'):
+                line_class = 'diff-removed'
+            if line_class:
+                lines.append("<span class='%s'>%s</span>" % (line_class,
+                                                             escape(line)))
+            else:
+                lines.append(escape(line))
+        return "<pre class='diff'>%s</pre>" % '\n'.join(lines)
 
-        return ''.join(res)
+    @staticmethod
+    def generate_output_link(file_url, link_name):
+        yield "<p><a href='%s'>%s</a></p>" % (file_url, link_name)
@@ -11,10 +11,19 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from flask import Flask, render_template
+import os
+import signal
+import sys
 
+from flask import Flask, Response, render_template
+
+from artmanflow.steps.metrics import QUEUED_EXECUTIONS, REGISTRY, \
+    RUNNING_EXECUTIONS, RUNNING_GUESTS
+from artmanflow.steps.supervisor import ExecutionSupervisor
+from artmanflow.web.executions import executions
 from artmanflow.web.sources_generation import src_gen
 from artmanflow.web.java_sources_staging import java_src_staging
+from artmanflow.web.scheduler import StepScheduler
 
 app = Flask(__name__)
 
@@ -33,11 +42,37 @@ app.register_blueprint(java_src_staging)
 
 # Step 6: Stage Artifacts
 
+# Executions catalog
+app.register_blueprint(executions)
+
+
 @app.route('/')
 @app.route('/index.html')
 def index():
     return render_template('index.html')
 
 
+@app.route('/metrics')
+def metrics():
+    # Gauges are sampled on scrape, the rest is collected as steps finish
+    stats = StepScheduler.stats()
+    RUNNING_EXECUTIONS.reset(
+        [({'step': step}, running) for step, (running, _) in stats.items()])
+    QUEUED_EXECUTIONS.reset(
+        [({'step': step}, queued) for step, (_, queued) in stats.items()])
+    RUNNING_GUESTS.set(ExecutionSupervisor.running_count())
+    return Response(REGISTRY.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 if __name__ == "__main__":
-    app.run(debug=True)
+    # Exit normally on SIGTERM, so that the pooled containers are removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Sharding workers are started on other ports or interfaces
+    host = os.getenv('ARTMANFLOW_HOST', '127.0.0.1')
+    # The Werkzeug debugger runs arbitrary code, it is never exposed to
+    # other hosts
+    debug = host in ('127.0.0.1', 'localhost', '::1') and \
+        os.getenv('ARTMANFLOW_DEBUG', '1') != '0'
+    app.run(debug=debug, host=host,
+            port=int(os.getenv('ARTMANFLOW_PORT', 5000)))
@@ -12,25 +12,39 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import io
 import os
+import shutil
 
 from flask import Blueprint, Response, \
     render_template, request, redirect
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
 
 from artmanflow.steps.java_sources_staging_host import JavaSourcesStagingHost
+from artmanflow.steps.sources_generation_host import SourcesGenerationHost
 from artmanflow.steps.common import ConfigUtils
+from artmanflow.steps.supervisor import ExecutionSupervisor
 from artmanflow.web.html_utils import HtmlUtils
+from artmanflow.web.log_tail import LogTail
+from artmanflow.web.rendered_pages import RenderedPageCache
+from artmanflow.web.scheduler import StepScheduler
 from artmanflow.web.service_utils import ServiceUtils
+from artmanflow.web.submissions import SubmissionRegistry
 
 java_src_staging = Blueprint('java_sources_staging', __name__,
                              url_prefix='/java-sources-staging')
 
-
 @java_src_staging.route('/new')
 def java_sources_staging_new():
     config = _params_from_yaml(
         ServiceUtils.get_step_default_config('java_sources_staging.yaml'))
-    return render_template('java_sources_staging_new.html', config=config)
+    # Prefilled by the "Stage Java Sources" link of a generation execution
+    config['generator_artifacts_execution_id'] = request.args.get(
+        'generator_artifacts_execution_id', '')
+    return render_template('java_sources_staging_new.html', config=config,
+                           idempotency_key=ConfigUtils.generate_id(''))
 
 
 @java_src_staging.route('', methods=['POST'])
@@ -38,21 +52,65 @@ def java_sources_staging():
     step_props = JavaSourcesStagingHost.host_step_properties(
         ConfigUtils.generate_id('java-src-stage-'))
 
-    config_yaml = ServiceUtils.get_step_config(request.form,
+    max_upload_size = int(ServiceUtils.get_step_default_config(
+        'java_sources_staging.yaml').get('max_upload_size_mb') or 0) * \
+        1024 * 1024
+    upload = _ArtifactsUpload(step_props, max_upload_size)
+    form = upload.parse(request.environ)
+    config_yaml = ServiceUtils.get_step_config(form,
                                                'java_sources_staging.yaml',
                                                _params_to_yaml)
-    artifacts_zip_path = step_props.temp_subpath(ConfigUtils.artifact_name())
-    config_yaml['generator_artifacts']['sources_zip'] = artifacts_zip_path
+    source_execution_id = form.get('generator_artifacts_execution_id')
+    if source_execution_id:
+        upload.discard()
+        if not ServiceUtils.generation_execution_exists(source_execution_id):
+            return 'The sources generation execution %s does not exist' % \
+                   source_execution_id, 400
+        config_yaml['generator_artifacts']['execution_id'] = \
+            source_execution_id
+    elif upload.size():
+        expected_sha256 = form.get('generator_artifacts_sha256')
+        if expected_sha256 and expected_sha256.lower() != upload.sha256():
+            upload.discard()
+            return 'The uploaded sources sha256 is %s, expected %s' % (
+                upload.sha256(), expected_sha256), 400
+        config_yaml['generator_artifacts']['sha256'] = upload.sha256()
+    else:
+        upload.discard()
+        return 'Either a generated sources zip or a sources generation ' \
+               'execution id is required', 400
     execution_id = step_props.execution_id()
     config_yaml['staging']['git_branch'] = execution_id
     config_yaml['execution_id'] = execution_id
 
-    ServiceUtils.run_host_step(JavaSourcesStagingHost(config_yaml))
+    if source_execution_id:
+        source_artifacts = _link_source_artifacts(step_props,
+                                                  source_execution_id)
+        if not source_artifacts:
+            shutil.rmtree(step_props.temp_path(), ignore_errors=True)
+            return 'The sources generation execution %s has no artifacts' % \
+                   source_execution_id, 404
+        config_yaml['generator_artifacts'].update(source_artifacts)
+    else:
+        config_yaml['generator_artifacts']['sources_zip'] = upload.finish()
+
+    # The same hash as the catalog one, paths in the execution directory
+    # are normalized with the execution id
+    existing_execution_id = SubmissionRegistry.claim(
+        step_props, ConfigUtils.config_hash(config_yaml),
+        ServiceUtils.idempotency_key(form))
+    if existing_execution_id:
+        shutil.rmtree(step_props.temp_path(), ignore_errors=True)
+        return redirect("/java-sources-staging/%s" % existing_execution_id)
 
+    # The scheduler prepares the execution once it accepts it
     step = JavaSourcesStagingHost(config_yaml)
-    step.pre_execute()
-    request.files['generator_artifacts_sources_zip'].save(artifacts_zip_path)
-    ServiceUtils.run_host_step(step)
+    rejection = ServiceUtils.run_host_step(
+        step, 'java_sources_staging.yaml',
+        ServiceUtils.queue_priority(form))
+    if rejection:
+        shutil.rmtree(step_props.temp_path(), ignore_errors=True)
+        return rejection
 
     return redirect("/java-sources-staging/%s" % step_props.execution_id())
 
@@ -60,23 +118,181 @@ def java_sources_staging():
 @java_src_staging.route('/<execution_id>')
 def java_sources_staging_output(execution_id):
     step_props = JavaSourcesStagingHost.host_step_properties(execution_id)
-    artifact_name = ConfigUtils.artifact_yaml_name()
-    pr_url = None
-
-    if ConfigUtils.check_artifact_exist(step_props, artifact_name):
-        artifact = ConfigUtils.read_config(
-            step_props.host_guest_output_dir_subpath(
-                ConfigUtils.artifact_yaml_name()))
-        pr_url = artifact['pr_url']
+    status = ExecutionSupervisor.read_status(step_props.temp_path())
+    if _is_completed(step_props):
+        pr_url = None
+        artifact_yaml_path = step_props.host_guest_output_dir_subpath(
+            ConfigUtils.artifact_yaml_name())
+        if os.path.isfile(artifact_yaml_path):
+            pr_url = ConfigUtils.read_config(artifact_yaml_path)['pr_url']
+        rows = HtmlUtils.generate_html_from_console_output(
+            step_props.stdout_file_path())
+        return RenderedPageCache.response(step_props,
+                                          'java_sources_staging_output.html',
+                                          rows=rows, completed=True,
+                                          waterfall=_waterfall(step_props),
+                                          status=_finished_status(status), pr_url=pr_url,
+                                          output_link=step_props.temp_path())
 
-    rows = HtmlUtils.generate_html_from_console_output(
-        step_props.stdout_file_path())
+    stream_link = "/java-sources-staging/%s/stream" % execution_id
+    cancel_link = "/java-sources-staging/%s/cancel" % execution_id
+    queue_position = StepScheduler.find_queue_position(execution_id)
     stream = ServiceUtils.stream_template('java_sources_staging_output.html',
-                                          rows=rows, pr_url=pr_url,
+                                          rows=[], completed=False,
+                                          status=status, pr_url=None,
+                                          stream_link=stream_link,
+                                          cancel_link=cancel_link,
+                                          queue_position=queue_position,
                                           output_link=step_props.temp_path())
     return Response(stream, mimetype='text/html')
 
 
+@java_src_staging.route('/<execution_id>/cancel', methods=['POST'])
+def java_sources_staging_cancel(execution_id):
+    if not ServiceUtils.cancel_host_step(execution_id):
+        return 'The execution %s is not running' % execution_id, 404
+    return redirect("/java-sources-staging/%s" % execution_id)
+
+
+@java_src_staging.route('/<execution_id>/tail')
+def java_sources_staging_tail(execution_id):
+    step_props = JavaSourcesStagingHost.host_step_properties(execution_id)
+    return LogTail.tail_response(step_props.stdout_file_path(), request,
+                                 _is_completed(step_props))
+
+
+@java_src_staging.route('/<execution_id>/stream')
+def java_sources_staging_stream(execution_id):
+    step_props = JavaSourcesStagingHost.host_step_properties(execution_id)
+    return LogTail.stream_response(step_props.stdout_file_path(), request,
+                                   lambda: _is_completed(step_props))
+
+
+class _ArtifactsUpload(object):
+    # The uploaded archive is written to the execution directory while the
+    # form is parsed and hashed on the way, instead of being spooled to a
+    # temp file and copied by FileStorage.save()
+    def __init__(self, step_props, max_size):
+        self._step_props = step_props
+        self._max_size = max_size
+        self._path = step_props.temp_subpath('upload.part')
+        self._file = None
+        self._filename = None
+        self._digest = hashlib.sha256()
+        self._size = 0
+
+    def parse(self, environ):
+        try:
+            _, form, _ = parse_form_data(
+                environ, stream_factory=self._stream_factory,
+                max_content_length=self._max_size or None)
+        except Exception:
+            self.discard()
+            raise
+        if self._file:
+            self._file.close()
+        return form
+
+    def size(self):
+        return self._size
+
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def finish(self):
+        compression = 'zstd' if self._filename.endswith('.zst') else 'gzip'
+        artifacts_zip_path = self._step_props.temp_subpath(
+            ConfigUtils.artifact_name(compression))
+        os.rename(self._path, artifacts_zip_path)
+        return artifacts_zip_path
+
+    def discard(self):
+        if self._file:
+            self._file.close()
+            if os.path.isfile(self._path):
+                os.remove(self._path)
+            try:
+                os.rmdir(self._step_props.temp_path())
+            except OSError:
+                pass  # not empty, or never created
+
+    def _stream_factory(self, total_content_length, content_type, filename,
+        content_length=None):
+        if not filename or self._file:
+            # Empty file fields, only a single archive is expected
+            return io.BytesIO()
+        if not os.path.isdir(self._step_props.temp_path()):
+            os.makedirs(self._step_props.temp_path())
+        self._filename = filename
+        self._file = _HashingWriter(open(self._path, 'wb'), self._update)
+        return self._file
+
+    def _update(self, data):
+        self._size += len(data)
+        if self._max_size and self._size > self._max_size:
+            raise RequestEntityTooLarge(
+                'The generated sources are bigger than %s MB' % (
+                    self._max_size // (1024 * 1024)))
+        self._digest.update(data)
+
+
+class _HashingWriter(object):
+    def __init__(self, file_obj, update_func):
+        self._file = file_obj
+        self._update_func = update_func
+
+    def write(self, data):
+        self._update_func(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def _link_source_artifacts(step_props, source_execution_id):
+    # The archive of the generation execution is handed over without
+    # copying it: hardlinked in the execution directory, or mounted directly
+    # from the generation execution if it is on another device
+    source_props = SourcesGenerationHost.host_step_properties(
+        source_execution_id)
+    if not os.path.isdir(step_props.temp_path()):
+        os.makedirs(step_props.temp_path())
+    artifact_name = ConfigUtils.find_artifact(source_props)
+    if artifact_name:
+        source_path = source_props.host_guest_output_dir_subpath(
+            artifact_name)
+        linked_path = step_props.temp_subpath(artifact_name)
+        try:
+            os.link(source_path, linked_path)
+        except OSError:
+            return {'sources_zip': source_path}
+        return {'sources_zip': linked_path}
+
+    store = ServiceUtils.artifact_store()
+    if store and store.has_manifest(source_execution_id):
+        sources_path = step_props.temp_subpath('sources')
+        store.materialize(source_execution_id, sources_path)
+        return {'sources_dir': sources_path}
+    return None
+
+
+def _waterfall(step_props):
+    return HtmlUtils.generate_waterfall_html(
+        step_props.host_guest_output_dir_subpath(ConfigUtils.timings_name()))
+
+
+def _finished_status(status):
+    # Artifacts can be ready before the guest process has exited
+    return status if ExecutionSupervisor.is_finished(status) else None
+
+
+def _is_completed(step_props):
+    return ConfigUtils.check_artifact_exist(
+        step_props, ConfigUtils.artifact_yaml_name()) or \
+        ExecutionSupervisor.is_finished(
+            ExecutionSupervisor.read_status(step_props.temp_path()))
+
+
 def _params_to_yaml(post_params, extra_config):
     config = {
         'docker_image': post_params['docker_image'],
@@ -0,0 +1,112 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import re
+import time
+
+from flask import Response, jsonify
+
+from artmanflow.web.html_utils import AnsiHtmlConverter, HtmlUtils
+
+
+class LogTail(object):
+    _MAX_CHUNK_BYTES = 1024 * 1024
+
+    _POLL_INTERVAL_SECONDS = 1
+
+    _KEEPALIVE_INTERVAL_SECONDS = 15
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def parse_position(request):
+        # EventSource sends the id of the last received event on reconnect,
+        # it holds both the log offset and the console style at that offset
+        position = request.headers.get('Last-Event-ID')
+        if position:
+            offset, _, state = position.partition(':')
+        else:
+            offset = request.args.get('offset', 0)
+            state = request.args.get('state', '')
+        try:
+            offset = max(0, int(offset))
+        except ValueError:
+            offset = 0
+        if not re.match(r'^[0-9;]*$', state):
+            state = ''
+        return offset, state
+
+    @staticmethod
+    def read(file_path, offset):
+        try:
+            with open(file_path, 'rb') as log_file:
+                log_file.seek(0, os.SEEK_END)
+                offset = min(offset, log_file.tell())
+                log_file.seek(offset)
+                chunk = log_file.read(LogTail._MAX_CHUNK_BYTES)
+        except IOError:
+            return '', offset
+
+        # Return only complete lines, the rest is read on the next call
+        if len(chunk) < LogTail._MAX_CHUNK_BYTES:
+            chunk = chunk[:chunk.rfind(b'\n') + 1]
+        return chunk.decode('UTF-8', 'replace'), offset + len(chunk)
+
+    @staticmethod
+    def tail_response(file_path, request, completed):
+        offset, state = LogTail.parse_position(request)
+        converter = AnsiHtmlConverter(state)
+        text, offset = LogTail.read(file_path, offset)
+        return jsonify(LogTail._tail_data(text, offset, completed, converter))
+
+    @staticmethod
+    def stream_response(file_path, request, completed_func):
+        offset, state = LogTail.parse_position(request)
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        return Response(LogTail._events(file_path, offset, state,
+                                        completed_func),
+                        mimetype='text/event-stream', headers=headers)
+
+    @staticmethod
+    def _events(file_path, offset, state, completed_func):
+        converter = AnsiHtmlConverter(state)
+        last_event_time = time.time()
+        while True:
+            completed = completed_func()
+            text, offset = LogTail.read(file_path, offset)
+            if text or completed:
+                data = LogTail._tail_data(text, offset, completed and not text,
+                                          converter)
+                yield 'id: %s:%s\ndata: %s\n\n' % (offset, data['state'],
+                                                   json.dumps(data))
+                last_event_time = time.time()
+                if completed and not text:
+                    return
+                if text:
+                    continue
+            elif time.time() - last_event_time > \
+                    LogTail._KEEPALIVE_INTERVAL_SECONDS:
+                yield ': keepalive\n\n'
+                last_event_time = time.time()
+            time.sleep(LogTail._POLL_INTERVAL_SECONDS)
+
+    @staticmethod
+    def _tail_data(text, offset, completed, converter):
+        html = HtmlUtils.generate_html_from_console_text(
+            text, converter) if text else ''
+        return {'html': html, 'offset': offset, 'state': converter.state(),
+                'completed': completed}
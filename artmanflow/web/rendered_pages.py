@@ -0,0 +1,137 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import os
+
+from flask import Response, current_app, request
+
+from artmanflow.steps.common import ConfigUtils, FileLock
+from artmanflow.steps.supervisor import ExecutionSupervisor
+from artmanflow.web.service_utils import ServiceUtils
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class RenderedPageCache(object):
+    _READ_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def response(step_props, template_name, **context):
+        # The output of a completed execution never changes, so its page is
+        # rendered once and served precompressed from then on
+        gzip_path = RenderedPageCache._page_path(step_props, template_name)
+        with FileLock(gzip_path + '.lock'):
+            if not RenderedPageCache._is_fresh(gzip_path, step_props,
+                                               template_name):
+                RenderedPageCache._render(gzip_path, template_name, context)
+
+        stat = os.stat(gzip_path)
+        etag = '%x-%x' % (int(stat.st_mtime * 1000000), stat.st_size)
+        headers = {'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+        if request.if_none_match.contains(etag):
+            response = Response(status=304, headers=headers)
+            response.set_etag(etag)
+            return response
+
+        encodings = request.accept_encodings
+        brotli_path = gzip_path[:-len('.gz')] + '.br'
+        if encodings['br'] and os.path.isfile(brotli_path):
+            response = RenderedPageCache._file_response(
+                brotli_path, 'br', headers)
+        elif encodings['gzip']:
+            response = RenderedPageCache._file_response(
+                gzip_path, 'gzip', headers)
+        else:
+            response = Response(RenderedPageCache._decompress(gzip_path),
+                                mimetype='text/html', headers=headers)
+        response.set_etag(etag)
+        return response
+
+    @staticmethod
+    def _page_path(step_props, template_name):
+        name = os.path.splitext(template_name)[0]
+        return os.path.join(step_props.temp_path(), name + '.html.gz')
+
+    @staticmethod
+    def _is_fresh(gzip_path, step_props, template_name):
+        if not os.path.isfile(gzip_path):
+            return False
+        template_path = os.path.join(current_app.root_path,
+                                     current_app.template_folder,
+                                     template_name)
+        sources = [step_props.stdout_file_path(), template_path,
+                   step_props.temp_subpath(
+                       ExecutionSupervisor.STATUS_FILE_NAME),
+                   step_props.host_guest_output_dir_subpath(
+                       ConfigUtils.timings_name())]
+        rendered_at = os.path.getmtime(gzip_path)
+        return all(not os.path.isfile(path) or
+                   os.path.getmtime(path) <= rendered_at for path in sources)
+
+    @staticmethod
+    def _render(gzip_path, template_name, context):
+        brotli_path = gzip_path[:-len('.gz')] + '.br'
+        compressor = brotli.Compressor() if brotli else None
+        with gzip.open(gzip_path + '.part', 'wb') as gzip_file, \
+                open(brotli_path + '.part', 'wb') as brotli_file:
+            for chunk in ServiceUtils.stream_template(template_name,
+                                                      **context):
+                data = chunk.encode('UTF-8')
+                gzip_file.write(data)
+                if compressor:
+                    brotli_file.write(compressor.process(data))
+            if compressor:
+                brotli_file.write(compressor.finish())
+
+        if compressor:
+            os.rename(brotli_path + '.part', brotli_path)
+        else:
+            os.remove(brotli_path + '.part')
+            if os.path.isfile(brotli_path):
+                os.remove(brotli_path)
+        # Renamed last, the brotli file is never older than the gzip one
+        os.rename(gzip_path + '.part', gzip_path)
+
+    @staticmethod
+    def _file_response(path, encoding, headers):
+        response = Response(RenderedPageCache._read_chunks(path),
+                            mimetype='text/html', headers=headers)
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Content-Length'] = str(os.path.getsize(path))
+        return response
+
+    @staticmethod
+    def _read_chunks(path):
+        with open(path, 'rb') as page_file:
+            while True:
+                chunk = page_file.read(RenderedPageCache._READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    @staticmethod
+    def _decompress(path):
+        with gzip.open(path, 'rb') as page_file:
+            while True:
+                chunk = page_file.read(RenderedPageCache._READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
@@ -0,0 +1,146 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import itertools
+import threading
+import time
+
+from artmanflow.steps.metrics import EXECUTION_DURATION, PHASE_DURATION
+
+
+class StepScheduler(object):
+    # Schedulers are shared by all the requests served by this process
+    _schedulers = {}
+    _schedulers_lock = threading.Lock()
+
+    _DEFAULT_RETRY_AFTER_SECONDS = 60
+
+    def __init__(self, step_type, max_running, max_queued):
+        self._step_type = step_type
+        self._max_running = max_running
+        self._max_queued = max_queued
+        self._lock = threading.Lock()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._average_duration = None
+
+    @staticmethod
+    def for_step_type(step_type, scheduler_config):
+        with StepScheduler._schedulers_lock:
+            scheduler = StepScheduler._schedulers.get(step_type)
+            if not scheduler:
+                scheduler = StepScheduler(
+                    step_type,
+                    int(scheduler_config.get('max_running_executions', 2)),
+                    int(scheduler_config.get('max_queued_executions', 20)))
+                StepScheduler._schedulers[step_type] = scheduler
+            return scheduler
+
+    @staticmethod
+    def find_queue_position(execution_id):
+        with StepScheduler._schedulers_lock:
+            schedulers = list(StepScheduler._schedulers.values())
+        for scheduler in schedulers:
+            position = scheduler.queue_position(execution_id)
+            if position:
+                return position
+        return None
+
+    @staticmethod
+    def stats():
+        with StepScheduler._schedulers_lock:
+            schedulers = list(StepScheduler._schedulers.values())
+        stats = {}
+        for scheduler in schedulers:
+            with scheduler._lock:
+                stats[scheduler._step_type] = (scheduler._running,
+                                               len(scheduler._queue))
+        return stats
+
+    @staticmethod
+    def cancel_queued(execution_id):
+        with StepScheduler._schedulers_lock:
+            schedulers = list(StepScheduler._schedulers.values())
+        return any(scheduler.remove(execution_id) for scheduler in schedulers)
+
+    def submit(self, step, priority=0):
+        with self._lock:
+            if self._running < self._max_running:
+                self._running += 1
+                step.pre_execute()
+                self._start(step)
+                return True
+            if len(self._queue) >= self._max_queued:
+                return False
+            # Queued executions already have their output directory
+            step.pre_execute()
+            # Higher priority first, FIFO within the same priority
+            heapq.heappush(self._queue, (-priority, next(self._sequence),
+                                         step, time.time()))
+            return True
+
+    def remove(self, execution_id):
+        with self._lock:
+            for entry in self._queue:
+                if entry[2].execution_id() == execution_id:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    return True
+        return False
+
+    def queue_position(self, execution_id):
+        with self._lock:
+            queue = sorted(self._queue, key=lambda entry: entry[:2])
+        for position, entry in enumerate(queue):
+            if entry[2].execution_id() == execution_id:
+                return position + 1
+        return None
+
+    def retry_after_seconds(self):
+        with self._lock:
+            if self._average_duration is None:
+                return self._DEFAULT_RETRY_AFTER_SECONDS
+            # Time for the running slots to drain one queue position
+            return max(1, int(self._average_duration / self._max_running))
+
+    def _start(self, step, queued_at=None):
+        threading.Thread(target=self._run, args=(step, queued_at)).start()
+
+    def _run(self, step, queued_at):
+        start_time = time.time()
+        if queued_at:
+            PHASE_DURATION.observe(start_time - queued_at,
+                                   step=self._step_type, phase='queued')
+        try:
+            step.execute()
+            step.wait()
+        except Exception as e:
+            # Finishes the execution, otherwise it stays running forever
+            step.fail(e)
+        finally:
+            duration = time.time() - start_time
+            EXECUTION_DURATION.observe(duration, step=self._step_type)
+            with self._lock:
+                if self._average_duration is None:
+                    self._average_duration = duration
+                else:
+                    self._average_duration = \
+                        0.8 * self._average_duration + 0.2 * duration
+                if self._queue:
+                    entry = heapq.heappop(self._queue)
+                    self._start(entry[2], entry[3])
+                else:
+                    self._running -= 1
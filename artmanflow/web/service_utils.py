@@ -12,12 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import threading
-from flask import render_template, current_app
+import os
+import re
+
+from flask import render_template, current_app, request
+from artmanflow.steps.artifact_store import ArtifactStore
+from artmanflow.steps.catalog import ExecutionCatalog
 from artmanflow.steps.common import ConfigUtils
+from artmanflow.steps.sources_generation_host import SourcesGenerationHost
+from artmanflow.steps.supervisor import ExecutionSupervisor
+from artmanflow.web.scheduler import StepScheduler
+from artmanflow.web.submissions import SubmissionRegistry
 
 
 class ServiceUtils:
+    _HOST_CONFIG_KEYS = ['guest_root_path', 'generation_cache',
+                         'git_mirrors', 'guest_image_cache',
+                         'docker_pull_ttl_seconds', 'container_pool',
+                         'execution_timeout_seconds', 'execution_catalog_path',
+                         'guest_snapshot', 'sharding', 'artifact_store']
+
+    _EXECUTION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+    _STEP_CONFIG_FILE_NAMES = ['sources_generation.yaml',
+                               'java_sources_staging.yaml']
+
     @staticmethod
     def stream_template(template_name, **context):
         current_app.update_template_context(context)
@@ -38,19 +57,71 @@ class ServiceUtils:
         converter_func):
         default_config = ServiceUtils.get_step_default_config(
             default_config_file_name)
-        extra_config = {'guest_root_path': default_config['guest_root_path']}
+        extra_config = {}
+        for key in ServiceUtils._HOST_CONFIG_KEYS:
+            if key in default_config:
+                extra_config[key] = default_config[key]
         return converter_func(request_params, extra_config)
 
     @staticmethod
-    def run_host_step(step):
-        HostScriptThread(step).start()
+    def execution_catalog():
+        for config_file_name in ServiceUtils._STEP_CONFIG_FILE_NAMES:
+            path = ServiceUtils.get_step_default_config(
+                config_file_name).get('execution_catalog_path')
+            if path:
+                return ExecutionCatalog(path)
+        return ExecutionCatalog()
 
+    @staticmethod
+    def artifact_store():
+        store_config = ServiceUtils.get_step_default_config(
+            'sources_generation.yaml').get('artifact_store') or {}
+        if store_config.get('path'):
+            return ArtifactStore(store_config['path'])
+        return None
 
-class HostScriptThread(threading.Thread):
-    def __init__(self, step):
-        threading.Thread.__init__(self)
-        self._step = step
+    @staticmethod
+    def generation_execution_exists(execution_id):
+        # Ids submitted by users to reference a sources generation execution
+        if not ServiceUtils._EXECUTION_ID_PATTERN.match(execution_id):
+            return False
+        step_props = SourcesGenerationHost.host_step_properties(execution_id)
+        if os.path.isdir(step_props.temp_path()):
+            return True
+        store = ServiceUtils.artifact_store()
+        return store is not None and store.has_manifest(execution_id)
 
-    def run(self):
-        self._step.pre_execute()
-        self._step.execute()
\ No newline at end of file
+    @staticmethod
+    def queue_priority(request_params):
+        try:
+            return int(request_params.get('queue_priority', 0))
+        except ValueError:
+            return 0
+
+    @staticmethod
+    def idempotency_key(request_params):
+        return request.headers.get('Idempotency-Key') or \
+            (request_params or {}).get('idempotency_key')
+
+    @staticmethod
+    def run_host_step(step, default_config_file_name, priority=0):
+        scheduler_config = ServiceUtils.get_step_default_config(
+            default_config_file_name).get('scheduler') or {}
+        scheduler = StepScheduler.for_step_type(step.step_name(),
+                                                scheduler_config)
+        if scheduler.submit(step, priority):
+            return None
+        SubmissionRegistry.release(step.execution_id())
+        return 'Too many executions are queued, please try again later', \
+               429, {'Retry-After': str(scheduler.retry_after_seconds())}
+
+    @staticmethod
+    def cancel_host_step(execution_id):
+        dequeued = StepScheduler.cancel_queued(execution_id)
+        supervisor = ExecutionSupervisor.find(execution_id)
+        if not supervisor:
+            return False
+        supervisor.cancel()
+        if dequeued:
+            supervisor.finish_cancelled()
+        return True
@@ -12,25 +12,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hmac
 import os
 
 from flask import Blueprint, Response, \
-    render_template, request, redirect, send_from_directory
+    render_template, request, redirect, send_from_directory, jsonify
 
 from artmanflow.steps.sources_generation_host import SourcesGenerationHost
+from artmanflow.steps.artifact_archive import read_archive_files
+from artmanflow.steps.artifact_manifest import ArtifactManifest
 from artmanflow.steps.common import ConfigUtils
+from artmanflow.steps.shard_coordinator import ShardCoordinator
+from artmanflow.steps.supervisor import ExecutionSupervisor
 from artmanflow.web.html_utils import HtmlUtils
+from artmanflow.web.log_tail import LogTail
+from artmanflow.web.rendered_pages import RenderedPageCache
+from artmanflow.web.scheduler import StepScheduler
 from artmanflow.web.service_utils import ServiceUtils
+from artmanflow.web.submissions import SubmissionRegistry
 
 src_gen = Blueprint('sources_generation', __name__,
                     url_prefix='/sources-generation')
 
+_MAX_TEXT_DIFFS = 100
+_MAX_TEXT_DIFF_FILE_SIZE = 1024 * 1024
+
 
 @src_gen.route('/new')
 def sources_generation_new():
     config = _params_from_yaml(
         ServiceUtils.get_step_default_config('sources_generation.yaml'))
-    return render_template('sources_generation_new.html', config=config)
+    return render_template('sources_generation_new.html', config=config,
+                           idempotency_key=ConfigUtils.generate_id(''))
 
 
 @src_gen.route('', methods=['POST'])
@@ -38,50 +51,219 @@ def sources_generation():
     config_yaml = ServiceUtils.get_step_config(request.form,
                                                'sources_generation.yaml',
                                                _params_to_yaml)
+    error = _check_config(config_yaml)
+    if error:
+        return error, 400
 
     execution_id = ConfigUtils.generate_id('src-gen-')
     config_yaml['execution_id'] = execution_id
+    existing_execution_id = SubmissionRegistry.claim(
+        SourcesGenerationHost.host_step_properties(execution_id),
+        ConfigUtils.config_hash(config_yaml),
+        ServiceUtils.idempotency_key(request.form))
+    if existing_execution_id:
+        return redirect("/sources-generation/%s" % existing_execution_id)
     step = SourcesGenerationHost(config_yaml)
-    ServiceUtils.run_host_step(step)
+    rejection = ServiceUtils.run_host_step(
+        step, 'sources_generation.yaml',
+        ServiceUtils.queue_priority(request.form))
+    if rejection:
+        return rejection
 
     return redirect("/sources-generation/%s" % execution_id)
 
 
-@src_gen.route('/<execution_id>')
-def sources_generation_output(execution_id):
+@src_gen.route('/shards', methods=['POST'])
+def sources_generation_shard():
+    # Shards of executions sharded by a coordinator on another server
+    if not _is_coordinator_request():
+        return jsonify({'error': 'Invalid or missing worker token'}), 403
+    config_yaml = ServiceUtils.get_step_config(request.get_json(),
+                                               'sources_generation.yaml',
+                                               _shard_params_to_yaml)
+    error = _check_config(config_yaml)
+    if error:
+        return jsonify({'error': error}), 400
+
+    execution_id = ConfigUtils.generate_id('src-gen-shard-')
+    config_yaml['execution_id'] = execution_id
+    # A coordinator resubmits a shard when a submission timed out
+    existing_execution_id = SubmissionRegistry.claim(
+        SourcesGenerationHost.host_step_properties(execution_id),
+        ConfigUtils.config_hash(config_yaml),
+        ServiceUtils.idempotency_key(request.get_json()))
+    if existing_execution_id:
+        return jsonify({'execution_id': existing_execution_id}), 202
+    step = SourcesGenerationHost(config_yaml)
+    rejection = ServiceUtils.run_host_step(step, 'sources_generation.yaml')
+    if rejection:
+        return rejection
+
+    return jsonify({'execution_id': execution_id}), 202
+
+
+@src_gen.route('/<execution_id>/status')
+def sources_generation_status(execution_id):
     step_props = SourcesGenerationHost.host_step_properties(execution_id)
-    artifact_name = ConfigUtils.artifact_name()
-    download_link = None
-    if ConfigUtils.check_artifact_exist(step_props, artifact_name):
-        download_link = "/sources-generation/%s/download" % execution_id
+    status = ExecutionSupervisor.read_status(step_props.temp_path())
+    if not status:
+        return jsonify({'error': 'Unknown execution %s' % execution_id}), 404
+
+    summary = None
+    summary_path = step_props.host_guest_output_dir_subpath(
+        ConfigUtils.artifact_yaml_name())
+    if ExecutionSupervisor.is_finished(status) and \
+            os.path.isfile(summary_path):
+        summary = ConfigUtils.read_config(summary_path)
+    return jsonify({'execution': status, 'summary': summary})
 
-    rows = HtmlUtils.generate_html_from_console_output(
-        step_props.stdout_file_path())
 
+@src_gen.route('/<execution_id>')
+def sources_generation_output(execution_id):
+    step_props = SourcesGenerationHost.host_step_properties(execution_id)
     output_path = step_props.temp_path()
-    stream = ServiceUtils.stream_template('sources_generation_output.html',
-                                          rows=rows,
+    status = ExecutionSupervisor.read_status(output_path)
+    if _is_completed(step_props):
+        download_link, staging_link = None, None
+        if ConfigUtils.find_artifact(step_props) or _is_stored(execution_id):
+            download_link = "/sources-generation/%s/download" % execution_id
+            staging_link = "/java-sources-staging/new?" \
+                           "generator_artifacts_execution_id=%s" % execution_id
+        rows = HtmlUtils.generate_html_from_console_output(
+            step_props.stdout_file_path())
+        return RenderedPageCache.response(step_props,
+                                          'sources_generation_output.html',
+                                          rows=rows, completed=True,
+                                          waterfall=_waterfall(step_props),
+                                          status=_finished_status(status),
                                           download_link=download_link,
+                                          staging_link=staging_link,
+                                          cells=_matrix_cells(step_props),
+                                          output_link=output_path)
+
+    stream_link = "/sources-generation/%s/stream" % execution_id
+    cancel_link = "/sources-generation/%s/cancel" % execution_id
+    queue_position = StepScheduler.find_queue_position(execution_id)
+    stream = ServiceUtils.stream_template('sources_generation_output.html',
+                                          rows=[], completed=False,
+                                          status=status, download_link=None,
+                                          stream_link=stream_link,
+                                          cancel_link=cancel_link,
+                                          queue_position=queue_position,
                                           output_link=output_path)
     return Response(stream, mimetype='text/html')
 
 
+@src_gen.route('/<execution_id>/cancel', methods=['POST'])
+def sources_generation_cancel(execution_id):
+    if not ServiceUtils.cancel_host_step(execution_id):
+        return 'The execution %s is not running' % execution_id, 404
+    return redirect("/sources-generation/%s" % execution_id)
+
+
+@src_gen.route('/<execution_id>/tail')
+def sources_generation_tail(execution_id):
+    step_props = SourcesGenerationHost.host_step_properties(execution_id)
+    return LogTail.tail_response(step_props.stdout_file_path(), request,
+                                 _is_completed(step_props))
+
+
+@src_gen.route('/<execution_id>/stream')
+def sources_generation_stream(execution_id):
+    step_props = SourcesGenerationHost.host_step_properties(execution_id)
+    return LogTail.stream_response(step_props.stdout_file_path(), request,
+                                   lambda: _is_completed(step_props))
+
+
+@src_gen.route('/<execution_id>/cells/<int:cell_index>/download')
+def sources_generation_cell_download(execution_id, cell_index):
+    step_props = SourcesGenerationHost.host_step_properties(execution_id)
+    cells = _matrix_cells(step_props)
+    if cell_index >= len(cells) or not cells[cell_index]['download_link']:
+        return 'The artifact of the cell %s does not exist' % cell_index, 404
+
+    artifact_path = step_props.host_guest_output_dir_subpath(
+        cells[cell_index]['artifact'])
+    artifact_name = os.path.basename(artifact_path)
+    mimetype = 'application/zstd' if artifact_name.endswith('.zst') \
+        else 'application/gzip'
+    return send_from_directory(os.path.dirname(artifact_path), artifact_name,
+                               as_attachment=True,
+                               attachment_filename='%s-%s-%s' % (
+                                   execution_id, cells[cell_index]['name'],
+                                   artifact_name),
+                               mimetype=mimetype)
+
+
 @src_gen.route('/<execution_id>/download')
 def sources_generation_download(execution_id):
     step_props = SourcesGenerationHost.host_step_properties(execution_id)
-    artifact_name = ConfigUtils.artifact_name()
+    artifact_name = ConfigUtils.find_artifact(step_props)
 
-    if ConfigUtils.check_artifact_exist(step_props, artifact_name):
+    if artifact_name:
+        mimetype = 'application/zstd' if artifact_name.endswith('.zst') \
+            else 'application/gzip'
         return send_from_directory(step_props.host_guest_output_dir_path(),
                                    artifact_name, as_attachment=True,
                                    attachment_filename=artifact_name,
-                                   mimetype='application/gzip')
+                                   mimetype=mimetype)
+    elif _is_stored(execution_id):
+        # The archive was replaced by the artifact store manifest
+        return Response(
+            ServiceUtils.artifact_store().stream_archive(execution_id),
+            mimetype='application/gzip',
+            headers={'Content-Disposition':
+                     'attachment; filename=%s' % ConfigUtils.artifact_name()})
     else:
         return 'The artifact does not exist. Please ensure that the provided ' \
                'execution_id is correct and the generation phase is finished ' \
                'and try again', 404
 
 
+@src_gen.route('/<execution_id>/diff/<new_execution_id>')
+def sources_generation_diff(execution_id, new_execution_id):
+    old_props = SourcesGenerationHost.host_step_properties(execution_id)
+    new_props = SourcesGenerationHost.host_step_properties(new_execution_id)
+    old_manifest = ArtifactManifest.find(old_props)
+    new_manifest = ArtifactManifest.find(new_props)
+    for manifest, manifest_id in [(old_manifest, execution_id),
+                                  (new_manifest, new_execution_id)]:
+        if not manifest:
+            return 'The artifact manifest of the execution %s does not ' \
+                   'exist' % manifest_id, 404
+
+    apis = old_manifest.diff(new_manifest)
+    changed = [path for api in apis for path in api['changed']]
+    text_diffs = []
+    if request.args.get('text_diffs', '1') != '0':
+        shown = changed[:_MAX_TEXT_DIFFS]
+        old_files = _read_artifact_files(old_props, execution_id, shown)
+        new_files = _read_artifact_files(new_props, new_execution_id, shown)
+        text_diffs = [{
+            'path': path,
+            'html': HtmlUtils.generate_text_diff_html(
+                path, old_files.get(path), new_files.get(path))
+        } for path in shown]
+    return render_template('sources_generation_diff.html',
+                           execution_id=execution_id,
+                           new_execution_id=new_execution_id, apis=apis,
+                           changed_count=len(changed), text_diffs=text_diffs)
+
+
+def _read_artifact_files(step_props, execution_id, names):
+    if not names:
+        return {}
+    artifact_name = ConfigUtils.find_artifact(step_props)
+    if artifact_name:
+        return read_archive_files(
+            step_props.host_guest_output_dir_subpath(artifact_name), names,
+            _MAX_TEXT_DIFF_FILE_SIZE)
+    if _is_stored(execution_id):
+        return ServiceUtils.artifact_store().read_files(
+            execution_id, names, _MAX_TEXT_DIFF_FILE_SIZE)
+    return {}
+
+
 def _params_to_yaml(post_params, extra_config):
     yaml_configs_list = post_params[
         'artman_client_yaml_configs'].splitlines()
@@ -96,6 +278,17 @@ def _params_to_yaml(post_params, extra_config):
         'docker_image': post_params['docker_image'],
         'local_volumes': post_params.get('local_volumes', ''),
         'debug_mode': True if 'debug_mode' in post_params else False,
+        'max_parallel_apis': _max_parallel_apis(post_params),
+        'artifact_compression': post_params.get('artifact_compression',
+                                                'gzip'),
+        'baseline_execution_id': post_params.get(
+            'baseline_execution_id', '').strip(),
+        'matrix': {
+            'googleapis_commits': post_params.get(
+                'matrix_googleapis_commits', '').split(),
+            'targets': [t.strip() for t in post_params.get(
+                'matrix_targets', '').split(',') if t.strip()]
+        },
         'artman': {
             'git_repo': post_params['artman_git_repo'],
             'git_branch': post_params['artman_git_branch'],
@@ -118,17 +311,56 @@ def _params_to_yaml(post_params, extra_config):
     return config
 
 
+def _max_parallel_apis(post_params):
+    try:
+        max_parallel_apis = int(post_params.get('max_parallel_apis'))
+    except (TypeError, ValueError):
+        max_parallel_apis = int(ServiceUtils.get_step_default_config(
+            'sources_generation.yaml').get('max_parallel_apis', 1))
+    return max(max_parallel_apis, 1)
+
+
+def _is_coordinator_request():
+    # Shard submissions are rejected unless a worker token is configured
+    sharding = ServiceUtils.get_step_default_config(
+        'sources_generation.yaml').get('sharding') or {}
+    worker_token = sharding.get('worker_token')
+    if not worker_token:
+        return False
+    authorization = request.headers.get('Authorization') or ''
+    return hmac.compare_digest(authorization.encode('UTF-8'),
+                               ('Bearer %s' % worker_token).encode('UTF-8'))
+
+
+def _shard_params_to_yaml(shard_params, extra_config):
+    config = dict((key, shard_params[key])
+                  for key in ShardCoordinator.SHARD_CONFIG_KEYS + [
+                      'artman_client_yaml_configs'] if key in shard_params)
+    config.update(extra_config)
+    # A shard is never sharded again
+    config['sharding'] = {}
+    return config
+
+
 def _params_from_yaml(yaml_params):
     yaml_configs_list = yaml_params['artman_client_yaml_configs']
     converted_yaml_config = []
     for entry in yaml_configs_list:
         converted_yaml_config.append(
             "%s:%s" % (entry['path'], entry['target']))
+    matrix = yaml_params.get('matrix') or {}
 
     config = {
         'docker_image': yaml_params['docker_image'],
         'local_volumes': yaml_params['local_volumes'],
         'debug_mode': str(yaml_params['debug_mode']),
+        'max_parallel_apis': str(yaml_params.get('max_parallel_apis', 1)),
+        'artifact_compression': yaml_params.get('artifact_compression',
+                                                'gzip'),
+        'baseline_execution_id': yaml_params.get('baseline_execution_id', ''),
+        'matrix_googleapis_commits': '\n'.join(
+            matrix.get('googleapis_commits') or []),
+        'matrix_targets': ','.join(matrix.get('targets') or []),
         'artman_git_repo': yaml_params['artman']['git_repo'],
         'artman_git_branch': yaml_params['artman']['git_branch'],
         'artman_git_commit': yaml_params['artman']['git_commit'],
@@ -143,10 +375,55 @@ def _params_from_yaml(yaml_params):
     return config
 
 
-def _check_artifacts_exist(step_props):
-    artifacts_fl = step_props.host_guest_output_dir_subpath(
-        ConfigUtils.artifact_name())
-    return os.path.isfile(artifacts_fl)
+def _matrix_cells(step_props):
+    summary_path = step_props.host_guest_output_dir_subpath(
+        ConfigUtils.artifact_yaml_name())
+    if not os.path.isfile(summary_path):
+        return []
+    cells = ConfigUtils.read_config(summary_path).get('cells') or []
+    for index, cell in enumerate(cells):
+        cell['download_link'] = None
+        if os.path.isfile(step_props.host_guest_output_dir_subpath(
+                cell['artifact'])):
+            cell['download_link'] = '/sources-generation/%s/cells/%s/' \
+                                    'download' % (step_props.execution_id(),
+                                                  index)
+    return cells
+
+
+def _waterfall(step_props):
+    return HtmlUtils.generate_waterfall_html(
+        step_props.host_guest_output_dir_subpath(ConfigUtils.timings_name()))
+
+
+def _finished_status(status):
+    # Artifacts can be ready before the guest process has exited
+    return status if ExecutionSupervisor.is_finished(status) else None
+
+
+def _is_completed(step_props):
+    return ConfigUtils.find_artifact(step_props) is not None or \
+        ExecutionSupervisor.is_finished(
+            ExecutionSupervisor.read_status(step_props.temp_path()))
+
+
+def _is_stored(execution_id):
+    store = ServiceUtils.artifact_store()
+    return store is not None and store.has_manifest(execution_id)
+
+
+def _check_config(config_yaml):
+    # Returns why the submitted config cannot be executed, if it cannot
+    compression = config_yaml.get('artifact_compression', 'gzip')
+    if compression not in ConfigUtils.artifact_compressions():
+        return 'Unsupported artifact compression: %s' % compression
+    baseline_execution_id = config_yaml.get('baseline_execution_id')
+    if baseline_execution_id and \
+            not ServiceUtils.generation_execution_exists(
+                baseline_execution_id):
+        return 'The baseline execution %s does not exist' % \
+               baseline_execution_id
+    return None
 
 # def _get_default_config(config_file_name):
 #     default_generation_config_str = render_template(config_file_name)
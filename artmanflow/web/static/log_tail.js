@@ -0,0 +1,14 @@
+function tailLog(streamUrl, outputId) {
+  var output = document.getElementById(outputId);
+  var source = new EventSource(streamUrl + '?offset=0');
+  source.onmessage = function(event) {
+    var data = JSON.parse(event.data);
+    if (data.html) {
+      output.insertAdjacentHTML('beforeend', data.html);
+    }
+    if (data.completed) {
+      source.close();
+      window.location.reload(true);
+    }
+  };
+}
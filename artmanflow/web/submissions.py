@@ -0,0 +1,79 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from artmanflow.steps.supervisor import ExecutionSupervisor
+
+
+class SubmissionRegistry(object):
+    # Submissions are shared by all the requests served by this process,
+    # like the schedulers that run them
+    _submissions = {}
+    _lock = threading.Lock()
+
+    _IDEMPOTENCY_KEY_TTL_SECONDS = 24 * 3600
+    # Claimed submissions have no status until the step is submitted
+    _SUBMIT_WINDOW_SECONDS = 60
+
+    @staticmethod
+    def claim(step_props, config_hash, idempotency_key=None):
+        # Returns the id of an identical in-flight execution (or of the one
+        # submitted with the same idempotency key), otherwise registers
+        # step_props as the execution of this submission and returns None
+        keys = [('config', step_props.step_name(), config_hash)]
+        if idempotency_key:
+            # The key identifies the submission better than its config
+            keys.insert(0, ('key', step_props.step_name(), idempotency_key))
+        now = time.time()
+        with SubmissionRegistry._lock:
+            SubmissionRegistry._expire(now)
+            for key in keys:
+                submission = SubmissionRegistry._submissions.get(key)
+                if submission and (key[0] == 'key' or
+                                   SubmissionRegistry._in_flight(submission)):
+                    return submission['execution_id']
+            submission = {'execution_id': step_props.execution_id(),
+                          'execution_path': step_props.temp_path(),
+                          'submitted_at': now}
+            for key in keys:
+                SubmissionRegistry._submissions[key] = submission
+        return None
+
+    @staticmethod
+    def release(execution_id):
+        # The submission was rejected, the same config can be submitted again
+        with SubmissionRegistry._lock:
+            for key, submission in list(
+                    SubmissionRegistry._submissions.items()):
+                if submission['execution_id'] == execution_id:
+                    del SubmissionRegistry._submissions[key]
+
+    @staticmethod
+    def _in_flight(submission):
+        status = ExecutionSupervisor.read_status(submission['execution_path'])
+        if not status:
+            return time.time() - submission['submitted_at'] < \
+                SubmissionRegistry._SUBMIT_WINDOW_SECONDS
+        return not ExecutionSupervisor.is_finished(status)
+
+    @staticmethod
+    def _expire(now):
+        expired_at = now - SubmissionRegistry._IDEMPOTENCY_KEY_TTL_SECONDS
+        for key, submission in list(SubmissionRegistry._submissions.items()):
+            if submission['submitted_at'] < expired_at or (
+                    key[0] == 'config' and
+                    not SubmissionRegistry._in_flight(submission)):
+                del SubmissionRegistry._submissions[key]
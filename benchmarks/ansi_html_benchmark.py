@@ -0,0 +1,175 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the console to HTML conversion of the output pages against the
+# previous per-line implementation, which is embedded below as LegacyHtmlUtils.
+#
+#   python benchmarks/ansi_html_benchmark.py --size-mb 100
+
+import argparse
+import io
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from artmanflow.web.html_utils import HtmlUtils
+
+
+class LegacyHtmlUtils(object):
+    _COLOR_REGEX = r'(\033\[\d*;*\d*m)'
+
+    _COLOR_STYLE_MAP = {
+        "\033[30m": "color:#000000;",
+        "\033[0;30m": "color:#000000;",
+        "\033[30;0m": "color:#000000;",
+        "\033[31m": " color:#CD0000;",
+        "\033[0;31m": "color:#CD0000;",
+        "\033[31;0m": "color:#CD0000;",
+        "\033[32m": "color:#00CD00;",
+        "\033[0;32m": "color:#00CD00;",
+        "\033[32;0m": "color:#00CD00;",
+        "\033[33m": "color:#C4A000;",
+        "\033[0;33m": "color:#C4A000;",
+        "\033[33;0m": "color:#C4A000;",
+        "\033[34m": "color:#0000EE;",
+        "\033[0;34m": "color:#0000EE;",
+        "\033[34;0m": "color:#0000EE;",
+        "\033[35m": "color:#CD00CD;",
+        "\033[0;35m": "color:#CD00CD;",
+        "\033[35;0m": "color:#CD00CD;",
+        "\033[36m": "color:#00CCCC;",
+        "\033[0;36m": "color:#00CCCC;",
+        "\033[36;0m": "color:#00CCCC;",
+        "\033[37m": "color:#AAAAAA;",
+        "\033[0;37m": "color:#AAAAAA;",
+        "\033[37;0m": "color:#AAAAAA;",
+        "\033[m": " ",
+        "\033[0m": " ",
+        "\033[1;30m": "color:#555555;font-weight:bold",
+        "\033[30;1m": "color:#555555;font-weight:bold",
+        "\033[1;31m": "color:#CD0000;font-weight:bold",
+        "\033[31;1m": "color:#CD0000;font-weight:bold",
+        "\033[1;32m": "color:#00CD00;font-weight:bold",
+        "\033[32;1m": "color:#00CD00;font-weight:bold",
+        "\033[1;33m": "color:#C4A000;font-weight:bold",
+        "\033[33;1m": "color:#C4A000;font-weight:bold",
+        "\033[1;34m": "color:#0000EE;font-weight:bold",
+        "\033[34;1m": "color:#0000EE;font-weight:bold",
+        "\033[1;35m": "color:#CD00CD;font-weight:bold",
+        "\033[35;1m": "color:#CD00CD;font-weight:bold",
+        "\033[1;36m": "color:#00CCCC;font-weight:bold",
+        "\033[36;1m": "color:#00CCCC;font-weight:bold",
+        "\033[1;37m": "color:#AAAAAA;font-weight:bold",
+        "\033[37;1m": "color:#AAAAAA;font-weight:bold",
+    }
+
+
+    @staticmethod
+    def generate_html_from_console_output(file_path):
+        with open(file_path, 'r') as fl:
+            yield '<pre>'
+            color_regex = re.compile(LegacyHtmlUtils._COLOR_REGEX)
+            for line in fl:
+                yield LegacyHtmlUtils._read_line(color_regex, line)
+            yield '</pre>'
+
+    @staticmethod
+    def _read_line(regex, line):
+        split_line = regex.split(line)
+        split_len = len(split_line)
+
+        res = []
+        for i in range(0, split_len, 2):
+            res.append(split_line[i])
+
+            if i + 1 < split_len:
+                style = LegacyHtmlUtils._COLOR_STYLE_MAP.get(split_line[i + 1])
+                if style:
+                    res.append("</pre><pre style='display:inline;%s'>" % style)
+                else:
+                    res.append(split_line[i + 1])
+
+        if split_len > 1:
+            last_token = split_line[split_len - 1]
+            if not last_token or last_token.isspace():
+                res.append('\n')
+
+        return ''.join(res)
+
+
+_LOG_LINES = [
+    '\033[1;30mdocker run --rm -v /tmp/artmanflow:/artman_root image\n\033[0m',
+    'artman --local --config artman_%(api)s.yaml generate java_gapic\n',
+    '\033[32mINFO\033[0m: Running protoc with the following command:\n',
+    '\033[1;32m%(api)s\033[0m generated into /artman_root/output/%(api)s\n',
+    '\033[33mWARNING\033[0m: deprecated option in %(api)s.proto\n',
+    '\033[31;1mERROR:\033[0m could not resolve %(api)s/v1/types.proto\n',
+    '\033[38;5;244m  at com.google.api.codegen.Main.main(Main.java:42)'
+    '\033[0m\n',
+    '    compiling %(api)s/v1/resources.proto (%(n)d of 512)\n',
+]
+
+
+def generate_log(path, size_bytes, seed=0):
+    rnd = random.Random(seed)
+    apis = ['pubsub', 'spanner', 'bigtable', 'vision', 'speech', 'kms']
+    written = 0
+    with io.open(path, 'w', encoding='UTF-8') as log_file:
+        while written < size_bytes:
+            lines = []
+            for _ in range(1000):
+                line = rnd.choice(_LOG_LINES) % {'api': rnd.choice(apis),
+                                                 'n': rnd.randint(1, 512)}
+                lines.append(line)
+            block = ''.join(lines)
+            log_file.write(block)
+            written += len(block)
+    return written
+
+
+def measure(generate_func, log_path):
+    start = time.time()
+    output_size = 0
+    for row in generate_func(log_path):
+        output_size += len(row)
+    return time.time() - start, output_size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=100)
+    parser.add_argument('--log-path', default='/tmp/ansi_html_benchmark.log')
+    args = parser.parse_args()
+
+    input_size = generate_log(args.log_path, args.size_mb * 1024 * 1024)
+    input_mb = input_size / (1024.0 * 1024.0)
+    print('Synthetic log: %s (%.1f MB)' % (args.log_path, input_mb))
+    try:
+        for name, generate_func in [
+            ('legacy', LegacyHtmlUtils.generate_html_from_console_output),
+            ('current', HtmlUtils.generate_html_from_console_output)]:
+            elapsed, output_size = measure(generate_func, args.log_path)
+            print('%-8s %8.1f MB/s %8.2fs  output/input size ratio %.2f' % (
+                name, input_mb / elapsed, elapsed,
+                float(output_size) / input_size))
+    finally:
+        os.remove(args.log_path)
+
+
+if __name__ == '__main__':
+    main()
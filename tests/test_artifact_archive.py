@@ -0,0 +1,58 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from artmanflow.steps.artifact_archive import StreamingArchive, \
+    read_archive_files
+
+
+class StreamingArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self._tree_path = os.path.join(self._temp_path, 'tree')
+        os.makedirs(os.path.join(self._tree_path, 'java', 'a'))
+        with open(os.path.join(self._tree_path, 'java', 'a', 'A.java'),
+                  'w') as source_file:
+            source_file.write('class A {}\n')
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_path)
+
+    def test_close(self):
+        archive_path = os.path.join(self._temp_path, 'artifacts.tar.gz')
+        archive = StreamingArchive(archive_path, threads=1)
+        archive.add_tree(self._tree_path)
+        archive.close()
+        # Aborting a complete archive keeps it
+        archive.abort()
+        self.assertEqual({'java/a/A.java': b'class A {}\n'},
+                         read_archive_files(archive_path,
+                                            ['java/a/A.java'], 1024))
+
+    def test_abort(self):
+        archive_path = os.path.join(self._temp_path, 'artifacts.tar.gz')
+        archive = StreamingArchive(archive_path, threads=1)
+        archive.add_tree(self._tree_path)
+        archive.abort()
+        archive.abort()
+        self.assertEqual(['tree'], os.listdir(self._temp_path))
+        self.assertIsNotNone(archive._compressor.returncode)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from artmanflow.steps.generation_cache import GenerationCache
+
+
+class GenerationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self._cache = GenerationCache(os.path.join(self._temp_path, 'cache'),
+                                      1024)
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_path)
+
+    def test_store_and_lookup(self):
+        self._cache.store('key', self._output('output', 'java/a/A.java'))
+        dest_path = os.path.join(self._temp_path, 'dest')
+        self.assertTrue(self._cache.lookup('key', dest_path))
+        self.assertTrue(os.path.isfile(os.path.join(dest_path, 'java', 'a',
+                                                    'A.java')))
+        self.assertFalse(self._cache.lookup('other', dest_path + '2'))
+        self.assertFalse(os.path.exists(dest_path + '2'))
+        stats = self._cache.stats()
+        self.assertEqual((1, 1, 1), (stats['hits'], stats['misses'],
+                                     stats['entries']))
+
+    def test_entry_removed_during_lookup(self):
+        entry_path = self._cache.store('key',
+                                       self._output('output', 'A.java'))
+        # Like an eviction by another execution while the tree is copied
+        shutil.rmtree(entry_path)
+        dest_path = os.path.join(self._temp_path, 'dest')
+        self.assertFalse(self._cache.lookup('key', dest_path))
+        self.assertFalse(os.path.exists(dest_path))
+        self.assertEqual(1, self._cache.stats()['misses'])
+
+    def test_evicts_least_recently_used(self):
+        self._cache.store('a', self._output('a', 'A.java', 600))
+        self._cache.store('b', self._output('b', 'B.java', 600))
+        self.assertFalse(self._cache.lookup(
+            'a', os.path.join(self._temp_path, 'dest')))
+        self.assertEqual(1, self._cache.stats()['evictions'])
+
+    def _output(self, name, file_path, size=10):
+        output_path = os.path.join(self._temp_path, name)
+        path = os.path.join(output_path, file_path)
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as output_file:
+            output_file.write('x' * size)
+        return output_path
+
+
+if __name__ == '__main__':
+    unittest.main()
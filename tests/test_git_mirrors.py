@@ -0,0 +1,127 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from artmanflow.steps.common import GitUtils
+from artmanflow.steps.git_mirrors import GitMirrorCache
+
+_GIT_IDENTITY = ['-c', 'user.name=artmanflow', '-c',
+                 'user.email=artmanflow@example.com']
+
+
+class GitMirrorCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self._output = tempfile.TemporaryFile('w+')
+        # A bare upstream repository, updated from a working clone
+        self._upstream_path = os.path.join(self._temp_path, 'googleapis.git')
+        self._work_path = os.path.join(self._temp_path, 'work')
+        self._git(['init', '-q', '--bare', self._upstream_path])
+        self._git(['init', '-q', self._work_path])
+        self._git(['checkout', '-q', '-b', 'master'], self._work_path)
+        self._git(['remote', 'add', 'origin', self._upstream_path],
+                  self._work_path)
+        self._config = {'git_repo': 'file://%s' % self._upstream_path,
+                        'git_branch': 'master', 'git_commit': 'HEAD'}
+        self._mirrors = GitMirrorCache(os.path.join(self._temp_path,
+                                                    'mirrors'))
+
+    def tearDown(self):
+        self._output.close()
+        shutil.rmtree(self._temp_path)
+
+    def test_mirror_name(self):
+        other_config = dict(self._config, git_repo='file://%s/other/%s' % (
+            self._temp_path, 'googleapis.git'))
+        name = self._mirrors.mirror_name(self._config)
+        self.assertTrue(name.startswith('googleapis-'))
+        self.assertTrue(name.endswith('.git'))
+        self.assertEqual(name, self._mirrors.mirror_name(dict(self._config)))
+        self.assertNotEqual(name, self._mirrors.mirror_name(other_config))
+
+    def test_clone_then_fetch(self):
+        first_commit = self._commit('first')
+        mirror_path = self._mirrors.update(self._config, self._output)
+        self.assertEqual(self._mirrors.mirror_path(self._config), mirror_path)
+        self.assertEqual(first_commit, self._rev_parse(mirror_path, 'master'))
+        # The mirror is fetched from the configured url, without credentials
+        self.assertEqual(self._config['git_repo'], self._git(
+            ['remote', 'get-url', 'origin'], mirror_path))
+
+        second_commit = self._commit('second')
+        self._git(['tag', 'v1'], self._work_path)
+        self._git(['push', '-q', 'origin', 'v1'], self._work_path)
+        self._mirrors.update(self._config, self._output)
+        self.assertEqual(second_commit,
+                         self._rev_parse(mirror_path, 'master'))
+        self.assertEqual(second_commit, self._rev_parse(mirror_path, 'v1'))
+        self.assertEqual(second_commit, GitUtils.resolve_commit(self._config))
+
+    def test_fetch_prunes_deleted_branches(self):
+        self._commit('first')
+        self._git(['push', '-q', 'origin', 'master:feature'],
+                  self._work_path)
+        mirror_path = self._mirrors.update(self._config, self._output)
+        self.assertIn('feature', self._git(['branch'], mirror_path))
+
+        self._git(['push', '-q', 'origin', ':feature'], self._work_path)
+        self._mirrors.update(self._config, self._output)
+        self.assertNotIn('feature', self._git(['branch'], mirror_path))
+
+    def test_clone_with_mirror_reference(self):
+        self._commit('first')
+        mirror_path = self._mirrors.update(self._config, self._output)
+        second_commit = self._commit('second')
+
+        # The clone gets the commits the mirror does not have yet from the
+        # upstream repository and does not depend on the mirror afterwards
+        clone_path = os.path.join(self._temp_path, 'clone')
+        os.makedirs(clone_path)
+        config = dict(self._config, git_reference=mirror_path)
+        subprocess.check_call(GitUtils.clone_command(config) + ['-q'],
+                              cwd=clone_path, stdout=self._output,
+                              stderr=self._output)
+        repo_path = os.path.join(clone_path, 'googleapis')
+        self.assertEqual(second_commit, self._rev_parse(repo_path, 'HEAD'))
+        self.assertFalse(os.path.isfile(os.path.join(
+            repo_path, '.git', 'objects', 'info', 'alternates')))
+
+        shutil.rmtree(mirror_path)
+        self._git(['fsck', '--no-progress'], repo_path)
+
+    def _commit(self, message):
+        with open(os.path.join(self._work_path, 'file.txt'), 'a') as file:
+            file.write(message + '\n')
+        self._git(['add', 'file.txt'], self._work_path)
+        self._git(_GIT_IDENTITY + ['commit', '-q', '-m', message],
+                  self._work_path)
+        self._git(['push', '-q', 'origin', 'master'], self._work_path)
+        return self._rev_parse(self._work_path, 'HEAD')
+
+    def _rev_parse(self, repo_path, rev):
+        return self._git(['rev-parse', rev], repo_path)
+
+    @staticmethod
+    def _git(args, cwd=None):
+        output = subprocess.check_output(['git'] + args, cwd=cwd)
+        return output.decode('UTF-8').strip()
+
+
+if __name__ == '__main__':
+    unittest.main()
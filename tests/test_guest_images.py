@@ -0,0 +1,218 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from artmanflow.steps.guest_images import GuestImageCache
+
+# Keeps the images in a directory: 'build' creates a file per tag (after the
+# base image seconds for 'sleep-<seconds>' base images), 'rmi' fails for the
+# tags listed in the busy file, like images used by a container
+_DOCKER_SHIM = '''#!%(python)s
+import json, os, re, sys, time
+state = os.environ['FAKE_DOCKER_STATE']
+with open(os.path.join(state, 'calls'), 'a') as calls:
+    calls.write(json.dumps(sys.argv[1:]) + '\\n')
+args = sys.argv[1:]
+image_path = lambda tag: os.path.join(state, 'images', tag.replace(':', '_'))
+if args[:2] == ['image', 'inspect']:
+    sys.exit(0 if os.path.isfile(image_path(args[2])) else 1)
+if args[0] == 'build':
+    dockerfile = sys.stdin.read()
+    if 'FROM broken' in dockerfile:
+        sys.exit(1)
+    sleep = re.search(r'FROM sleep-([0-9.]+)', dockerfile)
+    if sleep:
+        time.sleep(float(sleep.group(1)))
+    with open(image_path(args[args.index('-t') + 1]), 'w') as image:
+        image.write(dockerfile)
+    sys.exit(0)
+if args[0] == 'rmi':
+    busy_path = os.path.join(state, 'busy')
+    if os.path.isfile(busy_path) and args[1] in open(busy_path).read():
+        sys.exit(1)
+    os.remove(image_path(args[1]))
+    sys.exit(0)
+sys.exit(2)
+'''
+
+
+class GuestImageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        bin_path = os.path.join(self._temp_path, 'bin')
+        self._docker_state = os.path.join(self._temp_path, 'docker')
+        os.makedirs(bin_path)
+        os.makedirs(os.path.join(self._docker_state, 'images'))
+        docker_path = os.path.join(bin_path, 'docker')
+        with open(docker_path, 'w') as docker_file:
+            docker_file.write(_DOCKER_SHIM % {'python': sys.executable})
+        os.chmod(docker_path, os.stat(docker_path).st_mode | stat.S_IEXEC)
+
+        self._environ = dict(os.environ)
+        os.environ['PATH'] = bin_path + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_DOCKER_STATE'] = self._docker_state
+        # docker output goes to the execution stdout file
+        self._output = tempfile.TemporaryFile('w+')
+
+    def tearDown(self):
+        self._output.close()
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self._temp_path)
+
+    def test_builds_once_and_reuses(self):
+        cache = self._cache(2)
+        tag = self._ensure(cache, 'a' * 40)
+        self.assertEqual(GuestImageCache.image_tag('sha256:base', 'a' * 40,
+                                                   'b' * 40), tag)
+        self.assertEqual(tag, self._ensure(cache, 'a' * 40))
+
+        builds = [call for call in self._calls() if call[0] == 'build']
+        repo_url = self._repo_config('a' * 40)['git_repo']
+        self.assertEqual([['build', '--build-arg', 'ARTMAN_REPO=%s' % repo_url,
+                           '--build-arg', 'TOOLKIT_REPO=%s' % repo_url,
+                           '-t', tag, '-']], builds)
+        with open(self._image_path(tag)) as image_file:
+            dockerfile = image_file.read()
+        self.assertIn('FROM base-image', dockerfile)
+        self.assertIn('checkout %s' % ('a' * 40), dockerfile)
+        self.assertNotIn(repo_url, dockerfile)
+        self._output.seek(0)
+        self.assertIn('Using cached guest image %s' % tag,
+                      self._output.read())
+
+    def test_failed_build(self):
+        cache = self._cache(2)
+        self.assertIsNone(cache.ensure_image(
+            'broken', 'sha256:base', self._repo_config('a' * 40),
+            self._repo_config('b' * 40), self._output))
+        self.assertEqual({}, self._usage())
+
+    def test_unresolved_commits(self):
+        cache = self._cache(2)
+        self.assertIsNone(self._ensure(cache, 'not-a-commit'))
+        self.assertEqual([], self._calls())
+
+    def test_removes_least_recently_used(self):
+        cache = self._cache(2)
+        tags = [self._ensure(cache, commit * 40) for commit in 'abc']
+        self.assertEqual(sorted(tags[1:]), sorted(self._usage()))
+        self.assertFalse(os.path.isfile(self._image_path(tags[0])))
+        self.assertIn(['rmi', tags[0]], self._calls())
+
+        # Reused images are recently used again
+        self._ensure(cache, 'b' * 40)
+        self._ensure(cache, 'd' * 40)
+        self.assertEqual(sorted([tags[1], GuestImageCache.image_tag(
+            'sha256:base', 'd' * 40, 'b' * 40)]), sorted(self._usage()))
+
+    def test_keeps_images_rmi_fails_on(self):
+        cache = self._cache(1)
+        busy_tag = self._ensure(cache, 'a' * 40)
+        with open(os.path.join(self._docker_state, 'busy'), 'w') as busy:
+            busy.write(busy_tag)
+        tag = self._ensure(cache, 'b' * 40)
+        self.assertEqual(sorted([busy_tag, tag]), sorted(self._usage()))
+        self.assertTrue(os.path.isfile(self._image_path(busy_tag)))
+
+        # Removed by the next collection once it is not used anymore
+        os.remove(os.path.join(self._docker_state, 'busy'))
+        tag = self._ensure(cache, 'b' * 40)
+        self.assertEqual([tag], list(self._usage()))
+        self.assertFalse(os.path.isfile(self._image_path(busy_tag)))
+
+    def test_keeps_images_in_use(self):
+        cache = self._cache(1)
+        with cache.use_image('base-image', 'sha256:base',
+                             self._repo_config('a' * 40),
+                             self._repo_config('b' * 40),
+                             self._output) as used_tag:
+            tag = self._ensure(cache, 'b' * 40)
+            self.assertTrue(os.path.isfile(self._image_path(used_tag)))
+            self.assertNotIn(['rmi', used_tag], self._calls())
+        self.assertEqual(sorted([used_tag, tag]), sorted(self._usage()))
+
+        # Rebuilt when it was removed before its use
+        os.remove(self._image_path(used_tag))
+        with cache.use_image('base-image', 'sha256:base',
+                             self._repo_config('a' * 40),
+                             self._repo_config('b' * 40),
+                             self._output) as rebuilt_tag:
+            self.assertEqual(used_tag, rebuilt_tag)
+            self.assertTrue(os.path.isfile(self._image_path(used_tag)))
+
+    def test_builds_of_other_images_do_not_wait(self):
+        cache = self._cache(2)
+        finished = []
+
+        def ensure(base_image, artman_commit):
+            cache.ensure_image(base_image, 'sha256:base',
+                               self._repo_config(artman_commit),
+                               self._repo_config('b' * 40), self._output)
+            finished.append(artman_commit)
+
+        slow_build = threading.Thread(target=ensure,
+                                      args=('sleep-2', 'a' * 40))
+        slow_build.start()
+        time.sleep(0.5)
+        start_time = time.time()
+        ensure('base-image', 'c' * 40)
+        self.assertLess(time.time() - start_time, 1.5)
+        slow_build.join()
+        self.assertEqual(['c' * 40, 'a' * 40], finished)
+
+    def _cache(self, max_images):
+        return GuestImageCache(max_images,
+                               os.path.join(self._temp_path, 'state'))
+
+    def _ensure(self, cache, artman_commit):
+        return cache.ensure_image(
+            'base-image', 'sha256:base', self._repo_config(artman_commit),
+            self._repo_config('b' * 40), self._output)
+
+    @staticmethod
+    def _repo_config(commit):
+        return {'git_repo': 'https://github.com/googleapis/artman.git',
+                'git_branch': 'master', 'git_commit': commit}
+
+    def _image_path(self, tag):
+        return os.path.join(self._docker_state, 'images',
+                            tag.replace(':', '_'))
+
+    def _calls(self):
+        calls_path = os.path.join(self._docker_state, 'calls')
+        if not os.path.isfile(calls_path):
+            return []
+        with open(calls_path) as calls_file:
+            return [json.loads(line) for line in calls_file]
+
+    def _usage(self):
+        usage_path = os.path.join(self._temp_path, 'state', 'images.json')
+        if not os.path.isfile(usage_path):
+            return {}
+        with open(usage_path) as usage_file:
+            return json.load(usage_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import unittest
+
+from artmanflow.web.html_utils import AnsiHtmlConverter
+
+_SPAN_REGEX = re.compile(r"<span style='([^']*)'>(.*?)</span>|([^<]+)",
+                         re.S)
+
+_CONSOLE_OUTPUT = (
+    '\033[1;30msubprocess.check_call([\'git\', \'clone\'])\n\033[0m'
+    'plain <b>text</b> & more\n'
+    '\033[32mgreen \033[1mbold green\033[22m green\033[39m default\n'
+    '\033[38;5;208morange\033[48;2;10;20;30m on rgb\033[0m\n'
+    '\033[4munderlined\033[24m \033[3mitalic\033[m\n'
+    '\033[1;31mFailed\033[0m')
+
+
+def _styled_chars(html):
+    # (character, style) pairs, span boundaries do not matter
+    chars = []
+    for style, span_text, text in _SPAN_REGEX.findall(html):
+        for char in _unescape(span_text or text):
+            chars.append((char, style))
+    return chars
+
+
+def _unescape(text):
+    for entity, char in [('&lt;', '<'), ('&gt;', '>'), ('&amp;', '&')]:
+        text = text.replace(entity, char)
+    return text
+
+
+class AnsiHtmlConverterTest(unittest.TestCase):
+    def test_chunk_boundaries(self):
+        expected = _styled_chars(AnsiHtmlConverter().convert(_CONSOLE_OUTPUT))
+        self.assertEqual(
+            ''.join(char for char, style in expected),
+            re.sub(r'\033\[[0-9;]*m', '', _CONSOLE_OUTPUT))
+
+        # Every split point, including the middle of escape sequences
+        for split in range(1, len(_CONSOLE_OUTPUT)):
+            converter = AnsiHtmlConverter()
+            html = converter.convert(_CONSOLE_OUTPUT[:split]) + \
+                converter.convert(_CONSOLE_OUTPUT[split:])
+            self.assertEqual(expected, _styled_chars(html),
+                             'split at %s' % split)
+
+    def test_single_character_chunks(self):
+        expected = _styled_chars(AnsiHtmlConverter().convert(_CONSOLE_OUTPUT))
+        converter = AnsiHtmlConverter()
+        html = ''.join(converter.convert(char) for char in _CONSOLE_OUTPUT)
+        self.assertEqual(expected, _styled_chars(html))
+
+    def test_resume_from_state(self):
+        expected = _styled_chars(AnsiHtmlConverter().convert(_CONSOLE_OUTPUT))
+        for split in range(1, len(_CONSOLE_OUTPUT)):
+            head = _CONSOLE_OUTPUT[:split]
+            # A split escape sequence is left for the next chunk
+            partial = re.search(r'\033(\[[0-9;]*)?$', head)
+            if partial:
+                split = partial.start()
+            converter = AnsiHtmlConverter()
+            html = converter.convert(_CONSOLE_OUTPUT[:split])
+            resumed = AnsiHtmlConverter(converter.state())
+            html += resumed.convert(_CONSOLE_OUTPUT[split:])
+            self.assertEqual(expected, _styled_chars(html),
+                             'resumed at %s' % split)
+
+
+if __name__ == '__main__':
+    unittest.main()